@@ -0,0 +1,133 @@
+# Compares the ways a state broadcast can be turned into JSON:
+#   python benchmarks/serializer_benchmark.py [--json] [iterations]
+# --json measures the standard library backend even where orjson is installed
+from __future__ import print_function
+
+import json
+import os
+import sys
+import timeit
+
+if "--json" in sys.argv:
+    sys.argv.remove("--json")
+    sys.modules["orjson"] = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "octoprint_canvas"))
+
+import Serializer
+
+
+VALUES = {
+    "active_setup_id": "5f0c1c7e2b",
+    "palette_connected": False,
+    "palette_port": None,
+    "printer_connected": True,
+    "serial_port": b"/dev/ttyACM0",
+    "baud": 115200,
+    "nozzle_actual": 214.8,
+    "nozzle_target": 215.0,
+    "bed_actual": 59.9,
+    "bed_target": 60.0,
+    "chamber_actual": None,
+    "chamber_target": None,
+    "fan": 255,
+    "motor": True,
+    "job_name": "benchy.gcode",
+    "job_progress": 42.3,
+    "job_start": 1589912345,
+    "job_status": "PRINTING",
+    "job_total_time": 5400,
+    "job_time_remaining": 3120,
+    "filament_length": 3625.1,
+    "file_path": "benchy.gcode",
+    "file_size": 2412331,
+    "file_date": 1589912000,
+}
+
+
+def build_state(values):
+    # same shape as MQTTRouter._build_state
+    return {
+        "state": {
+            "simcoe": {"data": {"activeSetup": {"id": values["active_setup_id"]}}},
+            "palette": {"data": {"connected": values["palette_connected"],
+                                 "serial": {"port": values["palette_port"]}}},
+            "printer": {
+                "data": {
+                    "connected": values["printer_connected"],
+                    "serial": {"port": values["serial_port"], "baud": values["baud"]},
+                    "temperature": {
+                        "nozzle": [{"actual": values["nozzle_actual"], "target": values["nozzle_target"]}],
+                        "bed": {"actual": values["bed_actual"], "target": values["bed_target"]},
+                        "chamber": {"actual": values["chamber_actual"], "target": values["chamber_target"]},
+                    },
+                    "fan": values["fan"],
+                    "motor": values["motor"],
+                },
+                "job": {
+                    "name": values["job_name"],
+                    "progress": values["job_progress"],
+                    "time": {"start": values["job_start"]},
+                    "status": {"name": values["job_status"]},
+                    "data": {
+                        "totalTime": values["job_total_time"],
+                        "timeRemaining": values["job_time_remaining"],
+                        "filament": {"length": values["filament_length"]},
+                        "file": {"path": values["file_path"], "size": values["file_size"],
+                                 "date": values["file_date"]},
+                    },
+                },
+            },
+        }
+    }
+
+
+def message(body):
+    return {
+        "header": {"version": 1, "type": "state", "origin": {"id": "ab12cd34", "name": "canvas-hub"}},
+        "payload": {"status": 200, "seq": 1, "keyframe": True, "body": body},
+    }
+
+
+# the encoding MQTT.mqtt_publish did before Serializer
+def convert(data):
+    if isinstance(data, bytes) and not isinstance(data, str):
+        return data.decode('ascii')
+    if isinstance(data, dict):
+        return dict(map(convert, data.items()))
+    if isinstance(data, tuple):
+        return tuple(map(convert, data))
+    return data
+
+
+def previous():
+    return json.dumps(convert(message(build_state(VALUES))))
+
+
+def serializer():
+    return Serializer.dumps(message(build_state(VALUES)))
+
+
+encoder = Serializer.TemplateEncoder(build_state, list(VALUES))
+
+
+def template():
+    return Serializer.dumps(message(encoder.encode(VALUES)))
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    assert json.loads(previous()) == json.loads(serializer()) == json.loads(template())
+    print("backend: %s, %d iterations, %d -> %d bytes" % (Serializer.BACKEND, iterations,
+                                                         len(previous()), len(template())))
+    baseline = None
+    for name, fn in (("convert + json.dumps", previous),
+                     ("Serializer.dumps", serializer),
+                     ("TemplateEncoder", template)):
+        seconds = min(timeit.repeat(fn, number=iterations, repeat=3))
+        baseline = baseline or seconds
+        print("%-22s %8.2f us/message  %5.2fx" % (name, seconds / iterations * 1e6, baseline / seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import time
+
+# settings are clamped to these, a rate of 0 or a factor of 1 would stall or spin the broadcast task
+MIN_RATE = 0.01
+MIN_FACTOR = 1.5
+MIN_MAX_INTERVAL = 1
+
+
+def clamp(value, default, minimum):
+    # settings read as None when they don't parse
+    return max(minimum, default if value is None else value)
+
+
+class TokenBucket:
+    # Holds up to burst tokens and gains rate tokens per second; every publish takes one
+    def __init__(self, rate, burst):
+        self.rate = clamp(rate, 0.5, MIN_RATE)
+        self.burst = clamp(burst, 3, 1)
+        self.tokens = self.burst
+        self._updated = time.time()
+
+    def take(self):
+        # 0 if a token was taken, otherwise the seconds until one is there
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class BroadcastPolicy:
+    # When the state is broadcast. After a change the broadcasts back off: elapsed (seconds since the change)
+    # goes 0, 1, factor, factor^2... with no gap longer than max_interval. Triggers are held for
+    # coalesce_window seconds so a burst of them becomes one broadcast, and the bucket caps the rate on the
+    # state topic however often something triggers. Not thread safe, the router calls it under its lock.
+    def __init__(self, factor=5, max_interval=3600, coalesce_window=0.25, rate=0.5, burst=3):
+        self.factor = clamp(factor, 5, MIN_FACTOR)
+        self.max_interval = clamp(max_interval, 3600, MIN_MAX_INTERVAL)
+        self.coalesce_window = clamp(coalesce_window, 0.25, 0)
+        self.bucket = TokenBucket(rate, burst)
+        self.elapsed = 0
+
+    def reset(self):
+        self.elapsed = 0
+
+    def advance(self):
+        # called for each broadcast, returns the seconds until the next one
+        target = 1 if self.elapsed == 0 else self.elapsed * self.factor
+        delay = min(target - self.elapsed, self.max_interval)
+        self.elapsed += delay
+        return delay
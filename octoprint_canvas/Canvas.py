@@ -9,10 +9,20 @@ import socket
 import threading
 from subprocess import call
 from dotenv import load_dotenv
-from io import BytesIO, open  # for Python 2 & 3
+from io import open  # for Python 2 & 3
 from future.utils import listvalues, lmap  # for Python 2 & 3
 from . import constants
 from . import PaletteComm
+from . import Spool
+from . import DownloadCache
+from . import ZipStream
+from . import SegmentedDownload
+from . import DownloadManager
+from . import DownloadProgress
+from . import CanvasApi
+from . import TokenManager
+from . import RetryScheduler
+from . import CircuitBreaker
 import jwt
 try:
     from ruamel.yaml import YAML
@@ -39,7 +49,7 @@ class Canvas:
         self.hub_registered = False
         self.get_hub_yaml = plugin.get_hub_yaml
         self.replace_hub_yaml = plugin.replace_hub_yaml
-        self.save_hub_yaml = plugin.save_hub_yaml
+        self.edit_hub_yaml = plugin.edit_hub_yaml
         self.isHubS = False
         self.registerThread = None
         self.plugin = plugin
@@ -49,14 +59,35 @@ class Canvas:
         self.private_path = self.path + "private.pem.key"
         self.public_path = self.path + "public.pem.key"
         self.palette_comm = PaletteComm.PaletteComm(plugin)
+        self.breakers = CircuitBreaker.CircuitBreakers(self.logger, on_change=self._onCircuitChange)
+        self.api = CanvasApi.CanvasApi(self.logger, "https://" + BASE_URL_API, breakers=self.breakers)
+        self.tokens = TokenManager.TokenManager(self.logger, self._fetchAccessToken, self._saveAccessToken)
+        self.retry_stop = threading.Event()
+        self.registration_retry = RetryScheduler.RetryScheduler(self.logger, "device registration",
+                                                                RetryScheduler.Backoff(5, 600),
+                                                                stop_event=self.retry_stop)
+        self.device_retry = RetryScheduler.RetryScheduler(self.logger, "device lookup", RetryScheduler.Backoff(5, 300),
+                                                          max_attempts=5, stop_event=self.retry_stop)
+        self.account_retry = RetryScheduler.RetryScheduler(self.logger, "linked account sync",
+                                                           RetryScheduler.Backoff(2, 300), max_attempts=8,
+                                                           stop_event=self.retry_stop)
+        if "canvas-hub" in self.get_hub_yaml() and "device" in self.get_hub_yaml()["canvas-hub"]:
+            self.tokens.seed(self.get_hub_yaml()["canvas-hub"].get("accessToken"))
+            self.tokens.start()
+        self.download_cache = DownloadCache.DownloadCache(
+            os.path.join(self._getSpoolFolder(), constants.DOWNLOAD_CACHE_FOLDER),
+            self._settings.get_int(["downloadCacheSize"]) * 1024 * 1024)
+        self.download_manager = DownloadManager.DownloadManager(self.logger, self.downloadPrintFiles,
+                                                                self._settings.get_int(["downloadConcurrency"]),
+                                                                self._onDownloadJobChange)
         self.mqtt_connected = False
         if ("mqtt" in self.get_hub_yaml()
                 and "broker" in self.get_hub_yaml()["mqtt"]
                 and "endpoint" in self.get_hub_yaml()["mqtt"]["broker"]):
-            self.mqtt = MQTT.MQTT(plugin, self.downloadPrintFiles)
+            self.mqtt = MQTT.MQTT(plugin, self.download_manager)
             self.mqtt.on_connection_status_change = self.onMqttConnectionChange
             self.mqtt.mqtt_connect()
-        self._getLinkedAccount()
+        self._startLinkedAccountSync()
         self.syncHostname()
 
     ##############
@@ -85,89 +116,94 @@ class Canvas:
 
     def _registerDevice(self):
         self.logger.info(getLog("registering device"))
-        while not self.device_registered:
-            if not "serial-number" in self.get_hub_yaml()["canvas-hub"]:
-                self.logger.debug(getLog("No serial-number found"))
-                name = str(randrange(10000000000000)) + \
-                    yaml.load(self._settings.config_yaml)["server"]["secretKey"]
-                payload = {
-                    "name": name,
-                    "type": "canvas-hub",
-                    "model": "diy"
-                }
-            else:
-                self.logger.debug(getLog("Found hub serial-number"))
-                name = self.get_hub_yaml()["canvas-hub"]["serial-number"]
-                serialNumber = self.get_hub_yaml()["canvas-hub"]["serial-number"]
-                payload = {
-                    "hostname": serialNumber + "-canvas-hub.local/",
-                    "name": name,
-                    "serialNumber": serialNumber,
-                    "type": "canvas-hub",
-                    "model": "mosaic"
-                }
-            self.logger.debug(getLog("update hostname"))
-            hostname = self._getHostname()
-            if hostname:
-                payload["hostname"] = hostname
-            if self.isHubS:
-                payload["model"] = "mosaic-s"
-            self.logger.debug(getLog("Generating url"))
-            url = "https://" + BASE_URL_API + "devices"
-            try:
-                response = requests.put(url, json=payload)
-                response_body = response.json()
-                if response.status_code >= 400:
-                    self.logger.error(getLog("error getting response"))
-                    time.sleep(30)
-                else:
-                    self.logger.debug(getLog("response successful"))
-                    self._saveDeviceRegistrationResponse(response_body)
-                    self.device_registered = True
-            except requests.exceptions.RequestException as e:
-                self.logger.info(getLog(e))
-                time.sleep(30)
-        return
+        try:
+            self.registration_retry.run(self._attemptRegistration)
+        except RetryScheduler.RetriesExhausted as e:
+            self.logger.error(getLog(str(e)))
+
+    def _attemptRegistration(self):
+        if not "serial-number" in self.get_hub_yaml()["canvas-hub"]:
+            self.logger.debug(getLog("No serial-number found"))
+            name = str(randrange(10000000000000)) + \
+                yaml.load(self._settings.config_yaml)["server"]["secretKey"]
+            payload = {
+                "name": name,
+                "type": "canvas-hub",
+                "model": "diy"
+            }
+        else:
+            self.logger.debug(getLog("Found hub serial-number"))
+            name = self.get_hub_yaml()["canvas-hub"]["serial-number"]
+            serialNumber = self.get_hub_yaml()["canvas-hub"]["serial-number"]
+            payload = {
+                "hostname": serialNumber + "-canvas-hub.local/",
+                "name": name,
+                "serialNumber": serialNumber,
+                "type": "canvas-hub",
+                "model": "mosaic"
+            }
+        self.logger.debug(getLog("update hostname"))
+        hostname = self._getHostname()
+        if hostname:
+            payload["hostname"] = hostname
+        if self.isHubS:
+            payload["model"] = "mosaic-s"
+        response = self.api.put("devices", "register", json=payload)
+        if response.status_code >= 400:
+            self.logger.error(getLog("error getting response"))
+            raise RetryScheduler.Retry("registration answered %s" % response.status_code,
+                                       RetryScheduler.retry_after_seconds(response))
+        self.logger.debug(getLog("response successful"))
+        self._saveDeviceRegistrationResponse(response.json())
+        self.device_registered = True
 
     def _saveDeviceRegistrationResponse(self, response):
         self.logger.info(getLog("Saving registration response"))
         if "refreshToken" in response:
             self.logger.debug(getLog("found refresh token ... saving"))
-            self.get_hub_yaml()["canvas-hub"].update(refreshToken=response["refreshToken"],
-                                               accessToken=response["accessToken"],
-                                               clientId=response["clientId"],
-                                               device=response["device"])
-
             # create certs
             self._writeFile(self.cert_path, response["certificate"]["pem"])
             self._writeFile(self.private_path, response["certificate"]["privateKey"])
             self._writeFile(self.public_path, response["certificate"]["publicKey"])
 
-            # construct topics
-            device_id = self.get_hub_yaml()["canvas-hub"]["device"]["id"]
-            topic_prefix = self.get_hub_yaml()["mqtt"]["publish"]["topicPrefix"]
-            origin_name = self.get_hub_yaml()["mqtt"]["publish"]["originName"]
-            all_devices = topic_prefix + '/devices'
-            all_canvas_hubs = topic_prefix + '/devices/canvas-hub'
-            device_topic_prefix = topic_prefix + '/devices/' + device_id
-            device_request_topic_prefix = device_topic_prefix + '/' + origin_name + '/request/#'
-            broadcast_health_topic = device_topic_prefix + '/' + origin_name + '/broadcast/health'
-            broadcast_state_topic = device_topic_prefix + '/' + origin_name + '/broadcast/state'
-            self.get_hub_yaml()["mqtt"]["topics"]['requests'].update(allDevices=all_devices,
-                                                   allCanvasHubs=all_canvas_hubs,
-                                                   deviceTopicPrefix=device_topic_prefix,
-                                                   deviceRequestTopicPrefix=device_request_topic_prefix)
-            self.get_hub_yaml()["mqtt"]["topics"]['broadcasts'].update(healthTopic=broadcast_health_topic,
-                                                                 stateTopic=broadcast_state_topic)
+            # credentials and topics are published together, MQTT never sees a device without its topics
+            with self.edit_hub_yaml() as hub_yaml:
+                hub_yaml["canvas-hub"].update(refreshToken=response["refreshToken"],
+                                              accessToken=response["accessToken"],
+                                              clientId=response["clientId"],
+                                              device=response["device"])
+
+                # construct topics
+                device_id = hub_yaml["canvas-hub"]["device"]["id"]
+                topic_prefix = hub_yaml["mqtt"]["publish"]["topicPrefix"]
+                origin_name = hub_yaml["mqtt"]["publish"]["originName"]
+                all_devices = topic_prefix + '/devices'
+                all_canvas_hubs = topic_prefix + '/devices/canvas-hub'
+                device_topic_prefix = topic_prefix + '/devices/' + device_id
+                device_request_topic_prefix = device_topic_prefix + '/' + origin_name + '/request/#'
+                broadcast_health_topic = device_topic_prefix + '/' + origin_name + '/broadcast/health'
+                broadcast_state_topic = device_topic_prefix + '/' + origin_name + '/broadcast/state'
+                hub_yaml["mqtt"]["topics"]['requests'].update(allDevices=all_devices,
+                                                              allCanvasHubs=all_canvas_hubs,
+                                                              deviceTopicPrefix=device_topic_prefix,
+                                                              deviceRequestTopicPrefix=device_request_topic_prefix)
+                hub_yaml["mqtt"]["topics"]['broadcasts'].update(healthTopic=broadcast_health_topic,
+                                                                stateTopic=broadcast_state_topic)
+                hub_yaml["canvas-hub"].update(version=3)
             self.device_registered = True
-            self.get_hub_yaml()["canvas-hub"].update(version=3)
-            self.save_hub_yaml()
+            # the new credentials must survive a power cut right after registration
+            self.plugin.flush_hub_yaml()
+            self.tokens.seed(response["accessToken"])
+            self.tokens.start()
             if self.mqtt_connected == False:
-                self.mqtt = MQTT.MQTT(self.plugin, self.downloadPrintFiles)
+                if hasattr(self, "mqtt"):
+                    # the replaced router would keep receiving printer updates
+                    self.mqtt.mqttRouter.close()
+                self.mqtt = MQTT.MQTT(self.plugin, self.download_manager)
                 self.mqtt.on_connection_status_change = self.onMqttConnectionChange
                 self.logger.debug(getLog('calling mqtt_connect'))
                 self.mqtt.mqtt_connect()
-            self._getLinkedAccount()
+            self._startLinkedAccountSync()
 
         else:
             self.logger.debug(getLog("no refresh token from response"))
@@ -175,83 +211,88 @@ class Canvas:
     def _getDevice(self):
         device = self.get_hub_yaml()["canvas-hub"]["device"]
         if "id" in device:
-            url = "https://" + BASE_URL_API + "devices/" + device["id"]
-            headers = {
-                "content-type": "application/json",
-                "Authorization": "Bearer " + self.get_hub_yaml()["canvas-hub"]["accessToken"]
-            }
             try:
-                self.logger.debug(getLog("getting device by id"))
-                response = requests.get(url, headers=headers)
-                if response.status_code >= 400:
-                    self.logger.error(getLog("error getting device by id"))
-                    time.sleep(30)
-                else:
-                    self.logger.debug(getLog("device response successful"))
-                    self._connectMQTTClient()
-            except requests.exceptions.RequestException as e:
-                self.logger.error(getLog('request exception: ' + str(e)))
-                time.sleep(30)
+                self.device_retry.run(lambda: self._attemptGetDevice(device["id"]))
+                self._connectMQTTClient()
+            except RetryScheduler.RetriesExhausted as e:
+                self.logger.error(getLog(str(e)))
+
+    def _attemptGetDevice(self, device_id):
+        headers = {
+            "content-type": "application/json",
+            "Authorization": "Bearer " + self.tokens.get()
+        }
+        self.logger.debug(getLog("getting device by id"))
+        response = self.api.get("devices/" + device_id, "device", headers=headers)
+        if response.status_code >= 400:
+            self.logger.error(getLog("error getting device by id"))
+            raise RetryScheduler.Retry("device lookup answered %s" % response.status_code,
+                                       RetryScheduler.retry_after_seconds(response))
+        self.logger.debug(getLog("device response successful"))
+
+    def _startLinkedAccountSync(self):
+        thread = threading.Thread(target=self._getLinkedAccount)
+        thread.daemon = True
+        thread.start()
 
     def _getLinkedAccount(self):
         if "canvas-hub" in self.get_hub_yaml() and "device" in self.get_hub_yaml()["canvas-hub"]:
             device = self.get_hub_yaml()["canvas-hub"]["device"]
             if "id" in device:
-                if not self.accessTokenValid():
-                    self.get_hub_yaml()["canvas-hub"]["accessToken"] = self.getNewAccessToken()
-                    self.save_hub_yaml()
-                url = "https://" + BASE_URL_API + "devices/" + device["id"] + "/link"
-                headers = {
-                    "content-type": "application/json",
-                    "Authorization": "Bearer " + self.get_hub_yaml()["canvas-hub"]["accessToken"]
-                }
                 try:
-                    self.logger.debug(getLog("getting linked account data"))
-                    response = requests.get(url, headers=headers)
-                    if response.status_code == 200:
-                        self.logger.debug(getLog("got linked account data"))
-                        # linked user ID and username available in response
-                        response_body = response.json()
-                        self.get_hub_yaml()["canvas-user"]["id"] = response_body["user"]["id"]
-                        self.get_hub_yaml()["canvas-user"]["username"] = response_body["user"][
-                            "username"]
-                        self.save_hub_yaml()
-                        self.updateUsersOnUI()
-                    elif response.status_code == 204:
-                        self.logger.debug(getLog("no linked account"))
-                        # no linked user exists
-                        self.get_hub_yaml()["canvas-user"] = {}
-                        self.save_hub_yaml()
-                        self.updateUsersOnUI()
-                    else:
-                        self.logger.error(getLog("error getting linked account data"))
-                except requests.exceptions.RequestException as e:
-                    self.logger.error(getLog('request exception: ' + str(e)))
+                    self.account_retry.run(lambda: self._attemptLinkedAccountSync(device["id"]))
+                except RetryScheduler.RetriesExhausted as e:
+                    self.logger.error(getLog(str(e)))
+
+    def _attemptLinkedAccountSync(self, device_id):
+        headers = {
+            "content-type": "application/json",
+            "Authorization": "Bearer " + self.tokens.get()
+        }
+        self.logger.debug(getLog("getting linked account data"))
+        response = self.api.get("devices/" + device_id + "/link", "link", headers=headers)
+        if response.status_code == 200:
+            self.logger.debug(getLog("got linked account data"))
+            # linked user ID and username available in response
+            response_body = response.json()
+            with self.edit_hub_yaml() as hub_yaml:
+                hub_yaml["canvas-user"]["id"] = response_body["user"]["id"]
+                hub_yaml["canvas-user"]["username"] = response_body["user"]["username"]
+            self.updateUsersOnUI()
+        elif response.status_code == 204:
+            self.logger.debug(getLog("no linked account"))
+            # no linked user exists
+            with self.edit_hub_yaml() as hub_yaml:
+                hub_yaml["canvas-user"] = {}
+            self.updateUsersOnUI()
+        elif response.status_code == 429 or response.status_code >= 500:
+            raise RetryScheduler.Retry("linked account answered %s" % response.status_code,
+                                       RetryScheduler.retry_after_seconds(response))
+        else:
+            self.logger.error(getLog("error getting linked account data"))
 
     def syncHostname(self):
         self.logger.info(getLog('check for hostname'))
         try:
-            if "canvas-hub" in self.get_hub_yaml() and "device" in self.get_hub_yaml()["canvas-hub"]:
-                device = self.get_hub_yaml()["canvas-hub"]["device"]
+            hub_yaml = self.get_hub_yaml()
+            if "canvas-hub" in hub_yaml and "device" in hub_yaml["canvas-hub"]:
+                device = hub_yaml["canvas-hub"]["device"]
                 if "hostname" in device:
-                    if not self.accessTokenValid():
-                        self.get_hub_yaml()["canvas-hub"]["accessToken"] = self.getNewAccessToken()
-                        self.save_hub_yaml()
                     hostname = self._getHostname();
                     self.logger.info(getLog('hostname: ' + str(hostname)))
-                    if hostname != self.get_hub_yaml()["canvas-hub"]['device']['hostname']:
+                    if hostname != device['hostname']:
                         self.logger.info(getLog('hostname mismatch'))
-                        self.get_hub_yaml()["canvas-hub"]['device']['hostname'] = hostname;
-                        self.save_hub_yaml()
-                        url = "https://" + BASE_URL_API + "devices/" + device["id"]
-                        headers = {
-                            "content-type": "application/json",
-                            "Authorization": "Bearer " + self.get_hub_yaml()["canvas-hub"]["accessToken"]
-                        }
+                        with self.edit_hub_yaml() as hub_yaml:
+                            hub_yaml["canvas-hub"]['device']['hostname'] = hostname
+                        url = "devices/" + device["id"]
                         try:
+                            headers = {
+                                "content-type": "application/json",
+                                "Authorization": "Bearer " + self.tokens.get()
+                            }
                             self.logger.debug(getLog("updating hostname"))
                             payload = {"hostname": hostname}
-                            response = requests.post(url, headers=headers, json=payload)
+                            response = self.api.post(url, "hostname", headers=headers, json=payload)
                             if response.status_code >= 200 and response.status_code < 300:
                                 self.logger.debug(getLog("successfully updated hostname"))
                             else:
@@ -264,10 +305,10 @@ class Canvas:
     def updateUsersOnUI(self):
         self.logger.info(getLog('updating usernames in UI'))
         users = []
-        if ("canvas-user" in self.get_hub_yaml()
-                and "username" in self.get_hub_yaml()["canvas-user"]):
+        canvas_user = self.get_hub_yaml().get("canvas-user", {})
+        if "username" in canvas_user:
             users = [{
-                "username": self.get_hub_yaml()["canvas-user"]["username"]
+                "username": canvas_user["username"]
             }]
         self.updateUI({
             "command": "UpdateLinkedUsers",
@@ -284,7 +325,7 @@ class Canvas:
     def updateIotConnectionOnUI(self):
         self.logger.info(getLog('updating IoT connection status in UI'))
         userLinked = False
-        if 'canvas-user' in self.get_hub_yaml() and 'id' in self.get_hub_yaml()["canvas-user"]:
+        if 'id' in self.get_hub_yaml().get("canvas-user", {}):
             userLinked = True
         self.updateUI({
             "command": "UpdateIotConnection",
@@ -294,47 +335,202 @@ class Canvas:
             },
         })
 
-    def _streamFileProgress(self, response, filename):
+    def _downloadToSpool(self, response, job, spool, etag):
         self.logger.debug(getLog("Starting stream buffer"))
         self.updateUI({
             "command": "CanvasDownload",
             "data": {
-                "filename": filename
+                "filename": job.name
             },
             "status": "starting"
         })
-        buffer = BytesIO()
-        total_bytes = int(response.headers.get("content-length"))
-        chunk_size = total_bytes // 100  # for Python 2 & 3
-
-        for data in response.iter_content(chunk_size=chunk_size):
-            buffer.write(data)
-            downloaded_bytes = float(len(buffer.getvalue()))
-            percentage_completion = int((downloaded_bytes / total_bytes) * 100)
-            self.logger.info(getLog("%s%% downloaded" % percentage_completion))
+        total_bytes = spool.size() + int(response.headers.get("content-length", 0))
+        progress = DownloadProgress.DownloadProgress(total_bytes, spool.size(),
+                                                     self._settings.get_float(["downloadProgressInterval"]))
+        self.logger.info(getLog("Downloading %s (%s of %s bytes to go)" % (job.name, total_bytes - spool.size(),
+                                                                            total_bytes)))
+        self._sendDownloadProgress(job.name, progress.start())
+        try:
+            if self._useSegments(response, spool, total_bytes, etag):
+                try:
+                    self._segmentedFileProgress(response, job, spool, etag, progress)
+                except SegmentedDownload.RangeNotSupported as e:
+                    # keep what the segments got so far and fetch the rest as a single stream
+                    self.logger.info(getLog("Segmented download not possible, continuing as one stream: " + str(e)))
+                    response = self.breakers.call(job.url, requests.get, job.url, stream=True,
+                                                  timeout=constants.DOWNLOAD_TIMEOUT)
+                    response.raise_for_status()
+                    self._streamFileProgress(response, job, spool, etag, progress, skip=spool.size())
+            else:
+                self._streamFileProgress(response, job, spool, etag, progress)
+        except Exception as e:
+            spool.fail(e)
+            raise
+        spool.finish()
+        downloaded_bytes = spool.size()
+        self._sendDownloadProgress(job.name, progress.update(downloaded_bytes, force=True, finished=True))
+        self.logger.info(getLog("Downloaded %s: %s bytes at %s bytes/s" % (
+            job.name, downloaded_bytes, progress.average_bytes_per_second(downloaded_bytes))))
+        self.download_manager.set_state(job, DownloadManager.EXTRACTING)
+        self.updateUI({
+            "command": "CanvasDownload",
+            "data": {
+                "filename": job.name
+            },
+            "status": "received"
+        })
+
+    def _useSegments(self, response, spool, total_bytes, etag):
+        # segments are written into the cache partial, so only cacheable downloads from servers that take ranges
+        segments = self._settings.get_int(["downloadSegments"]) or 1
+        min_size = (self._settings.get_int(["downloadSegmentMinSize"]) or 0) * 1024 * 1024
+        return (segments > 1 and bool(etag) and response.headers.get("Accept-Ranges") == "bytes"
+                and total_bytes - spool.size() >= max(min_size, segments))
+
+    def _reportDownloadProgress(self, filename, progress, downloaded_bytes, force=False):
+        report = progress.update(downloaded_bytes, force)
+        if report is None:
+            return
+        if progress.log_due():
+            self.logger.info(getLog("%s%% downloaded, %s bytes/s" % (report["progress"], report["bytesPerSecond"])))
+        self._sendDownloadProgress(filename, report)
+
+    def _sendDownloadProgress(self, filename, report):
+        data = {
+            "filename": filename
+        }
+        data.update(report)
+        self.updateUI({
+            "command": "CanvasDownload",
+            "data": data,
+            "status": "downloading"
+        }, False)
+
+    def _streamFileProgress(self, response, job, spool, etag, progress, skip=0):
+        # skip drops bytes the spool already has from the start of a response that ignored the Range header
+        downloaded_bytes = spool.size()
+        resumes = 0
+        stream_hash = DownloadCache.StreamHash(etag, spool.path, downloaded_bytes)
+        while True:
+            try:
+                for data in response.iter_content(chunk_size=constants.DOWNLOAD_CHUNK_SIZE):
+                    job.raise_if_cancelled()
+                    if skip:
+                        skipped = min(skip, len(data))
+                        skip -= skipped
+                        data = data[skipped:]
+                        if not data:
+                            continue
+                    spool.write(data)
+                    stream_hash.update(data)
+                    downloaded_bytes += len(data)
+                    self._reportDownloadProgress(job.name, progress, downloaded_bytes)
+                break
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                resumes += 1
+                if not etag or resumes > constants.DOWNLOAD_RESUME_ATTEMPTS:
+                    raise
+                self.logger.info(getLog("Download interrupted, resuming from byte %s" % downloaded_bytes))
+                response = self._requestRange(job.url, downloaded_bytes, etag)
+                skip = 0
+                if response.status_code != 206:
+                    response.close()
+                    raise
+        stream_hash.verify()
+
+    def _segmentedFileProgress(self, response, job, spool, etag, progress):
+        total_bytes = progress.total_bytes
+        segments = self._settings.get_int(["downloadSegments"])
+        self.logger.info(getLog("Downloading %s bytes in %s segments" % (total_bytes - spool.size(), segments)))
+        download = SegmentedDownload.SegmentedDownload(job.url, spool, total_bytes, segments, etag,
+                                                       constants.DOWNLOAD_CHUNK_SIZE,
+                                                       constants.DOWNLOAD_RESUME_ATTEMPTS, first_response=response,
+                                                       breakers=self.breakers)
+
+        def on_progress(downloaded_bytes):
+            job.raise_if_cancelled()
+            self._reportDownloadProgress(job.name, progress, downloaded_bytes)
+        download.run(on_progress, progress.interval)
+        # the segments arrived out of order, so the checksum is taken over the finished file
+        DownloadCache.StreamHash(etag, spool.path, total_bytes).verify()
+
+    def _getSpoolFolder(self):
+        spool_folder = os.path.join(self._settings.global_get_basefolder("uploads"), constants.DOWNLOAD_SPOOL_FOLDER)
+        if not os.path.isdir(spool_folder):
+            os.makedirs(spool_folder)
+        return spool_folder
+
+    def _requestRange(self, s3url, offset, etag):
+        # If-Range makes the server send the whole file instead if it changed since the partial download
+        headers = {"Range": "bytes=%s-" % offset, "If-Range": etag}
+        return self.breakers.call(s3url, requests.get, s3url, stream=True, headers=headers,
+                                  timeout=constants.DOWNLOAD_TIMEOUT)
+
+    def _releaseSpool(self, spool, key, extracted):
+        # only an archive that downloaded and extracted cleanly is cached
+        error = spool.wait_closed()
+        if key is None:
+            spool.discard()
+        elif error is None and extracted:
+            self.download_cache.commit(key)
+        elif error is None or isinstance(error, DownloadCache.ChecksumMismatch):
+            # complete but broken (bad zip, CRC mismatch), fetching it again is the only fix
+            self.download_cache.drop(key)
+        # any other failure keeps the partial download so the next attempt can resume it
+
+    def _extractZipfile(self, spool, name, release):
+        # runs alongside the download, members land in the watched folder as soon as their bytes arrive.
+        # release(extracted) is called at the end, extracted is True only if every member came out
+        extracted = False
+        watched_path = self._settings.global_get_basefolder("watched")
+        self.logger.info(getLog("Extracting zip file"))
+        reader = spool.open_reader()
+        extractor = ZipStream.StreamingZipExtractor(reader, watched_path,
+                                                    lambda member, count: self._onMemberExtracted(name, member, count))
+        try:
+            try:
+                extractor.extract()
+            except ZipStream.UnsupportedZip as e:
+                self.logger.info(getLog("Extracting after download completes: " + str(e)))
+                if spool.wait_closed() is not None:
+                    return
+                zip_file = zipfile.ZipFile(spool.path)
+                for member in zip_file.infolist():
+                    if member.filename not in extractor.extracted:
+                        zip_file.extract(member, watched_path)
+                        extractor.extracted.append(member.filename)
+                        self._onMemberExtracted(name, member.filename, len(extractor.extracted))
+                zip_file.close()
             self.updateUI({
                 "command": "CanvasDownload",
                 "data": {
-                    "filename": filename,
-                    "progress": percentage_completion
+                    "filename": name,
+                    "members": len(extractor.extracted)
                 },
-                "status": "downloading"
-            }, False)
-        return buffer
-
-    def _extractZipfile(self, buffer_file, name):
-        zip_file = zipfile.ZipFile(buffer_file)
-        watched_path = self._settings.global_get_basefolder("watched")
+                "status": "extracted"
+            })
+            extracted = True
+        except Spool.SpoolError as e:
+            # the download failed, downloadPrintFiles reports its error
+            self.logger.error(getLog(str(e)))
+        except Exception as e:
+            self.logger.error(getLog("Error extracting zip file: " + str(e)))
+            raise
+        finally:
+            reader.close()
+            release(extracted)
+
+    def _onMemberExtracted(self, name, member, count):
+        self.logger.info(getLog("Extracted " + member))
         self.updateUI({
             "command": "CanvasDownload",
             "data": {
-                "filename": name
+                "filename": name,
+                "member": member,
+                "count": count
             },
-            "status": "received"
-        })
-        self.logger.info(getLog("Extracting zip file"))
-        zip_file.extractall(watched_path)
-        zip_file.close()
+            "status": "extracting"
+        }, False)
 
     def _getHostname(self):
         try:
@@ -350,23 +546,23 @@ class Canvas:
     def _updateHostname(self, new_hostname):
         self.logger.debug(getLog("Updating Hostname: " + new_hostname))
         hub_id = self.get_hub_yaml()["canvas-hub"]["id"]
-        url = "https://" + BASE_URL_API + "hubs/" + hub_id
+        url = "hubs/" + hub_id
         headers = self._getAuthorizationHeader()
         payload = {"hostname": new_hostname}
         try:
-            response = requests.post(url, json=payload, headers=headers)
+            response = self.api.post(url, "hostname", json=payload, headers=headers)
             response_body = response.json()
             if response.status_code >= 400:
                 self.logger.error(getLog('error getting response'))
             else:
                 if new_hostname:
                     self.logger.debug(getLog("Hostname updated: %s" % new_hostname))
-                    self.get_hub_yaml()["canvas-hub"]["hostname"] = new_hostname
-                    self.save_hub_yaml()
+                    with self.edit_hub_yaml() as hub_yaml:
+                        hub_yaml["canvas-hub"]["hostname"] = new_hostname
                 else:
                     self.logger.debug(getLog("Deleting hostname"))
-                    del self.get_hub_yaml()["canvas-hub"]["hostname"]
-                    self.save_hub_yaml()
+                    with self.edit_hub_yaml() as hub_yaml:
+                        hub_yaml["canvas-hub"].pop("hostname", None)
         except requests.exceptions.RequestException as e:
             self.logger.error(getLog(e))
 
@@ -390,16 +586,16 @@ class Canvas:
             self.get_hub_yaml()["canvas-hub"]["token"] == constants.PROBLEMATIC_HUB_VALUES["token"]
         ):
             self.logger.debug(getLog("0cf0 found."))
-            del self.get_hub_yaml()["canvas-hub"]["hub"]
-            del self.get_hub_yaml()["canvas-hub"]["token"]
-            self.save_hub_yaml()
+            with self.edit_hub_yaml() as hub_yaml:
+                del hub_yaml["canvas-hub"]["hub"]
+                del hub_yaml["canvas-hub"]["token"]
 
     def checkIfRootCertExists(self):
         root_ca_path = os.path.expanduser('~') + "/.mosaicdata/root-ca.crt"
         if not os.path.isfile(root_ca_path):
             self.logger.debug(getLog("downloading root-ca cert"))
             try:
-                response = requests.get(constants.ROOT_CA_CERTIFICATE)
+                response = self.api.get(constants.ROOT_CA_CERTIFICATE, "root-ca")
                 self._writeFile(root_ca_path, response.content.decode())
                 self.logger.debug(getLog("successfully downloaded root-ca"))
             except requests.exceptions.RequestException as e:
@@ -424,18 +620,18 @@ class Canvas:
             self._startRegisterThread()
 
     def updatePluginVersions(self):
-        updated = False
-        if "versions" in self.get_hub_yaml():
+        versions = self.get_hub_yaml().get("versions")
+        if versions:
+            updated = {}
             # canvas
-            if self.get_hub_yaml()["versions"]["canvas-plugin"] != self._plugin_version:
-                self.get_hub_yaml()["versions"]["canvas-plugin"] = self._plugin_version
-                updated = True
+            if versions["canvas-plugin"] != self._plugin_version:
+                updated["canvas-plugin"] = self._plugin_version
             # palette 2
-            if self._plugin_manager.get_plugin_info("palette2") and self.get_hub_yaml()["versions"]["palette-plugin"] != self._plugin_manager.get_plugin_info("palette2").version:
-                self.get_hub_yaml()["versions"]["palette-plugin"] = self._plugin_manager.get_plugin_info("palette2").version
-                updated = True
+            if self._plugin_manager.get_plugin_info("palette2") and versions["palette-plugin"] != self._plugin_manager.get_plugin_info("palette2").version:
+                updated["palette-plugin"] = self._plugin_manager.get_plugin_info("palette2").version
             if updated:
-                self.save_hub_yaml()
+                with self.edit_hub_yaml() as hub_yaml:
+                    hub_yaml["versions"].update(updated)
 
     def determineHubVersion(self):
         hub_yaml = self.get_hub_yaml()
@@ -459,22 +655,18 @@ class Canvas:
         if self.device_registered:
             linked = self.checkLinkedAccount()
             if linked:
-                if not self.accessTokenValid():
-                    self.get_hub_yaml()["canvas-hub"]["accessToken"] = self.getNewAccessToken()
-                    self.save_hub_yaml()
-                url = "https://" + BASE_URL_API + "devices/" + self.get_hub_yaml()["canvas-hub"]["device"]["id"] + \
-                      "/link"
-                access_token = self.get_hub_yaml()["canvas-hub"]["accessToken"]
+                url = "devices/" + self.get_hub_yaml()["canvas-hub"]["device"]["id"] + "/link"
+                access_token = self.tokens.get()
                 headers = {"Authorization": "Bearer %s" % access_token}
-                response = requests.delete(url, headers=headers)
+                response = self.api.delete(url, "link", headers=headers)
                 response_body = response.json()
                 if response.status_code >= 400:
                     self.logger.error(getLog('Error unlinking account: ', response_body))
                     self.updateUI({"command": "AccountUnlinkError"})
                 else:
-                    username = self.get_hub_yaml()["canvas-user"]["username"]
-                    self.get_hub_yaml()["canvas-user"] = {}
-                    self.save_hub_yaml()
+                    with self.edit_hub_yaml() as hub_yaml:
+                        username = hub_yaml["canvas-user"]["username"]
+                        hub_yaml["canvas-user"] = {}
                     self.updateUsersOnUI()
                     self.updateUI({
                         "command": "AccountUnlinked",
@@ -488,14 +680,84 @@ class Canvas:
             self.updateUI({"command": "AccountUnlinkError"})
             raise Exception(constants.HUB_NOT_REGISTERED)
 
-    def downloadPrintFiles(self, s3url, name):
+    def downloadPrintFiles(self, job):
+        # runs on a download manager worker: the archive streams in on a separate thread while this one
+        # extracts it, and the job only finishes once both are done
+        name = job.name
+        self.logger.debug(getLog("Starting download"))
+        response = self.breakers.call(job.url, requests.get, job.url, stream=True,
+                                      timeout=constants.DOWNLOAD_TIMEOUT)
+        response.raise_for_status()
+        etag = response.headers.get("ETag")
+        key = self.download_cache.key_for(etag)
+        cached_path = self.download_cache.lookup(key)
+        if cached_path is not None:
+            response.close()
+            self.logger.info(getLog("Using cached download of " + name))
+            self.download_manager.set_state(job, DownloadManager.EXTRACTING)
+            self.updateUI({
+                "command": "CanvasDownload",
+                "data": {
+                    "filename": name
+                },
+                "status": "received"
+            })
+            self._extractZipfile(Spool.SpoolFile(path=cached_path, complete=True), name,
+                                 lambda extracted: extracted or self.download_cache.remove(key))
+            return
+        if key is None:
+            spool = Spool.SpoolFile(self._getSpoolFolder())
+        else:
+            offset = self.download_cache.partial_size(key)
+            if offset and response.headers.get("Accept-Ranges") == "bytes":
+                self.logger.info(getLog("Resuming earlier download from byte %s" % offset))
+                response.close()
+                response = self._requestRange(job.url, offset, etag)
+                response.raise_for_status()
+            if response.status_code != 206:
+                offset = 0
+            spool = Spool.SpoolFile(path=self.download_cache.partial_path(key), offset=offset,
+                                    offset_path=self.download_cache.offset_path(key))
+        downloadThread = threading.Thread(target=self._downloadInBackground, args=(response, job, spool, etag))
+        downloadThread.daemon = True
+        downloadThread.start()
+        self._extractZipfile(spool, name, lambda extracted: self._releaseSpool(spool, key, extracted))
+        error = spool.wait_closed()
+        if error is not None:
+            raise error
+
+    def _downloadInBackground(self, response, job, spool, etag):
+        # failures end up in the spool, downloadPrintFiles raises them for the job
         try:
-            self.logger.debug(getLog("Starting download"))
-            response = requests.get(s3url, stream=True)
-            downloaded_file = self._streamFileProgress(response, name)
-            self._extractZipfile(downloaded_file, name)
-        except requests.exceptions.RequestException as e:
-            self.logger.error(getLog(e))
+            self._downloadToSpool(response, job, spool, etag)
+        except Exception as e:
+            spool.fail(e)
+            self.logger.error(getLog(str(e)))
+
+    def _onCircuitChange(self, host, state):
+        self.updateCloudStatusOnUI()
+
+    def updateCloudStatusOnUI(self):
+        unavailable = [host for host, state in self.breakers.states().items() if state == CircuitBreaker.OPEN]
+        self.updateUI({
+            "command": "CloudStatus",
+            "data": {
+                "available": not unavailable,
+                "unavailableHosts": unavailable
+            }
+        })
+
+    def _onDownloadJobChange(self, job, state):
+        # downloading and extracting are reported by the download itself
+        if state in (DownloadManager.QUEUED, DownloadManager.FAILED, DownloadManager.CANCELLED):
+            self.updateUI({
+                "command": "CanvasDownload",
+                "data": {
+                    "filename": job.name,
+                    "jobId": job.id
+                },
+                "status": state
+            })
 
     def changeImportantUpdateSettings(self, condition):
         self.logger.debug(getLog("Changing Important Update Settings"))
@@ -512,15 +774,10 @@ class Canvas:
 
     def getActivationCode(self):
         self.logger.debug(getLog('getting activation code'))
-        if not self.accessTokenValid():
-            self.get_hub_yaml()["canvas-hub"]["accessToken"] = self.getNewAccessToken()
-            self.save_hub_yaml()
-        url = "https://" + BASE_URL_API + "devices/" + self.get_hub_yaml()["canvas-hub"]["device"]["id"] + \
-              "/activation-code"
-        access_token = self.get_hub_yaml()["canvas-hub"]["accessToken"]
-        headers = {"Authorization": "Bearer %s" % access_token}
+        url = "devices/" + self.get_hub_yaml()["canvas-hub"]["device"]["id"] + "/activation-code"
         try:
-            response = requests.get(url, headers=headers)
+            headers = {"Authorization": "Bearer %s" % self.tokens.get()}
+            response = self.api.get(url, "activation-code", headers=headers)
             response_body = response.json()
             if response.status_code >= 400:
                 self.logger.error(getLog('Error getting response: ', response_body))
@@ -529,25 +786,24 @@ class Canvas:
 
         except requests.exceptions.RequestException as e:
             raise Exception(e)
-        except jwt.ExpiredSignature:
+        except jwt.ExpiredSignatureError:
             self.logger.debug(getLog("invalid token"))
 
-    def getNewAccessToken(self):
+    def _fetchAccessToken(self):
         self.logger.debug(getLog('getting new access token'))
-        url = "https://" + BASE_URL_API + "devices/" + self.get_hub_yaml()["canvas-hub"]["device"]["id"] + "/token"
+        url = "devices/" + self.get_hub_yaml()["canvas-hub"]["device"]["id"] + "/token"
         payload = {"token": self.get_hub_yaml()["canvas-hub"]["refreshToken"]}
-        try:
-            response = requests.post(url, json=payload)
-            response_body = response.json()
-            if not response.status_code >= 400:
-                return response_body['accessToken']
-        except requests.exceptions.RequestException as e:
-            raise Exception(e)
-
-    def accessTokenValid(self):
-        self.logger.info(getLog('access token valid'))
-        public_string = "b" + self._readFile(self.public_path)
-        return False
+        response = self.api.post(url, "token", json=payload)
+        if response.status_code == 429 or response.status_code >= 500:
+            raise RetryScheduler.Retry("token refresh answered %s" % response.status_code,
+                                       RetryScheduler.retry_after_seconds(response))
+        response.raise_for_status()
+        return response.json()['accessToken']
+
+    def _saveAccessToken(self, access_token):
+        # the YAML copy lets a restarted plugin pick the token up again without a refresh
+        with self.edit_hub_yaml() as hub_yaml:
+            hub_yaml["canvas-hub"]["accessToken"] = access_token
 
     def resetCanvasData(self):
         self.logger.info(getLog('resetting canvas data'))
@@ -555,28 +811,23 @@ class Canvas:
             if "canvas-hub" in self.get_hub_yaml() and "device" in self.get_hub_yaml()["canvas-hub"]:
                 device = self.get_hub_yaml()["canvas-hub"]["device"]
                 if "id" in device:
-                    if not self.accessTokenValid():
-                        self.get_hub_yaml()["canvas-hub"]["accessToken"] = self.getNewAccessToken()
-                        self.save_hub_yaml()
-                    url = "https://" + BASE_URL_API + "devices/" + device["id"]
-                    headers = {
-                        "content-type": "application/json",
-                        "Authorization": "Bearer " + self.get_hub_yaml()["canvas-hub"]["accessToken"]
-                    }
+                    url = "devices/" + device["id"]
                     try:
+                        headers = {
+                            "content-type": "application/json",
+                            "Authorization": "Bearer " + self.tokens.get()
+                        }
                         self.logger.debug(getLog("deleting device"))
                         payload = {"id": device['id']}
-                        response = requests.delete(url, headers=headers, json=payload)
+                        response = self.api.delete(url, "device", headers=headers, json=payload)
                         if response.status_code >= 200 and response.status_code < 300:
                             self.logger.debug(getLog("successfully deleted device"))
                         else:
                             self.logger.error(getLog("error deleting device"))
                     except requests.exceptions.RequestException as e:
                         self.logger.error(getLog('request exception: ' + str(e)))
-            path = os.path.join(os.path.expanduser('~'), '.mosaicdata', 'canvas-hub-data.yml')
-            if os.path.isfile(path):
-                self.logger.info(getLog('found canvas hub data file'))
-                os.remove(path)
+            # through the store, so a pending write doesn't bring the file back
+            if self.plugin.delete_hub_yaml():
                 self.logger.info(getLog('canvas hub data file deleted'))
                 self.canvas.updateUI({"command": "resetCanvasData", "data": 'true'})
             else:
@@ -0,0 +1,148 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import RetryScheduler
+from . import CircuitBreaker
+
+
+def getLog(msg, module='canvas-api'):
+    return '{ "msg": "' + str(msg) + '", "module": "' + module +'" }'
+
+
+class EndpointPolicy:
+    # timeout is (connect, read) in seconds. Failed calls are retried up to retries times on connection
+    # errors, timeouts and retry_statuses, with jittered exponential backoff starting at backoff seconds
+    # and never longer than backoff_cap (also when the server asks for more with Retry-After). Only
+    # idempotent methods are retried unless retry_post is set.
+    def __init__(self, timeout=(5, 15), retries=2, backoff=0.5, backoff_cap=10, retry_statuses=(429, 502, 503, 504),
+                 retry_post=False):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = RetryScheduler.Backoff(backoff, backoff_cap)
+        self.retry_statuses = retry_statuses
+        self.retry_post = retry_post
+
+
+DEFAULT_POLICY = EndpointPolicy()
+
+POLICIES = {
+    # registration creates the device and its certificates, the server can take a while
+    "register": EndpointPolicy(timeout=(5, 30), retries=0),
+    "token": EndpointPolicy(timeout=(5, 10), retries=2, retry_post=True),
+    "device": EndpointPolicy(),
+    "link": EndpointPolicy(),
+    "activation-code": EndpointPolicy(timeout=(5, 10)),
+    "hostname": EndpointPolicy(retries=1),
+    "root-ca": EndpointPolicy(timeout=(5, 30)),
+}
+
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+
+
+class LatencyStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+        self.last_status = None
+
+    def record(self, elapsed, status):
+        self.calls += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        self.last = elapsed
+        self.last_status = status
+        if status is None or status >= 500:
+            self.errors += 1
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "averageMs": int(self.total / self.calls * 1000) if self.calls else 0,
+            "maxMs": int(self.max * 1000),
+            "lastMs": int(self.last * 1000),
+            "lastStatus": self.last_status
+        }
+
+
+class CanvasApi:
+    # One keep-alive session for every call to the Canvas cloud. endpoint names the kind of call, it picks the
+    # EndpointPolicy and the bucket its latency is recorded in. Responses are returned whatever their status,
+    # the last exception is raised once the retries are used up. Calls to a host whose circuit is open fail
+    # right away with CircuitOpenError.
+    def __init__(self, logger, base_url, pool_size=4, policies=None, breakers=None):
+        self.logger = logger
+        self.base_url = base_url
+        self.policies = POLICIES if policies is None else policies
+        self.breakers = CircuitBreaker.CircuitBreakers(logger) if breakers is None else breakers
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def get(self, path, endpoint, **kwargs):
+        return self.request("GET", path, endpoint, **kwargs)
+
+    def put(self, path, endpoint, **kwargs):
+        return self.request("PUT", path, endpoint, **kwargs)
+
+    def post(self, path, endpoint, **kwargs):
+        return self.request("POST", path, endpoint, **kwargs)
+
+    def delete(self, path, endpoint, **kwargs):
+        return self.request("DELETE", path, endpoint, **kwargs)
+
+    def request(self, method, path, endpoint, **kwargs):
+        policy = self.policies.get(endpoint, DEFAULT_POLICY)
+        kwargs.setdefault("timeout", policy.timeout)
+        url = path if "://" in path else self.base_url + path
+        retries = policy.retries if method in IDEMPOTENT_METHODS or policy.retry_post else 0
+        attempt = 0
+        while True:
+            retry_after = None
+            started = time.time()
+            try:
+                response = self.breakers.call(url, self.session.request, method, url, **kwargs)
+            except CircuitBreaker.CircuitOpenError:
+                raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self._record(endpoint, time.time() - started, None, attempt)
+                if attempt >= retries:
+                    raise
+                self.logger.info(getLog("%s %s failed, retrying: %s" % (method, endpoint, str(e))))
+            else:
+                self._record(endpoint, time.time() - started, response.status_code, attempt)
+                if response.status_code not in policy.retry_statuses or attempt >= retries:
+                    return response
+                self.logger.info(getLog("%s %s answered %s, retrying" % (method, endpoint, response.status_code)))
+                retry_after = RetryScheduler.retry_after_seconds(response)
+                response.close()
+            time.sleep(policy.backoff.delay(attempt, retry_after))
+            attempt += 1
+
+    def stats(self):
+        with self._stats_lock:
+            return dict((endpoint, stats.to_dict()) for endpoint, stats in self._stats.items())
+
+    def close(self):
+        self.session.close()
+
+    def _record(self, endpoint, elapsed, status, attempt):
+        with self._stats_lock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                stats = self._stats[endpoint] = LatencyStats()
+            stats.record(elapsed, status)
+            if attempt:
+                stats.retries += 1
+        self.logger.debug(getLog("%s answered %s in %d ms" % (endpoint, status, elapsed * 1000)))
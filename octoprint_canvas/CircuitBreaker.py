@@ -0,0 +1,133 @@
+import threading
+import time
+
+import requests
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+
+def getLog(msg, module='circuit-breaker'):
+    return '{ "msg": "' + str(msg) + '", "module": "' + module +'" }'
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    # a ConnectionError, so existing request error handling (and retries) treat it as the host being down
+    pass
+
+
+class CircuitBreaker:
+    # Opens after failure_threshold consecutive failures and then fails calls immediately. After
+    # reset_timeout seconds a single trial call is let through (half-open): success closes the circuit,
+    # failure opens it again for another reset_timeout.
+    def __init__(self, host, failure_threshold=5, reset_timeout=30, on_change=None):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self._on_change = on_change
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = 0
+        self._trial_running = False
+
+    def before_call(self):
+        changed = False
+        with self._lock:
+            if self.state == OPEN:
+                if time.time() - self._opened_at < self.reset_timeout:
+                    raise CircuitOpenError(self.host + " is unavailable")
+                self.state = HALF_OPEN
+                changed = True
+            if self.state == HALF_OPEN:
+                if self._trial_running:
+                    raise CircuitOpenError(self.host + " is unavailable")
+                self._trial_running = True
+        if changed:
+            self._changed(HALF_OPEN)
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._trial_running = False
+            changed = self.state != CLOSED
+            self.state = CLOSED
+        if changed:
+            self._changed(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            changed = self.state != OPEN and (self.state == HALF_OPEN or self._failures >= self.failure_threshold)
+            if self.state == OPEN or changed:
+                self.state = OPEN
+                self._opened_at = time.time()
+        if changed:
+            self._changed(OPEN)
+
+    def release(self):
+        # the call failed for a reason that says nothing about the host, let the next one try
+        with self._lock:
+            self._trial_running = False
+
+    def _changed(self, state):
+        if self._on_change is not None:
+            self._on_change(self.host, state)
+
+
+class CircuitBreakers:
+    # One breaker per remote host, shared by everything that talks to that host
+    def __init__(self, logger, failure_threshold=5, reset_timeout=30, on_change=None):
+        self.logger = logger
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._on_change = on_change
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def for_url(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            breaker = self._breakers.get(host)
+            if breaker is None:
+                breaker = self._breakers[host] = CircuitBreaker(host, self.failure_threshold, self.reset_timeout,
+                                                                self._stateChanged)
+            return breaker
+
+    def call(self, url, fn, *args, **kwargs):
+        # fn makes the request and returns the response; connection errors, timeouts and 5xx count as failures
+        breaker = self.for_url(url)
+        breaker.before_call()
+        try:
+            response = fn(*args, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            breaker.record_failure()
+            raise
+        except Exception:
+            breaker.release()
+            raise
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return response
+
+    def states(self):
+        with self._lock:
+            return dict((host, breaker.state) for host, breaker in self._breakers.items())
+
+    def _stateChanged(self, host, state):
+        self.logger.info(getLog("circuit for " + host + " is " + state))
+        if self._on_change is not None:
+            try:
+                self._on_change(host, state)
+            except Exception as e:
+                self.logger.error(getLog("error reporting circuit state: " + str(e)))
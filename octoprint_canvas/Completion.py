@@ -0,0 +1,86 @@
+import itertools
+import re
+import threading
+
+reGcode = re.compile(r"^\s*([GMT]\d+)", re.IGNORECASE)
+
+
+def gcode_of(command):
+    match = reGcode.match(command or '')
+    if match:
+        return match.group(1).upper()
+    return None
+
+
+_sequence = itertools.count()
+
+
+class Completion:
+    # Set once every expected gcode has been sent to the printer and one of the expected events has fired.
+    # Only gcodes sent with tags=completion.tags count, so the lines of a running print can't confirm a request
+    def __init__(self, gcodes=None, events=None, signals=None):
+        self.tag = "canvas:request:%d" % next(_sequence)
+        self.tags = set([self.tag])
+        self._remaining = list(gcodes or [])
+        self._events = set(events or [])
+        self._done = threading.Event()
+        self._signals = signals
+        self._check()
+
+    # with signals.expect(...) as completion: the waiter is released however the block ends
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._signals is not None:
+            self._signals.release(self)
+        return False
+
+    def wait(self, timeout):
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def _on_gcode(self, gcode):
+        if gcode in self._remaining:
+            self._remaining.remove(gcode)
+            self._check()
+
+    def _on_event(self, event):
+        if event in self._events:
+            self._events = set()
+            self._check()
+
+    def _check(self):
+        if not self._remaining and not self._events:
+            self._done.set()
+
+
+class CompletionSignals:
+    # Waiters register what they expect *before* issuing a command, so a fast printer can't beat them to it
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = []
+
+    def expect(self, gcodes=None, events=None):
+        completion = Completion(gcodes=gcodes, events=events, signals=self)
+        with self._lock:
+            self._waiters.append(completion)
+        return completion
+
+    def release(self, completion):
+        with self._lock:
+            if completion in self._waiters:
+                self._waiters.remove(completion)
+
+    def notify_gcode(self, gcode, tags=None):
+        if not tags:
+            return
+        with self._lock:
+            for completion in self._waiters:
+                if completion.tag in tags:
+                    completion._on_gcode(gcode)
+
+    def notify_event(self, event):
+        with self._lock:
+            for completion in self._waiters:
+                completion._on_event(event)
@@ -0,0 +1,137 @@
+import hashlib
+import os
+import re
+import threading
+import time
+
+from . import Spool
+
+reMD5 = re.compile("^[0-9a-f]{32}$")
+
+# partial downloads nobody came back for are dropped after a day
+PARTIAL_MAX_AGE = 24 * 60 * 60
+
+
+class ChecksumMismatch(IOError):
+    pass
+
+
+class DownloadCache:
+    # Downloaded archives keyed by their ETag, evicted least recently used first once the folder grows past
+    # budget_bytes. Interrupted downloads are kept as <key>.part so they can be resumed with a Range request,
+    # from the contiguous offset recorded in <key>.offset.
+    def __init__(self, folder, budget_bytes):
+        self.folder = folder
+        self.budget_bytes = budget_bytes
+        self._lock = threading.Lock()
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def key_for(self, etag):
+        if not etag:
+            return None
+        return hashlib.sha1(etag.strip('"').encode("utf-8")).hexdigest()
+
+    def lookup(self, key):
+        if key is None:
+            return None
+        path = self._entry_path(key)
+        with self._lock:
+            if not os.path.isfile(path):
+                return None
+            # mtime doubles as the last use time for eviction
+            os.utime(path, None)
+        return path
+
+    def partial_path(self, key):
+        return os.path.join(self.folder, key + ".part")
+
+    def offset_path(self, key):
+        return os.path.join(self.folder, key + ".offset")
+
+    def partial_size(self, key):
+        # how much of the partial download can be kept; without a record it may have holes and is dropped
+        path = self.partial_path(key)
+        if not os.path.isfile(path):
+            return 0
+        offset = Spool.read_offset(self.offset_path(key))
+        if offset is None:
+            self.drop(key)
+            return 0
+        return min(offset, os.path.getsize(path))
+
+    def commit(self, key):
+        with self._lock:
+            path = self._entry_path(key)
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(self.partial_path(key), path)
+            self._remove_offset(key)
+        self.evict()
+        return path
+
+    def drop(self, key):
+        with self._lock:
+            path = self.partial_path(key)
+            if os.path.exists(path):
+                os.remove(path)
+            self._remove_offset(key)
+
+    def remove(self, key):
+        # a cached archive that turned out to be broken
+        with self._lock:
+            path = self._entry_path(key)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def evict(self):
+        with self._lock:
+            now = time.time()
+            entries = []
+            for name in os.listdir(self.folder):
+                path = os.path.join(self.folder, name)
+                stat = os.stat(path)
+                if name.endswith((".part", ".offset")) and now - stat.st_mtime > PARTIAL_MAX_AGE:
+                    os.remove(path)
+                elif name.endswith(".zip"):
+                    entries.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.budget_bytes:
+                    break
+                os.remove(path)
+                total -= size
+
+    def _remove_offset(self, key):
+        path = self.offset_path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _entry_path(self, key):
+        return os.path.join(self.folder, key + ".zip")
+
+
+class StreamHash:
+    # MD5 of the download computed as it streams in. S3 uses the MD5 as ETag for single part uploads,
+    # multipart ETags ("<md5>-<parts>") can't be checked this way and are accepted as is.
+    def __init__(self, etag, prefix_path=None, prefix_size=0):
+        etag = (etag or "").strip('"').lower()
+        self._expected = etag if reMD5.match(etag) else None
+        self._md5 = hashlib.md5()
+        if self._expected is not None and prefix_path is not None and prefix_size:
+            with open(prefix_path, "rb") as prefix:
+                remaining = prefix_size
+                while remaining > 0:
+                    data = prefix.read(min(64 * 1024, remaining))
+                    if not data:
+                        break
+                    self._md5.update(data)
+                    remaining -= len(data)
+
+    def update(self, data):
+        if self._expected is not None:
+            self._md5.update(data)
+
+    def verify(self):
+        if self._expected is not None and self._md5.hexdigest() != self._expected:
+            raise ChecksumMismatch("download does not match its ETag")
@@ -0,0 +1,172 @@
+import heapq
+import itertools
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+
+
+def getLog(msg, module='download-manager'):
+    return '{ "msg": "' + str(msg) + '", "module": "' + module +'" }'
+
+
+QUEUED = "queued"
+DOWNLOADING = "downloading"
+EXTRACTING = "extracting"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+
+class DownloadCancelled(IOError):
+    pass
+
+
+class DownloadJob:
+    def __init__(self, url, name, priority):
+        self.id = uuid.uuid4().hex
+        self.url = url
+        self.name = name
+        self.priority = priority
+        self.state = QUEUED
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self._cancelled = threading.Event()
+
+    def is_cancelled(self):
+        return self._cancelled.is_set()
+
+    def raise_if_cancelled(self):
+        # called by the download loop between chunks
+        if self._cancelled.is_set():
+            raise DownloadCancelled("download of " + self.name + " was cancelled")
+
+    def to_dict(self):
+        return {
+            "jobId": self.id,
+            "name": self.name,
+            "state": self.state,
+            "priority": self.priority,
+            "error": self.error
+        }
+
+
+class DownloadManager:
+    # Queue of print file downloads worked off by up to concurrency threads, highest priority first and in
+    # submission order within a priority. run_job(job) does the actual download and extraction and raises on
+    # failure; on_change(job, state) is called on every state change. The last history finished jobs are kept
+    # so their state can still be looked up.
+    def __init__(self, logger, run_job, concurrency=1, on_change=None, history=20):
+        self.logger = logger
+        self.history = history
+        self._run_job = run_job
+        self._on_change = on_change
+        self._lock = threading.Condition(threading.Lock())
+        self._queue = []
+        self._sequence = itertools.count()
+        self._jobs = OrderedDict()
+        self._running = True
+        self._workers = []
+        for index in range(max(1, concurrency)):
+            worker = threading.Thread(target=self._work, name="canvas-download-%s" % index)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, url, name, priority=0):
+        job = DownloadJob(url, name, priority)
+        with self._lock:
+            if not self._running:
+                return None
+            self._jobs[job.id] = job
+            heapq.heappush(self._queue, (-priority, next(self._sequence), job))
+            self._lock.notify()
+        self.logger.info(getLog("queued download of " + name + " as " + job.id))
+        self._changed(job, QUEUED)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id):
+        # queued jobs are dropped right away, a running job stops at its next chunk
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.state in FINISHED_STATES:
+                return None
+            job._cancelled.set()
+            queued = job.state == QUEUED
+            if queued:
+                self._finish(job, CANCELLED)
+        if queued:
+            self._changed(job, CANCELLED)
+        self.logger.info(getLog("cancelled download " + job_id))
+        return job
+
+    def set_state(self, job, state):
+        with self._lock:
+            if job.state in FINISHED_STATES:
+                return
+            job.state = state
+        self._changed(job, state)
+
+    def shutdown(self):
+        with self._lock:
+            self._running = False
+            for job in self._jobs.values():
+                job._cancelled.set()
+            self._queue = []
+            self._lock.notify_all()
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while self._running and not self._queue:
+                    self._lock.wait()
+                if not self._running:
+                    return
+                job = heapq.heappop(self._queue)[2]
+                if job.state != QUEUED:
+                    continue
+                job.state = DOWNLOADING
+            self._changed(job, DOWNLOADING)
+            state, error = DONE, None
+            try:
+                self._run_job(job)
+            except DownloadCancelled as e:
+                state, error = CANCELLED, str(e)
+            except Exception as e:
+                state, error = FAILED, str(e)
+                self.logger.error(getLog("download of " + job.name + " failed: " + str(e)))
+                self.logger.debug(traceback.format_exc())
+            if state == DONE and job.is_cancelled():
+                state = CANCELLED
+            with self._lock:
+                job.error = error
+                self._finish(job, state)
+            self._changed(job, state)
+
+    def _finish(self, job, state):
+        # with the lock held
+        job.state = state
+        job.finished = time.time()
+        finished = [entry for entry in self._jobs.values() if entry.state in FINISHED_STATES]
+        for entry in finished[:max(0, len(finished) - self.history)]:
+            del self._jobs[entry.id]
+
+    def _changed(self, job, state):
+        if self._on_change is None:
+            return
+        try:
+            self._on_change(job, state)
+        except Exception as e:
+            self.logger.error(getLog("error reporting download state: " + str(e)))
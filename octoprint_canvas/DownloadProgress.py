@@ -0,0 +1,71 @@
+import time
+
+
+class DownloadProgress:
+    # Coalesces the progress of one download to at most one update every interval seconds, with throughput
+    # (smoothed over the last few updates) and an ETA. Log lines only go out every log_interval seconds.
+    def __init__(self, total_bytes, downloaded_bytes=0, interval=0.25, log_interval=10, smoothing=0.3):
+        self.total_bytes = total_bytes
+        self.start_bytes = downloaded_bytes
+        self.interval = interval
+        self.log_interval = log_interval
+        self.smoothing = smoothing
+        self.started = time.time()
+        self.bytes_per_second = None
+        self._last_time = self.started
+        self._last_bytes = downloaded_bytes
+        self._last_log = self.started
+
+    def start(self):
+        # the UI sets up its progress bar on the first report, which has to say 0
+        report = self._report(self.start_bytes)
+        report["progress"] = 0
+        return report
+
+    def update(self, downloaded_bytes, force=False, finished=False):
+        # returns the fields to report, or None while the next update isn't due yet
+        now = time.time()
+        elapsed = now - self._last_time
+        if not force and elapsed < self.interval:
+            return None
+        if elapsed > 0:
+            rate = (downloaded_bytes - self._last_bytes) / elapsed
+            if self.bytes_per_second is None:
+                self.bytes_per_second = rate
+            else:
+                self.bytes_per_second += self.smoothing * (rate - self.bytes_per_second)
+        self._last_time = now
+        self._last_bytes = downloaded_bytes
+        report = self._report(downloaded_bytes)
+        if finished:
+            # also without a content-length
+            report["progress"] = 100
+        return report
+
+    def _report(self, downloaded_bytes):
+        progress = 0
+        if self.total_bytes:
+            progress = min(100, int((float(downloaded_bytes) / self.total_bytes) * 100))
+        report = {
+            "progress": progress,
+            "bytes": downloaded_bytes,
+            "totalBytes": self.total_bytes,
+            "bytesPerSecond": int(self.bytes_per_second or 0),
+            "eta": None
+        }
+        if self.total_bytes and self.bytes_per_second:
+            report["eta"] = int(max(0, self.total_bytes - downloaded_bytes) / self.bytes_per_second)
+        return report
+
+    def log_due(self):
+        now = time.time()
+        if now - self._last_log < self.log_interval:
+            return False
+        self._last_log = now
+        return True
+
+    def average_bytes_per_second(self, downloaded_bytes):
+        elapsed = time.time() - self.started
+        if elapsed <= 0:
+            return 0
+        return int((downloaded_bytes - self.start_bytes) / elapsed)
@@ -0,0 +1,50 @@
+# origins are the Canvas apps talking to this hub, a handful; the cache only starts over if something odd floods it
+MAX_RESPONSE_PREFIXES = 64
+
+
+class HubSettings:
+    # The MQTT identifiers and topics from one hub YAML snapshot, looked up and joined once instead of on every
+    # message. version is the snapshot's version, the plugin builds a new HubSettings when the YAML changes.
+    # Values the hub doesn't have yet (before registration) are None.
+    def __init__(self, hub_yaml):
+        self.version = hub_yaml.version
+        canvas_hub = hub_yaml.get("canvas-hub", {})
+        mqtt = hub_yaml.get("mqtt", {})
+        broker = mqtt.get("broker", {})
+        publish = mqtt.get("publish", {})
+        requests = mqtt.get("topics", {}).get("requests", {})
+        broadcasts = mqtt.get("topics", {}).get("broadcasts", {})
+
+        self.device_id = canvas_hub.get("device", {}).get("id")
+        self.client_id = canvas_hub.get("clientId")
+        self.broker_endpoint = broker.get("endpoint")
+        self.broker_port = broker.get("port")
+        self.broker_protocol = broker.get("protocol")
+        self.retain = broker.get("retain")
+        self.clean_session = broker.get("cleanSession")
+        self.topic_prefix = publish.get("topicPrefix")
+        self.origin_name = publish.get("originName")
+
+        self.all_devices_topic = requests.get("allDevices")
+        self.all_canvas_hubs_topic = requests.get("allCanvasHubs")
+        self.device_topic = requests.get("deviceTopicPrefix")
+        self.device_request_topic = requests.get("deviceRequestTopicPrefix")
+        # deviceRequestTopicPrefix is a subscription filter ending in '/#', request topics start with what's before it
+        self.request_prefix = self.device_request_topic.split('/#')[0] if self.device_request_topic else None
+        self.subscriptions = sorted(set(topic for topic in requests.values() if topic))
+        self.health_topic = broadcasts.get("healthTopic")
+        self.state_topic = broadcasts.get("stateTopic")
+
+        self._response_prefixes = {}
+
+    def response_topic(self, origin_id, topic):
+        # responses go to <prefix>/devices/<device id>/<origin>/response<request topic>, one prefix per origin
+        prefix = self._response_prefixes.get(origin_id)
+        if prefix is None:
+            if self.device_id is None:
+                raise KeyError("device")
+            prefix = self.topic_prefix + '/devices/' + self.device_id + '/' + origin_id + '/response'
+            if len(self._response_prefixes) >= MAX_RESPONSE_PREFIXES:
+                self._response_prefixes = {}
+            self._response_prefixes[origin_id] = prefix
+        return prefix + topic
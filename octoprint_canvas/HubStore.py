@@ -0,0 +1,185 @@
+import contextlib
+import os
+import threading
+
+try:
+    from ruamel.yaml import YAML
+except ImportError:
+    from ruamel.yaml.main import YAML
+yaml = YAML(typ="safe")
+yaml.default_flow_style = False
+
+from . import constants
+
+
+def getLog(msg, module='hub-store'):
+    return '{ "msg": "' + str(msg) + '", "module": "' + module +'" }'
+
+
+REQUIRED_KEYS = ("canvas-user", "canvas-hub", "versions")
+
+
+class FrozenDict(dict):
+    # Read-only dict for published snapshots. Still a dict, so json.dumps and isinstance checks keep working.
+    # version is the HubStore version the snapshot was published as (top level only).
+    version = 0
+
+    def _readOnly(self, *args, **kwargs):
+        raise TypeError("hub YAML snapshots are read-only, change them with edit_hub_yaml()")
+
+    __setitem__ = __delitem__ = __ior__ = _readOnly
+    clear = pop = popitem = setdefault = update = _readOnly
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    if isinstance(value, dict):
+        return dict((key, thaw(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [thaw(item) for item in value]
+    return value
+
+
+def write_atomically(path, data):
+    # a power cut leaves either the old or the new file, never a truncated one
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as temp_file:
+        yaml.dump(data, temp_file)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    if hasattr(os, "replace"):
+        os.replace(temp_path, path)
+    else:
+        # Python 2: rename over an existing file is atomic on POSIX but fails on Windows
+        if os.name == "nt" and os.path.exists(path):
+            os.remove(path)
+        os.rename(temp_path, path)
+    if hasattr(os, "O_DIRECTORY"):
+        folder = os.open(os.path.dirname(path), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(folder)
+        finally:
+            os.close(folder)
+
+
+class HubStore:
+    # The hub YAML (~/.mosaicdata/canvas-hub-data.yml). Readers get the current snapshot, a FrozenDict that is
+    # swapped out whole and never changes, so they need no lock and can't see half an update. Writers go
+    # through edit(), one at a time, each publishing a new snapshot and bumping version. save() only marks
+    # the data dirty, all saves within flush_delay seconds of the first one are written together by flush(),
+    # which writes atomically.
+    def __init__(self, path, logger, scheduler, flush_delay=1.0):
+        self.path = path
+        self.logger = logger
+        self.scheduler = scheduler
+        self.flush_delay = flush_delay
+        self.data = None
+        self.snapshot = None
+        self.version = 0
+        self.writes = 0
+        self._lock = threading.RLock()
+        self._dirty = False
+        self._timer = None
+
+    def get(self):
+        snapshot = self.snapshot
+        if snapshot is None:
+            return self.load()
+        return snapshot
+
+    def load(self):
+        with self._lock:
+            if self.snapshot is not None:
+                return self.snapshot
+            folder = os.path.dirname(self.path)
+            if not os.path.exists(folder):
+                os.mkdir(folder)
+            data = None
+            if os.path.isfile(self.path):
+                with open(self.path, "r") as yaml_file:
+                    data = yaml.load(yaml_file)
+            if data and "canvas-user" not in data and all(key in data for key in ("canvas-hub", "versions")):
+                # for compatibility with older hub zero, if the yaml file doesn't have a "canvas-users" key
+                data["canvas-user"] = {}
+                self._dirty = True
+            if not data or not all(key in data for key in REQUIRED_KEYS):
+                if data:
+                    self.logger.info(getLog("Resetting YAML file to default"))
+                data = constants.DEFAULT_YAML
+                self._dirty = True
+            self._publish(data)
+            if self._dirty:
+                self.flush()
+            return self.snapshot
+
+    @contextlib.contextmanager
+    def edit(self):
+        # yields a private copy of the data to change; it becomes the new snapshot when the block ends, an
+        # exception in the block throws the changes away
+        with self._lock:
+            self.load()
+            draft = thaw(self.data)
+            yield draft
+            self._publish(draft)
+        self.save()
+
+    def replace(self, data):
+        with self._lock:
+            self._publish(data)
+        self.save()
+
+    def _publish(self, data):
+        # keeps plain copies: callers pass in constants like DEFAULT_YAML or put snapshot parts into a draft,
+        # and self.data must never change after this so flush() can write it as it is
+        self.data = thaw(data)
+        self.version += 1
+        snapshot = freeze(self.data)
+        snapshot.version = self.version
+        self.snapshot = snapshot
+
+    def save(self):
+        with self._lock:
+            self._dirty = True
+            if self._timer is not None:
+                return
+            self._timer = self.scheduler.call_later("hub YAML flush", self.flush_delay, self.flush)
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty or self.data is None:
+                return
+            try:
+                write_atomically(self.path, self.data)
+                self._dirty = False
+                self.writes += 1
+            except (IOError, OSError) as e:
+                # stays dirty, the next save or flush tries again
+                self.logger.error(getLog("Failed to write hub YAML: " + str(e)))
+
+    def delete(self):
+        # removes the file and drops pending writes, the data stays in memory until the plugin restarts
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._dirty = False
+            if not os.path.isfile(self.path):
+                return False
+            os.remove(self.path)
+            return True
@@ -1,6 +1,6 @@
 import sys
 import traceback
-from collections import deque
+import threading
 import time
 import json
 import six
@@ -8,8 +8,10 @@ import os
 import ssl
 from . import constants
 import paho.mqtt.client as mqtt
-from paho.mqtt.client import topic_matches_sub
 from . import MQTTRouter
+from . import Serializer
+from . import BroadcastPolicy
+from . import TopicTrie
 
 try:
     from ruamel.yaml import YAML
@@ -21,17 +23,23 @@ def getLog(msg, module='mqtt'):
     return '{ "msg": "' + str(msg) + '", "module": "' + module +'" }'
 
 class MQTT:
-    def __init__(self, plugin, downloadPrintFiles):
+    def __init__(self, plugin, download_manager):
         self._mqtt = None
         self.logger = plugin.logger
         self._mqtt_connected = False
         self.logger.debug(getLog("self._mqtt_connected = " + str(self._mqtt_connected)))
         self.get_hub_yaml = plugin.get_hub_yaml
+        self.get_hub_settings = plugin.get_hub_settings
         self.replace_hub_yaml = plugin.replace_hub_yaml
-        self.save_hub_yaml = plugin.save_hub_yaml
-        self._mqtt_subscriptions = []
-        self._mqtt_publish_queue = deque()
-        self._mqtt_subscribe_queue = deque()
+        self._mqtt_subscriptions = TopicTrie.TopicTrie()
+        self.outbox = plugin.outbox
+        self.scheduler = plugin.scheduler
+        self._replay_rate = BroadcastPolicy.clamp(plugin._settings.get_float(["outboxReplayRate"]), 10,
+                                                  BroadcastPolicy.MIN_RATE)
+        self._replay_bucket = BroadcastPolicy.TokenBucket(self._replay_rate,
+                                                          plugin._settings.get_int(["outboxReplayBurst"]))
+        self._replay_task = None
+        self._replay_lock = threading.Lock()
         self.lastTemp = {}
         self.broker_endpoint = ''
         self.broker_port = ''
@@ -40,19 +48,8 @@ class MQTT:
         self.health_topic = ''
         self.client_id = ''
         self.on_connection_status_change = None
-        try:
-            if "mqtt" in self.get_hub_yaml():
-                self.broker_endpoint = self.get_hub_yaml()["mqtt"]["broker"]["endpoint"]
-                self.broker_port = self.get_hub_yaml()["mqtt"]["broker"]["port"]
-                self.retain = self.get_hub_yaml()["mqtt"]["broker"]["retain"]
-                self.clean_session = self.get_hub_yaml()["mqtt"]["broker"]["cleanSession"]
-                self.health_topic = self.get_hub_yaml()["mqtt"]["topics"]["broadcasts"]["healthTopic"]
-
-            if "canvas-hub" in self.get_hub_yaml():
-                self.client_id = self.get_hub_yaml()["canvas-hub"]["clientId"]
-        except KeyError as keyError:
-            self.logger.error(str(keyError))
-        self.mqttRouter = MQTTRouter.Router(self, plugin, downloadPrintFiles)
+        self._readHubSettings()
+        self.mqttRouter = MQTTRouter.Router(self, plugin, download_manager)
 
     def mqtt_connect(self):
         if self.broker_endpoint is None:
@@ -61,17 +58,7 @@ class MQTT:
 
         if self._mqtt is None:
             try:
-                if "mqtt" in self.get_hub_yaml():
-                    self.logger.debug(getLog(" found mqtt in yaml"))
-                    self.broker_endpoint = self.get_hub_yaml()["mqtt"]["broker"]["endpoint"]
-                    self.broker_port = self.get_hub_yaml()["mqtt"]["broker"]["port"]
-                    self.retain = self.get_hub_yaml()["mqtt"]["broker"]["retain"]
-                    self.clean_session = self.get_hub_yaml()["mqtt"]["broker"]["cleanSession"]
-                    self.health_topic = self.get_hub_yaml()["mqtt"]["topics"]["broadcasts"]["healthTopic"]
-
-                if "canvas-hub" in self.get_hub_yaml() and "clientId" in self.get_hub_yaml()["canvas-hub"]:
-                    self.logger.debug(getLog("found client id"))
-                    self.client_id = self.get_hub_yaml()["canvas-hub"]["clientId"]
+                self._readHubSettings()
                 self._mqtt = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1,client_id=self.client_id, clean_session=self.clean_session)
                 self._mqtt.tls_set_context(context=self._ssl_alpn())
                 self._mqtt.will_set(self.health_topic, self._get_alive_message(False), qos=0, retain=self.retain)
@@ -116,19 +103,18 @@ class MQTT:
 
         return self.mqtt_publish(topic, payload, qos=qos, allow_queueing=allow_queueing)
 
-    def mqtt_publish(self, topic, payload, qos=0, allow_queueing=False):
+    def mqtt_publish(self, topic, payload, qos=0, allow_queueing=False, coalesce=False):
+        # allow_queueing: put the message in the outbox while disconnected instead of dropping it,
+        # coalesce: it replaces the message already queued for the topic
         if not isinstance(payload, six.string_types):
-            if (sys.version_info[:3]) > (3, 0):
-                payload = json.dumps(self._convert_py3_dict_to_json(payload))
-            else:
-                payload = json.dumps(payload)
+            payload = Serializer.dumps(payload)
 
-        if not self._mqtt_connected:
+        # behind what is still queued, so the broker gets them in order
+        if not self._mqtt_connected or (allow_queueing and self.queueing()):
             if allow_queueing:
-                self.logger.debug(getLog("Not connected, enqueuing message: {topic} - {payload}".format(
+                self.logger.debug(getLog("Enqueuing message: {topic} - {payload}".format(
                     **locals())))
-                self._mqtt_publish_queue.append((topic, payload, qos))
-                return True
+                return self.outbox.put(topic, payload, qos, coalesce)
             else:
                 return False
         retain = self.retain
@@ -136,30 +122,30 @@ class MQTT:
         # self.logger.debug("Sent message: {topic} - {payload}, retain={retain}".format(**locals()))
         return True
 
+    def queueing(self):
+        # whether a publish with allow_queueing goes to the outbox rather than straight to the broker
+        return not self._mqtt_connected or len(self.outbox) > 0
+
     def mqtt_subscribe(self, topic, callback, args=None, kwargs=None):
         if args is None:
             args = []
         if kwargs is None:
             kwargs = dict()
 
-        self._mqtt_subscriptions.append((topic, callback, args, kwargs))
+        self._mqtt_subscriptions.add(topic, (callback, args, kwargs))
 
-        if not self._mqtt_connected:
-            self._mqtt_subscribe_queue.append(topic)
-        else:
+        # while disconnected, _on_mqtt_connect subscribes to it
+        if self._mqtt_connected:
             self._mqtt.subscribe(topic)
 
     def mqtt_unsubscribe(self, callback, topic=None):
-        subbed_topics = [subbed_topic for subbed_topic, subbed_callback, _, _ in self._mqtt_subscriptions if callback == subbed_callback and (topic is None or topic == subbed_topic)]
-
-        def remove_sub(entry):
-            subbed_topic, subbed_callback, _, _ = entry
-            return not (callback == subbed_callback and (topic is None or subbed_topic == topic))
-
-        self._mqtt_subscriptions = filter(remove_sub, self._mqtt_subscriptions)
+        emptied = self._mqtt_subscriptions.remove(lambda subscription: subscription[0] == callback, topic)
 
+        # the router's own topics stay subscribed, and so do filters other callbacks still use
+        subbed_topics = [subbed_topic for subbed_topic in emptied
+                         if subbed_topic not in self.get_hub_settings().subscriptions]
         if self._mqtt_connected and subbed_topics:
-            self._mqtt.unsubscribe(*subbed_topics)
+            self._mqtt.unsubscribe(subbed_topics)
 
         ##~~ mqtt client callbacks
 
@@ -192,26 +178,46 @@ class MQTT:
             self.logger.debug(getLog("publishing alive to last will"))
             self._mqtt.publish(lw_topic, self._get_alive_message(True), qos=0, retain=self.retain)
 
-        if self._mqtt_publish_queue:
-            try:
-                while True:
-                    topic, payload, qos = self._mqtt_publish_queue.popleft()
-                    self._mqtt.publish(topic, payload=payload, retain=self.retain, qos=qos)
-            except IndexError:
-                # that's ok, queue is just empty
-                pass
-
         # subscribe to topics
-        subbed_topics = self.get_hub_yaml()["mqtt"]["topics"]["requests"]
-        subbed_topics = list(subbed_topics.values())
-        subbed_topics = list(map(lambda t: (t, 0), {topic for topic in subbed_topics}))
+        topics = set(self.get_hub_settings().subscriptions) | set(self._mqtt_subscriptions.filters())
+        subbed_topics = [(topic, 0) for topic in sorted(topics)]
         if subbed_topics:
             self._mqtt.subscribe(subbed_topics)
         self._mqtt_connected = True
         self.logger.debug(getLog("self._mqtt_connected = " + str(self._mqtt_connected)))
+        # a delta broadcast may have been lost with the connection, the next one starts from a keyframe
+        self.mqttRouter.broadcaster.request_keyframe()
+        self._startReplay()
         if self.on_connection_status_change is not None:
             self.on_connection_status_change(self._mqtt_connected)
 
+    def _startReplay(self):
+        # the outbox goes out at outboxReplayRate messages per second (after a burst), not all at once
+        with self._replay_lock:
+            if self._replay_task is None and len(self.outbox):
+                self.logger.info(getLog("replaying %d queued messages" % len(self.outbox)))
+                self._replay_task = self.scheduler.every("outbox replay", 1.0 / self._replay_rate,
+                                                         self._replayOutbox, delay=0)
+
+    def _replayOutbox(self):
+        while self._mqtt_connected:
+            queued = self.outbox.peek()
+            if queued is None:
+                break
+            if self._replay_bucket.take() > 0:
+                return
+            key, (topic, payload, qos) = queued
+            if self._mqtt.publish(topic, payload=payload, retain=self.retain, qos=qos).rc != mqtt.MQTT_ERR_SUCCESS:
+                # lost the connection, stays queued for the next connect
+                break
+            self.outbox.done(key, queued[1])
+        with self._replay_lock:
+            self._replay_task.cancel()
+            self._replay_task = None
+        # something queued after the last peek and before the task was gone would wait for the next connect
+        if self._mqtt_connected and len(self.outbox):
+            self._startReplay()
+
     def _on_mqtt_disconnect(self, client, userdata, rc):
         if not client == self._mqtt:
             return
@@ -235,26 +241,34 @@ class MQTT:
         if not client == self._mqtt:
             return
 
-        for subscription in self._mqtt_subscriptions:
-            topic, callback, args, kwargs = subscription
-            if topic_matches_sub(topic, msg.topic):
-                args = [msg.topic, msg.payload] + args
-                self.logger.info(getLog('on message' + str(args)))
-                kwargs.update(dict(retained=msg.retain, qos=msg.qos))
-                try:
-                    callback(*args, **kwargs)
-                except:
-                    self.logger.exception(getLog("Error while calling mqtt callback"))
+        for callback, args, kwargs in self._mqtt_subscriptions.match(msg.topic):
+            args = [msg.topic, msg.payload] + args
+            self.logger.info(getLog('on message' + str(args)))
+            kwargs = dict(kwargs, retained=msg.retain, qos=msg.qos)
+            try:
+                callback(*args, **kwargs)
+            except:
+                self.logger.exception(getLog("Error while calling mqtt callback"))
+
+    def _readHubSettings(self):
+        hub_settings = self.get_hub_settings()
+        self.broker_endpoint = hub_settings.broker_endpoint
+        self.broker_port = hub_settings.broker_port
+        self.retain = hub_settings.retain
+        self.clean_session = hub_settings.clean_session
+        # not there until the hub is registered
+        self.health_topic = hub_settings.health_topic or ''
+        self.client_id = hub_settings.client_id or ''
 
     def _get_topic(self, topic_type):
-        sub_topic = self.get_hub_yaml()["mqtt"]["publish"][topic_type + "Topic"]
-        topic_active = self.get_hub_yaml()["mqtt"]["publish"][topic_type + "Active"]
+        publish = self.get_hub_yaml()["mqtt"]["publish"]
+        sub_topic = publish[topic_type + "Topic"]
+        topic_active = publish[topic_type + "Active"]
 
         if not sub_topic or not topic_active:
             return None
 
-        return self.get_hub_yaml()["mqtt"]["publish"]["topicPrefix"] + \
-               self.get_hub_yaml()["mqtt"]["publish"]["baseTopic"] + sub_topic
+        return publish["topicPrefix"] + publish["baseTopic"] + sub_topic
 
     def _is_event_active(self, event):
         for event_class, events in self.EVENT_CLASS_TO_EVENT_LIST.items():
@@ -270,7 +284,7 @@ class MQTT:
             cert_path = os.path.expanduser('~') + "/.mosaicdata/certificate.pem.crt"
             private_path = os.path.expanduser('~') + "/.mosaicdata/private.pem.key"
             ssl_context = ssl.create_default_context()
-            ssl_context.set_alpn_protocols([self.get_hub_yaml()["mqtt"]["broker"]["protocol"]])
+            ssl_context.set_alpn_protocols([self.get_hub_settings().broker_protocol])
             ssl_context.load_verify_locations(cafile=root_ca_path)
             ssl_context.load_cert_chain(certfile=cert_path, keyfile=private_path)
 
@@ -280,9 +294,9 @@ class MQTT:
             raise e
 
     def _get_alive_message(self, alive):
-        return json.dumps({
+        return Serializer.dumps({
             "header": {
-                "originID":  self.get_hub_yaml()["mqtt"]["publish"]["originName"]
+                "originID":  self.get_hub_settings().origin_name
             },
             "payload": {
                 "body": {
@@ -290,9 +304,3 @@ class MQTT:
                 }
             }
         })
-
-    def _convert_py3_dict_to_json(self, data):
-        if isinstance(data, bytes):  return data.decode('ascii')
-        if isinstance(data, dict):   return dict(map(self._convert_py3_dict_to_json, data.items()))
-        if isinstance(data, tuple):  return map(self._convert_py3_dict_to_json, data)
-        return data
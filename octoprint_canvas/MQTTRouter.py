@@ -7,11 +7,18 @@ import requests
 import zipfile
 import io
 import json
-from dictdiffer import diff
-from math import log
 import platform
 import traceback
 from shutil import copyfile
+from . import Completion
+from . import StateNotifier
+from . import RequestDispatcher
+from . import StateModel
+from . import StateBroadcaster
+from . import BroadcastPolicy
+from . import Serializer
+from . import PrinterStateFeed
+from . import Scheduler
 
 def getLog(msg, module='mqtt-router', topic=''):
     if topic == '':
@@ -25,593 +32,662 @@ except ImportError:
 yaml = YAML(typ="safe")
 yaml.default_flow_style = False
 
+NOT_FOUND = {
+    "response": "Not Found"
+}
+
+GATEWAY_TIMEOUT = {
+    "response": "The server was acting as a gateway or proxy and did not receive a timely response from the upstream server"
+}
+
+# OctoPrint heater names and what the state calls them
+HEATERS = (("tool0", "nozzle"), ("bed", "bed"), ("chamber", "chamber"))
+
+
+def _time_remaining_threshold(remaining):
+    # the last minute is reported in finer steps
+    return 5 if remaining < 60 else 30
+
+
 class Router:
-    def __init__(self, mqtt, plugin, downloadPrintFiles):
+    def __init__(self, mqtt, plugin, download_manager):
         self.get_hub_yaml = plugin.get_hub_yaml
+        self.get_hub_settings = plugin.get_hub_settings
         self.replace_hub_yaml = plugin.replace_hub_yaml
-        self.save_hub_yaml = plugin.save_hub_yaml
-        self.downloadPrintFiles = downloadPrintFiles
-        self.device_id = ''
-        if "device" in  self.get_hub_yaml()["canvas-hub"] and \
-                "id" in self.get_hub_yaml()["canvas-hub"]["device"]:
-            self.device_id = self.get_hub_yaml()["canvas-hub"]["device"]["id"]
+        self.edit_hub_yaml = plugin.edit_hub_yaml
+        self.download_manager = download_manager
+        self.device_id = self.get_hub_settings().device_id or ''
         self._printer = plugin._printer
         self.count = 0
         self.plugin = plugin
         self.errors = plugin.errors
         self.mqtt = mqtt
+        self.executor = plugin.request_executor
+        self.completions = Completion.CompletionSignals()
+        self.state_changes = StateNotifier.StateNotifier()
+        self.state = StateModel.StateModel()
+        self._defineState()
+        self._state_encoder = Serializer.TemplateEncoder(self._build_state, list(self.state.values()))
+        self.broadcaster = StateBroadcaster.StateBroadcaster(plugin._settings.get(["broadcastMode"]),
+                                                             plugin._settings.get_int(["broadcastKeyframeInterval"]))
+        self.scheduler = plugin.scheduler
+        settings = plugin._settings
+        self.broadcast_policy = BroadcastPolicy.BroadcastPolicy(settings.get_float(["broadcastBackoffFactor"]),
+                                                                settings.get_float(["broadcastMaxInterval"]),
+                                                                settings.get_float(["broadcastCoalesceWindow"]),
+                                                                settings.get_float(["broadcastRate"]),
+                                                                settings.get_int(["broadcastBurst"]))
+        self._broadcast_lock = threading.Lock()
+        # nothing is broadcast in the first seconds, MQTT is still connecting
+        self._earliest_broadcast = Scheduler.clock() + 5
+        self._closed = False
+        self._registerRequestHandlers()
         self._file_manager = plugin._file_manager
-        self._broadcastStateThread = None
-        self._stateWatcherThread = None
         self.logger = plugin.logger
-        self._startBroadcastStateThread()
-        self._startStateWatcherThread()
-        self._most_recent_broadcast_state = {}
-        self._print_job_start_time = ''
-        self._print_job_file_path = ''
-        self._print_job_file_size = ''
-        self._print_job_file_modified = ''
-        self.motor_state = False
-        self._print_job_file_name = ''
-        self.fan_state = 0
-        self._print_job_status_name = ''
-        self._activeSetupId = ''
-        self._filament_length = ''
-        self.palette_connected = False
-        self.palette_port = ''
-        self.broadcast_counter = 0
+        self._broadcast_task = self.scheduler.call_later("state broadcast", 5, self._broadcast_state)
+        # OctoPrint sends the current state right away and from then on whenever it changes
+        self._feed = PrinterStateFeed.PrinterStateFeed(self)
+        self._printer.register_callback(self._feed)
+
+    def _defineState(self):
         connection = self._printer.get_current_connection()
-        self.connected_state = connection[1] and connection[2]
+        state = self.state
+        canvas_user = self.get_hub_yaml()["canvas-user"]
+        state.define("active_setup_id", canvas_user.get("active-setup", {}).get("id", ''))
+        state.define("palette_connected", False)
+        state.define("palette_port", '')
+        state.define("printer_connected", connection[1] and connection[2])
+        state.define("serial_port", connection[1])
+        state.define("baud", connection[2])
+        for heater, name in HEATERS:
+            # readings wander by a fraction of a degree all the time
+            state.define(name + "_actual", 0, threshold=1)
+            state.define(name + "_target", 0)
+        state.define("fan", 0)
+        state.define("motor", False)
+        state.define("job_name", '')
+        state.define("job_progress", 0, threshold=0.1)
+        state.define("job_start", '')
+        state.define("job_status", '')
+        state.define("job_total_time", 0, threshold=30)
+        state.define("job_time_remaining", 0, threshold=_time_remaining_threshold)
+        state.define("filament_length", '')
+        state.define("file_path", '')
+        state.define("file_size", '')
+        state.define("file_date", '')
 
-        self._temps = {
-            "tool0": {
-                "actual": 0,
-                "target": 0,
-            },
-            "bed": {
-                "actual": 0,
-                "target": 0,
-            },
-            "chamber": {
-                "actual": 0,
-                "target": 0,
-            }
-        }
+    def close(self):
+        # stops the printer updates and broadcasts, for a router that is being replaced or shut down
+        self._printer.unregister_callback(self._feed)
+        with self._broadcast_lock:
+            self._closed = True
+            self._broadcast_task.cancel()
 
-    def _startBroadcastStateThread(self):
-        if self._broadcastStateThread is None:
-            self._broadcastStateThread = threading.Thread(target=self._broadcast_state)
-            self._broadcastStateThread.daemon = True
-            self._broadcastStateThread.start()
-
-    def _startStateWatcherThread(self):
-        if self._stateWatcherThread is None:
-            self._stateWatcherThread = threading.Thread(target=self._watch_state)
-            self._stateWatcherThread.daemon = True
-            self._stateWatcherThread.start()
-
-    def _resetBroadcastStateThread(self):
-        self.broadcast_counter = -1
-
-    def _watch_state(self):
-        time.sleep(5)
-        while True:
-            time.sleep(2)
-            new_state = self._get_state()
-            result = list(diff(self._most_recent_broadcast_state, new_state))
-            if result:
-                has_significant_change = False
-                for item in result:
-                    type, path, change = item
-                    before_value, after_value = change
-                    if type != 'change':
-                        has_significant_change = True
-                        break
-                    path_str = '.'.join(str(x) for x in path)
-                    if path_str == 'state.printer.data.temperature.nozzle.0.actual':
-                        if abs(before_value - after_value) > 1:
-                            has_significant_change = True
-                            break
-                    elif path == 'state.printer.data.temperature.bed.actual':
-                        if abs(before_value - after_value) > 1:
-                            has_significant_change = True
-                            break
-                    elif path == 'state.printer.job.progress':
-                        if abs(before_value - after_value) > 0.1:
-                            has_significant_change = True
-                            break
-                    elif path == 'state.printer.job.data.timeRemaining':
-                        threshold = 30;
-                        if after_value < 60:
-                            threshold = 5;
-                        if abs(before_value - after_value) > threshold:
-                            has_significant_change = True
-                            break
-                    elif path == 'state.printer.job.data.totalTime':
-                        if abs(before_value - after_value) > 30:
-                            has_significant_change = True
-                            break
-                    else:
-                        has_significant_change = True
-                        break
-                if has_significant_change:
-                    self.logger.info(getLog('state changed significantly: ' + str(result)))
-                    self.broadcast_counter = -1
+    def request_broadcast(self):
+        # broadcasts after the coalescing window, together with whatever else triggers meanwhile, and starts the
+        # backoff over
+        with self._broadcast_lock:
+            self.broadcast_policy.reset()
+            now = Scheduler.clock()
+            due = max(now + self.broadcast_policy.coalesce_window, self._earliest_broadcast)
+            if not self._closed and self._broadcast_task.due > due:
+                self._broadcast_task.cancel()
+                self._broadcast_task = self.scheduler.call_later("state broadcast", due - now, self._broadcast_state)
 
     def _broadcast_state(self):
-        time.sleep(5)
-        while True:
-            self.broadcast_counter += 1
-            count = self.broadcast_counter
-            if count == 0 or self._check_kth_power(count, 5):
-                broadcast_state_topic = self.get_hub_yaml()["mqtt"]["topics"]["broadcasts"]["stateTopic"]
-                self.logger.info(getLog("broadcasting state - " + str(count) + 's',
-                                        topic='broadcast/state'))
-                state = self._get_state()
-                self._most_recent_broadcast_state = state
-                response_msg = {
-                    "header": {
-                        "originID": "simcoe",
-                        "msgID": datetime.datetime.utcnow().isoformat()[:-3] + 'Z'
-                    },
-                    "payload": {
-                        "status": 200,
-                        "body": state,
-                    },
-                }
-                self.mqtt.mqtt_publish(broadcast_state_topic, response_msg)
-            time.sleep(1)
+        # runs on the scheduler, see BroadcastPolicy for when
+        with self._broadcast_lock:
+            wait = self.broadcast_policy.bucket.take()
+            if wait > 0:
+                # over the rate limit, everything that triggered until then goes out in one broadcast
+                self._broadcast_task = self.scheduler.call_later("state broadcast", wait, self._broadcast_state)
+                return
+            elapsed = self.broadcast_policy.elapsed
+            self._broadcast_task = self.scheduler.call_later("state broadcast", self.broadcast_policy.advance(),
+                                                             self._broadcast_state)
+        broadcast_state_topic = self.get_hub_settings().state_topic
+        if self.mqtt.queueing():
+            # the outbox keeps only the newest state message, so a queued one must not depend on the ones before
+            self.broadcaster.request_keyframe()
+        self.logger.info(getLog("broadcasting state - %ds" % elapsed, topic='broadcast/state'))
+        response_msg = {
+            "header": {
+                "originID": "simcoe",
+                "msgID": datetime.datetime.utcnow().isoformat()[:-3] + 'Z'
+            },
+            "payload": self.broadcaster.payload(self.state.publish(), self._state_encoder.encode),
+        }
+        self.mqtt.mqtt_publish(broadcast_state_topic, response_msg, allow_queueing=True, coalesce=True)
 
     def _get_state(self):
-        progress_percent = 0
-        time_remaining = 0
-        time_total = 0
+        # encoded already, the state always has the same shape
+        return self._state_encoder.encode(self.state.values())
+
+    def on_current_data(self, data):
+        # pushed by OctoPrint through PrinterStateFeed
+        values = {
+            "job_progress": 0,
+            "job_time_remaining": 0,
+            "job_total_time": 0
+        }
         try:
-            data = self._printer.get_current_data()
-            job = self._printer.get_current_job()
-
-            if ((data is not None) and ('progress' in data)
-                    and (data['progress']['printTime'] is not None)
-                    and (data['progress']['printTimeLeft'] is not None)):
-                progress_percent = data['progress']['completion']
-                time_elapsed = data['progress']['printTime']
-                time_remaining = data['progress']['printTimeLeft']
-                time_total = time_elapsed + time_remaining
+            progress = data.get("progress")
+            if ((progress is not None) and (progress['printTime'] is not None)
+                    and (progress['printTimeLeft'] is not None)):
+                values["job_progress"] = progress['completion']
+                values["job_time_remaining"] = progress['printTimeLeft']
+                values["job_total_time"] = progress['printTime'] + progress['printTimeLeft']
+            job = data.get("job")
             if (job != None) and ('filament' in job) and (job['filament'] != None) and ('tool0' in \
                     job['filament']):
-                self._filament_length = job['filament']['tool0']['length']
+                values["filament_length"] = job['filament']['tool0']['length']
+            connection = self._printer.get_current_connection()
+            values["serial_port"] = connection[1]
+            values["baud"] = connection[2]
         except Exception as e:
             self.logger.error(getLog('error reading job: ' + str(e), topic="get/state"))
-        try:
-            get_temps = self._printer.get_current_temperatures()
-            if get_temps != {}:
-                self._temps = get_temps
-            if "active-setup" in self.get_hub_yaml()["canvas-user"]:
-                self._activeSetupId = self.get_hub_yaml()["canvas-user"]["active-setup"]["id"]
-        except KeyError as e:
-            self.logger.error(getLog('broadcast key error: ' + str(e), topic="get/state"))
+        self._stateChanged(values)
 
-        connection = self._printer.get_current_connection()
-        try:
-            return {
-                "state": {
-                    "simcoe": {
-                        "data": {
-                            "activeSetup": {
-                                "id": self._activeSetupId
-                            }
-                        },
-                    },
-                    "palette": {
-                        "data": {
-                            "connected": self.palette_connected,
-                            "serial": {
-                                "port": self.palette_port
-                            }
+    def on_temperatures(self, temps):
+        # pushed by OctoPrint through PrinterStateFeed
+        values = {}
+        for heater, name in HEATERS:
+            if temps.get(heater):
+                values[name + "_actual"] = temps[heater]["actual"]
+                values[name + "_target"] = temps[heater]["target"]
+        self._stateChanged(values)
+
+    def _stateChanged(self, values):
+        # the significance check runs only when something arrived, a significant change broadcasts right away
+        if self.state.set(**values):
+            self.logger.debug(getLog('state changed significantly: ' + ', '.join(self.state.dirty())))
+            self.request_broadcast()
+
+    def _build_state(self, values):
+        return {
+            "state": {
+                "simcoe": {
+                    "data": {
+                        "activeSetup": {
+                            "id": values["active_setup_id"]
                         }
                     },
-                    "printer": {
-                        "data": {
-                            "connected": self.connected_state,
-                            "serial": {
-                                "port": connection[1],
-                                "baud": connection[2],
-                            },
-                            "temperature": {
-                                "nozzle": [
-                                    {
-                                        "actual": self._temps["tool0"]["actual"],
-                                        "target": self._temps["tool0"]["target"],
-                                    },
-                                ],
-                                "bed": {
-                                    "actual": self._temps["bed"]["actual"],
-                                    "target": self._temps["bed"]["target"],
-                                },
-                                "chamber": {
-                                    "actual": self._temps["chamber"]["actual"],
-                                    "target": self._temps["chamber"]["target"],
+                },
+                "palette": {
+                    "data": {
+                        "connected": values["palette_connected"],
+                        "serial": {
+                            "port": values["palette_port"]
+                        }
+                    }
+                },
+                "printer": {
+                    "data": {
+                        "connected": values["printer_connected"],
+                        "serial": {
+                            "port": values["serial_port"],
+                            "baud": values["baud"],
+                        },
+                        "temperature": {
+                            "nozzle": [
+                                {
+                                    "actual": values["nozzle_actual"],
+                                    "target": values["nozzle_target"],
                                 },
+                            ],
+                            "bed": {
+                                "actual": values["bed_actual"],
+                                "target": values["bed_target"],
                             },
-                            "fan": self.fan_state,
-                            "motor": self.motor_state,
-                        },
-                        "job": {
-                            "name": self._print_job_file_name,
-                            "progress": progress_percent,
-                            "time": {
-                                "start": self._print_job_start_time
+                            "chamber": {
+                                "actual": values["chamber_actual"],
+                                "target": values["chamber_target"],
                             },
-                            "status": {
-                                "name": self._print_job_status_name,
+                        },
+                        "fan": values["fan"],
+                        "motor": values["motor"],
+                    },
+                    "job": {
+                        "name": values["job_name"],
+                        "progress": values["job_progress"],
+                        "time": {
+                            "start": values["job_start"]
+                        },
+                        "status": {
+                            "name": values["job_status"],
+                        },
+                        "data": {
+                            "totalTime": values["job_total_time"],
+                            "timeRemaining": values["job_time_remaining"],
+                            "filament": {
+                                "length": values["filament_length"],
                             },
-                            "data": {
-                                "totalTime": time_total,
-                                "timeRemaining": time_remaining,
-                                "filament": {
-                                    "length": self._filament_length,
-                                },
-                                "file": {
-                                    "path": self._print_job_file_path,
-                                    "size": self._print_job_file_size,
-                                    "date": self._print_job_file_modified,
-                                },
+                            "file": {
+                                "path": values["file_path"],
+                                "size": values["file_size"],
+                                "date": values["file_date"],
                             },
                         },
-                    }
+                    },
                 }
             }
-        except Exception as error:
-            self.logger.error(getLog('key error: ' + str(error), topic="get/state"))
+        }
+
+    def _registerRequestHandlers(self):
+        # topics are read once here; registration rebuilds the MQTT client and with it this router
+        hub_settings = self.get_hub_settings()
+        self._all_canvas_hubs_topic = hub_settings.all_canvas_hubs_topic
+        self._all_devices_topic = hub_settings.all_devices_topic
+        self._device_topic = hub_settings.device_topic
+        completion_timeout = self.plugin._settings.get_float(["completionTimeout"])
+        state_change_timeout = self.plugin._settings.get_float(["stateChangeTimeout"])
+
+        self.dispatcher = RequestDispatcher.RequestDispatcher(hub_settings.device_request_topic,
+                                                              RequestDispatcher.RequestHandler(concurrency='config'))
+        register = self.dispatcher.register
+        handler = RequestDispatcher.RequestHandler
+        register('/state', handler(self._handleState))
+        register('/scan-com-ports', handler(self._handleScanComPorts, status=200))
+        register('/printer/move', handler(self._handleMove, 'printer', completion_timeout))
+        register('/printer/home', handler(self._handleHome, 'printer', completion_timeout))
+        register('/printer/fan', handler(self._handleFan, 'printer', completion_timeout))
+        register('/printer/motor', handler(self._handleMotor, 'printer', completion_timeout))
+        register('/printer/temperature', handler(self._handleTemperature, 'printer', completion_timeout))
+        register('/printer/start', handler(self._handleStart, 'printer', completion_timeout))
+        register('/printer/cancel', handler(self._handleCancel, 'printer', state_change_timeout))
+        register('/printer/pause', handler(self._handlePause, 'printer', completion_timeout))
+        register('/printer/resume', handler(self._handleResume, 'printer', completion_timeout))
+        register('/printer/connect', handler(self._handlePrinterConnect, 'printer', state_change_timeout))
+        register('/printer/disconnect', handler(self._handlePrinterDisconnect, 'printer', completion_timeout))
+        register('/command', handler(self._handleCommand, 'printer', completion_timeout))
+        register('/palette/connect', handler(self._handlePaletteConnect, 'palette', state_change_timeout))
+        register('/palette/disconnect', handler(self._handlePaletteDisconnect, 'palette', completion_timeout))
+        register('/storage', handler(self._handleStoragePut, 'storage', status=200), method='put')
+        register('/storage', handler(self._handleStorageGet, 'storage', status=200), method='get')
+        register('/storage', handler(self._handleStoragePost, 'storage'), method='post')
+        register('/storage', handler(self._handleStorageDelete, 'storage'), method='delete')
+        register('/storage', handler(concurrency='storage'))
+        register('/update-active-setup', handler(self._handleUpdateActiveSetup, 'config'))
 
     def router(self, topic, msg):
         try:
-            subbed_topics = self.get_hub_yaml()["mqtt"]["topics"]["requests"]
-            request_prefix = str(subbed_topics.get("deviceRequestTopicPrefix")).split('/#')[0]
-            request_topic = self._removePrefix(topic, request_prefix)
-            if topic == subbed_topics.get('allCanvasHubs'):
+            request_topic = self.dispatcher.request_topic(topic)
+            if topic == self._all_canvas_hubs_topic:
                 pass
-            elif topic == subbed_topics.get('allDevices'):
-                pass
-            elif topic.startswith(request_prefix):
-                self._requestRouter(request_topic, msg)
-            elif topic == subbed_topics.get('deviceTopicPrefix'):
-                if msg["type"] == "ACCOUNT_LINKED":
-                    self.get_hub_yaml()["canvas-user"] = msg["payload"]["user"]
-                    self.save_hub_yaml()
-                    self.plugin.canvas.updateUsersOnUI()
-                    # show Account Linked modal after adding user to YAML
-                    self.plugin.canvas.updateUI({
-                        "command": "AccountLinked",
-                        "data": {
-                            "username": self.get_hub_yaml()["canvas-user"]["username"]
-                        }
-                    })
-                elif msg["type"] == "ACCOUNT_UNLINKED":
-                    # show Account Unlinked modal before removing user from YAML
-                    self.plugin.canvas.updateUI({
-                        "command": "AccountUnlinked",
-                        "data": {
-                            "username": self.get_hub_yaml()["canvas-user"]["username"]
-                        }
-                    })
-                    self.get_hub_yaml()["canvas-user"] = {}
-                    self.save_hub_yaml()
-                    self.plugin.canvas.updateUsersOnUI()
+            elif topic == self._all_devices_topic:
                 pass
+            elif request_topic is not None:
+                handler = self.dispatcher.resolve(request_topic, msg)
+                if not self.executor.submit(handler.concurrency, self._requestRouter, handler, request_topic, msg):
+                    self._rejectRequest(request_topic, msg)
+            elif topic == self._device_topic:
+                self.executor.submit('account', self._accountRouter, msg)
+        except ValueError as valError:
+            self.errors.errorHandler(valError)
+            pass
+
+    def _rejectRequest(self, topic, msg):
+        try:
+            response_topic = self.get_hub_settings().response_topic(msg["header"]["originID"], topic)
+            self.logger.info(getLog('too many pending requests, rejecting', topic=topic))
+            self._publishResponse(response_topic, msg["header"]["msgID"], {
+                "response": "Service Unavailable"
+            }, 503)
+        except KeyError as keyError:
+            self.errors.errorHandler(keyError)
+
+    def _accountRouter(self, msg):
+        try:
+            if msg["type"] == "ACCOUNT_LINKED":
+                with self.edit_hub_yaml() as hub_yaml:
+                    hub_yaml["canvas-user"] = msg["payload"]["user"]
+                self.plugin.canvas.updateUsersOnUI()
+                # show Account Linked modal after adding user to YAML
+                self.plugin.canvas.updateUI({
+                    "command": "AccountLinked",
+                    "data": {
+                        "username": msg["payload"]["user"]["username"]
+                    }
+                })
+            elif msg["type"] == "ACCOUNT_UNLINKED":
+                with self.edit_hub_yaml() as hub_yaml:
+                    username = hub_yaml["canvas-user"]["username"]
+                    hub_yaml["canvas-user"] = {}
+                # show Account Unlinked modal with the user that was removed
+                self.plugin.canvas.updateUI({
+                    "command": "AccountUnlinked",
+                    "data": {
+                        "username": username
+                    }
+                })
+                self.plugin.canvas.updateUsersOnUI()
         except ValueError as valError:
             self.errors.errorHandler(valError)
             pass
 
-    def _requestRouter(self, topic, msg):
+    def _requestRouter(self, handler, topic, msg):
         try:
             req_origin_id = msg["header"]["originID"]
-            device_id = self.get_hub_yaml()["canvas-hub"]["device"]["id"]
-            topic_prefix = self.get_hub_yaml()["mqtt"]["publish"]["topicPrefix"]
-            response_topic = topic_prefix + '/devices/' + device_id + '/' + req_origin_id + \
-                                          '/response' + topic
+            response_topic = self.get_hub_settings().response_topic(req_origin_id, topic)
             req_msg_id = msg["header"]["msgID"]
-            response_status = 204
-            response_body = {
-                "response": "No Content"
-            }
             query = ''
             if 'payload' in msg and 'query' in msg['payload']:
                 query += ': ' + str(msg['payload']['query'])
             self.logger.info(getLog('new message: ' + topic + query))
-            if topic == '/state':
-                response_body = self._get_state()
-                pass
-            elif topic == '/printer/move':
-                self.logger.debug(getLog('move payload: ', str(msg["payload"]), topic=topic))
-                f, x, y, z, e = 51, 0, 0, 0, 0
-                if "f" in msg["payload"]["query"]:
-                    f = msg["payload"]["query"]["f"] * 100
-                self._printer.feed_rate(f)
-                if "x" in msg["payload"]["query"]:
-                    x = msg["payload"]["query"]["x"]
-                if "y" in msg["payload"]["query"]:
-                    y = msg["payload"]["query"]["y"]
-                if "z" in msg["payload"]["query"]:
-                    z = msg["payload"]["query"]["z"]
-                self._printer.jog(axes={"x": x, "y": y, "z": z}, speed=20000, relative=True)
-                if "e" in msg["payload"]["query"]:
-                    self.logger.info(getLog('extruding/retracting: ' + str(e), topic=topic))
-                    e = msg["payload"]["query"]["e"]
-                self._printer.extrude(e)
-                time.sleep(1)
-                pass
-            elif topic == '/printer/home':
-                axes = msg["payload"]["query"]["axes"]
-                if not axes:
-                    axes = ['x', 'y', 'z']
-                self._printer.home(axes)
-                time.sleep(1)
-                pass
-            elif topic == '/printer/fan':
-                speed = msg["payload"]["query"]["speed"]
-                if speed == 0:
-                    self._printer.commands("M107")
-                    time.sleep(1)
-                elif 0 < speed <= 100:
-                    self._printer.commands("M106 S" + str(255*speed*.01))
-                time.sleep(1)
-                pass
-            elif topic == '/printer/motor':
-                if msg["payload"]["query"]["on"]:
-                    self._printer.commands("M17")  # enable motors
-                    time.sleep(1)
-                else:
-                    self._printer.commands("M18")  # disable motors
-                    time.sleep(1)
-                pass
-            elif topic == '/printer/temperature':
-
-                if "query" in msg["payload"]:
-                    if "bed" in msg["payload"]["query"]:
-                        self._printer.set_temperature(heater='bed', value=msg["payload"]["query"][
-                            "bed"])
-                        time.sleep(1)
-                    if "chamber" in msg["payload"]["query"]:
-                        self._printer.set_temperature(heater='chamber', value=msg["payload"][
-                            "query"]["chamber"])
-                        time.sleep(1)
-                    if "nozzle" in msg["payload"]["query"]:
-                        self._printer.set_temperature(heater='tool0', value=msg["payload"]["query"][
-                            "nozzle"][0])
-                        time.sleep(1)
-                pass
-            elif topic == '/printer/start':
-                path = msg["payload"]["query"]["path"]
-                legs = path.split('/')
-                basename = ''
-                if legs[0] == 'device':
-                    print_path = path
-                    legs = legs[1:]
-                    local_path = os.path.join(self.plugin._settings.getBaseFolder('uploads'))
-                    for leg in legs:
-                        local_path = os.path.join(local_path, leg)
-                    basename = os.path.basename(local_path)
-                else:
-                    self.logger.debug(getLog('start print from external drive', topic=topic))
-                    system = platform.system()
-                    if system == 'Linux':
-                        self.logger.debug(getLog('copying file to linux local', topic=topic))
-                        basename = os.path.basename(path)
-                        local_path = os.path.join(self.plugin._settings.getBaseFolder('uploads'), basename)
-                        if legs[1] == 'dev':
-                            ext_rel_legs = legs[3:]
-                            external_abs_path = '/mnt/mosaic/'
-                            for leg in ext_rel_legs:
-                                external_abs_path = os.path.join(external_abs_path, leg)
-                            copyfile(external_abs_path, local_path)
-                            print_path = 'device/' + basename
-                    elif system == 'Windows':
-                        self.logger.debug(getLog('copying file to windows local', topic=topic))
-                        basename = os.path.basename(path)
-                        local_path = os.path.join(self.plugin._settings.getBaseFolder('uploads'), basename)
-                        copyfile(path, local_path)
-                        print_path = 'device/' + basename
-                self._printer.select_file(local_path, sd=False, printAfterSelect=True)
-                self._print_job_start_time = datetime.datetime.utcnow().isoformat()[:-3] + 'Z'
-                self._print_job_file_path = print_path
-                self._print_job_file_name = basename
-                self._print_job_file_size = os.path.getsize(local_path)
-                timestamp = os.path.getmtime(local_path)
-                self._print_job_status_name = 'start'
-
-                self._print_job_file_modified = datetime.datetime.utcfromtimestamp(timestamp).strftime(
-                    '%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
-
-                self._print_job_file_name = legs[len(legs) - 1]
-                self.logger.info(getLog('starting print: ' + self._print_job_file_name, topic=topic))
-
-                time.sleep(1)
-                pass
-            elif topic == '/printer/cancel':
-                self._printer.cancel_print()
-                for count in range(0, 29):
-                    if self._print_job_status_name == 'cancelling':
-                        time.sleep(1)
-                time.sleep(1)
-                pass
-            elif topic == '/printer/pause':
-                printer_state = self._printer.get_state_id()
-                self._print_job_status_name = 'pausing'
-                self._printer.pause_print()
-                time.sleep(1)
-                pass
-            elif topic == '/printer/resume':
-                printer_state = self._printer.get_state_id()
-                self._printer.resume_print()
-                time.sleep(1)
-                self._print_job_status_name = ''
-                pass
-            elif topic == '/command':
-                self._printer.commands(msg["payload"]["query"]["command"])
-                time.sleep(1)
-                pass
-            elif topic == '/storage':
-                path = None
-
-                if "query" in msg["payload"] and "path" in msg["payload"]["query"]:
-                    path = msg["payload"]["query"]["path"]
-                method = msg["payload"]["method"]
-                if method == 'put':
-                    name = ""
-                    if "name" in msg["payload"]["query"]:
-                        name = msg["payload"]["query"]["name"]
-                    if "s3path" in msg["payload"]["query"]:
-                        self.downloadPrintFiles(msg["payload"]["query"]["s3path"], name)
-                        response_status = 200
-                        response_body = {
-                            path: path
-                        }
-                    pass
-                elif method == 'get':
-                    drives = ["device/"]
-                    system = platform.system()
-                    if system == 'Linux':
-                        temp_drives = os.popen('sudo blkid /dev/sd*').read()
-                        temp_drives = temp_drives.split('\n')
-                        self.logger.debug(getLog('temp_drives: ' + str(temp_drives), topic=topic))
-                        temp_drives.remove('')
-                        for drive in temp_drives:
-                            drive = drive.split(':')
-                            try:
-                                if 'PARTUUID' in drive[1]:
-                                    temp_drives2 = []
-                                    temp_drives2.append(drive[0])
-                                    for idx, drive in enumerate(temp_drives2):
-                                        if drive != '':
-                                            drives.append(drive)
-                            except Exception as e:
-                                self.logger.error(getLog('error finding drive: ' + str(e), topic=topic))
-                    elif system == 'Windows':
-                        available_drives = ['%s:' % d for d in string.ascii_uppercase if os.path.exists('%s:' % d)]
-                        for drive in available_drives:
-                            if drive != 'C:':
-                                drives.append(drive)
-                    response_status = 200
-                    response_body = drives
-                    pass
-                elif method == 'post':
-                    # get folder content
-                    if "path" in msg["payload"]["query"] and "newPath" not in msg["payload"][\
-                            "query"]:
-                        files = self._get_folder_content(msg, topic)
-                        response_body = files
-                        response_status = 200
-
-                    # edit file name
-                    if "newPath" in msg["payload"]["query"]:
-                        path = msg["payload"]["query"]["path"]
-                        new_path = msg["payload"]["query"]["newPath"]
-                        old_legs = path.split('/')
-                        new_legs = new_path.split('/')
-                        if old_legs[0] == 'device':
-                            old_legs.pop(0)
-                            path = '/'.join(old_legs[:])
-                            new_legs.pop(0)
-                            new_path = '/'.join(new_legs)
-                            new_abs_path = os.path.join(self.plugin._settings.getBaseFolder('uploads'),
-                                                        new_path)
-                            os.rename(os.path.join(self.plugin._settings.getBaseFolder(
-                                'uploads'), path), new_abs_path)
-                        else:
-                            system = platform.system()
-                            if system == 'Linux':
-                                old_abs_path = '/mnt/mosaic'
-                                for idx, leg in enumerate(old_legs):
-                                    if idx > 2:
-                                        old_abs_path = os.path.join(old_abs_path, leg)
-                                new_abs_path = '/mnt/mosaic'
-                                for idx, leg in enumerate(new_legs):
-                                    if idx > 2:
-                                        new_abs_path = os.path.join(new_abs_path, leg)
-                                os.popen('sudo mv ' + old_abs_path + ' ' + new_abs_path).read()
-                                pass
-                            elif system == 'Windows':
-                                new_abs_path = new_path
-                                os.rename(path, new_path)
-                            pass
-                        response_status = 200
-                        timestamp = os.path.getmtime(new_abs_path)
-                        timestamp = datetime.datetime.utcfromtimestamp(timestamp).strftime(
-                            '%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
-                        response_body = {
-                            "name": new_legs[len(new_legs) - 1],
-                            "dateModified":  timestamp
-                        }
-                    else:
-                        pass
-                elif method == 'delete':
-                    pass
-                pass
-            elif topic == '/printer/connect':
-                port = None
-                baudrate = None
-                if "baudrate" in msg["payload"]["query"]:
-                    if msg["payload"]["query"]["baudrate"] != "auto":
-                        baudrate = int(msg["payload"]["query"]["baudrate"])
-                if "comPort" in msg["payload"]["query"]:
-                    if msg["payload"]["query"]["comPort"] != "auto":
-                        port = msg["payload"]["query"]["comPort"]
-                self._printer.connect(port=port, baudrate=baudrate)
-                for count in range(0, 29):
-                    if self.connected_state == False:
-                        time.sleep(1)
-                if self.connected_state == False:
-                    response_status = 504
-                    response_body = {
-                        "response": "The server was acting as a gateway or proxy and did not receive a timely response from the upstream server"
-                    }
-                    pass
-                self.broadcast_counter = -1
-                pass
-            elif topic == '/palette/connect':
-                self.logger.info(getLog('palette connect', topic=topic))
-                self.plugin.canvas.palette_comm.send_message('connect')
-                for count in range(0, 29):
-                    if self.palette_connected == False:
-                        time.sleep(1)
-                if self.palette_connected == False:
-                    response_status = 504
-                    response_body = {
-                        "response": "The server was acting as a gateway or proxy and did not receive a timely response from the upstream server"
-                    }
-                self.broadcast_counter = -1
-            elif topic == '/palette/disconnect':
-                self.plugin.canvas.palette_comm.send_message('disconnect')
-                time.sleep(1)
-            elif topic == '/printer/disconnect':
-                self._printer.disconnect()
-                time.sleep(1)
-                pass
-            elif topic == '/scan-com-ports':
-                connection_options = self._printer.get_connection_options()
-                response_status = 200
-                response_body = {
-                    "ports": connection_options["ports"]
-                }
-                pass
-            elif topic == '/update-active-setup':
-                setup_id = msg["payload"]["query"]["id"]
-                self.get_hub_yaml()["canvas-user"]["active-setup"] = {}
-                self.get_hub_yaml()["canvas-user"]["active-setup"]["id"] = setup_id
-                self.logger.info(getLog('active setup updated', topic=topic))
-                self._activeSetupId = self.get_hub_yaml()["canvas-user"]["active-setup"]["id"]
-                self.save_hub_yaml()
+            response_status, response_body = handler.handle(topic, msg)
             self._publishResponse(response_topic, req_msg_id, response_body, response_status)
-            self._resetBroadcastStateThread()
+            self.request_broadcast()
         except ValueError as valError:
             self.errors.errorHandler(valError)
             pass
 
-    def _removePrefix(self, text, prefix):
-        if text.startswith(prefix):
-            return text[len(prefix):]
-        return text
+    def _handleState(self, topic, msg, handler):
+        # also how a consumer that missed a delta resyncs: the broadcast every request triggers is then a keyframe
+        self.broadcaster.request_keyframe()
+        return handler.status, self._get_state()
+
+    def _handleMove(self, topic, msg, handler):
+        self.logger.debug(getLog('move payload: ', str(msg["payload"]), topic=topic))
+        f, x, y, z, e = 51, 0, 0, 0, 0
+        if "f" in msg["payload"]["query"]:
+            f = msg["payload"]["query"]["f"] * 100
+        self._printer.feed_rate(f)
+        with self.completions.expect(gcodes=['G1', 'G1']) as completion:
+            if "x" in msg["payload"]["query"]:
+                x = msg["payload"]["query"]["x"]
+            if "y" in msg["payload"]["query"]:
+                y = msg["payload"]["query"]["y"]
+            if "z" in msg["payload"]["query"]:
+                z = msg["payload"]["query"]["z"]
+            self._printer.jog(axes={"x": x, "y": y, "z": z}, speed=20000, relative=True, tags=completion.tags)
+            if "e" in msg["payload"]["query"]:
+                self.logger.info(getLog('extruding/retracting: ' + str(e), topic=topic))
+                e = msg["payload"]["query"]["e"]
+            self._printer.extrude(e, tags=completion.tags)
+            self._awaitCompletion(completion, topic, handler.timeout)
+
+    def _handleHome(self, topic, msg, handler):
+        axes = msg["payload"]["query"]["axes"]
+        if not axes:
+            axes = ['x', 'y', 'z']
+        with self.completions.expect(gcodes=['G28']) as completion:
+            self._printer.home(axes, tags=completion.tags)
+            self._awaitCompletion(completion, topic, handler.timeout)
+
+    def _handleFan(self, topic, msg, handler):
+        speed = msg["payload"]["query"]["speed"]
+        if speed == 0:
+            with self.completions.expect(gcodes=['M107']) as completion:
+                self._printer.commands("M107", tags=completion.tags)
+                self._awaitCompletion(completion, topic, handler.timeout)
+        elif 0 < speed <= 100:
+            with self.completions.expect(gcodes=['M106']) as completion:
+                self._printer.commands("M106 S" + str(255*speed*.01), tags=completion.tags)
+                self._awaitCompletion(completion, topic, handler.timeout)
+
+    def _handleMotor(self, topic, msg, handler):
+        # M17 enables the motors, M18 disables them
+        gcode = "M17" if msg["payload"]["query"]["on"] else "M18"
+        with self.completions.expect(gcodes=[gcode]) as completion:
+            self._printer.commands(gcode, tags=completion.tags)
+            self._awaitCompletion(completion, topic, handler.timeout)
+
+    def _handleTemperature(self, topic, msg, handler):
+        if "query" in msg["payload"]:
+            gcodes = []
+            if "bed" in msg["payload"]["query"]:
+                gcodes.append('M140')
+            if "chamber" in msg["payload"]["query"]:
+                gcodes.append('M141')
+            if "nozzle" in msg["payload"]["query"]:
+                gcodes.append('M104')
+            with self.completions.expect(gcodes=gcodes) as completion:
+                if "bed" in msg["payload"]["query"]:
+                    self._printer.set_temperature(heater='bed', value=msg["payload"]["query"][
+                        "bed"], tags=completion.tags)
+                if "chamber" in msg["payload"]["query"]:
+                    self._printer.set_temperature(heater='chamber', value=msg["payload"][
+                        "query"]["chamber"], tags=completion.tags)
+                if "nozzle" in msg["payload"]["query"]:
+                    self._printer.set_temperature(heater='tool0', value=msg["payload"]["query"][
+                        "nozzle"][0], tags=completion.tags)
+                self._awaitCompletion(completion, topic, handler.timeout)
+
+    def _handleStart(self, topic, msg, handler):
+        path = msg["payload"]["query"]["path"]
+        legs = path.split('/')
+        basename = ''
+        if legs[0] == 'device':
+            print_path = path
+            legs = legs[1:]
+            local_path = os.path.join(self.plugin._settings.getBaseFolder('uploads'))
+            for leg in legs:
+                local_path = os.path.join(local_path, leg)
+            basename = os.path.basename(local_path)
+        else:
+            self.logger.debug(getLog('start print from external drive', topic=topic))
+            system = platform.system()
+            if system == 'Linux':
+                self.logger.debug(getLog('copying file to linux local', topic=topic))
+                basename = os.path.basename(path)
+                local_path = os.path.join(self.plugin._settings.getBaseFolder('uploads'), basename)
+                if legs[1] == 'dev':
+                    ext_rel_legs = legs[3:]
+                    external_abs_path = '/mnt/mosaic/'
+                    for leg in ext_rel_legs:
+                        external_abs_path = os.path.join(external_abs_path, leg)
+                    copyfile(external_abs_path, local_path)
+                    print_path = 'device/' + basename
+            elif system == 'Windows':
+                self.logger.debug(getLog('copying file to windows local', topic=topic))
+                basename = os.path.basename(path)
+                local_path = os.path.join(self.plugin._settings.getBaseFolder('uploads'), basename)
+                copyfile(path, local_path)
+                print_path = 'device/' + basename
+        with self.completions.expect(events=['PrintStarted']) as completion:
+            self._printer.select_file(local_path, sd=False, printAfterSelect=True)
+            timestamp = os.path.getmtime(local_path)
+            job_name = legs[len(legs) - 1]
+            self.update_state(job_start=datetime.datetime.utcnow().isoformat()[:-3] + 'Z',
+                              file_path=print_path,
+                              job_name=job_name,
+                              file_size=os.path.getsize(local_path),
+                              job_status='start',
+                              file_date=datetime.datetime.utcfromtimestamp(timestamp).strftime(
+                                  '%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z')
+            self.logger.info(getLog('starting print: ' + job_name, topic=topic))
+
+            self._awaitCompletion(completion, topic, handler.timeout)
+
+    def _handleCancel(self, topic, msg, handler):
+        job_tracked = self.state.get("job_status") != ''
+        self._printer.cancel_print()
+        if job_tracked:
+            # PrintCancelled clears the tracked job
+            self.state_changes.wait_until(lambda: self.state.get("job_status") == '', handler.timeout)
+
+    def _handlePause(self, topic, msg, handler):
+        self.update_state(job_status='pausing')
+        with self.completions.expect(events=['PrintPaused']) as completion:
+            self._printer.pause_print()
+            self._awaitCompletion(completion, topic, handler.timeout)
+
+    def _handleResume(self, topic, msg, handler):
+        with self.completions.expect(events=['PrintResumed']) as completion:
+            self._printer.resume_print()
+            self._awaitCompletion(completion, topic, handler.timeout)
+        self.update_state(job_status='')
+
+    def _handleCommand(self, topic, msg, handler):
+        command = msg["payload"]["query"]["command"]
+        gcode = Completion.gcode_of(command)
+        with self.completions.expect(gcodes=[gcode] if gcode else []) as completion:
+            self._printer.commands(command, tags=completion.tags)
+            self._awaitCompletion(completion, topic, handler.timeout)
+
+    def _handleStoragePut(self, topic, msg, handler):
+        path = None
+        if "query" in msg["payload"] and "path" in msg["payload"]["query"]:
+            path = msg["payload"]["query"]["path"]
+        name = ""
+        if "name" in msg["payload"]["query"]:
+            name = msg["payload"]["query"]["name"]
+        if "s3path" in msg["payload"]["query"]:
+            # higher priorities jump the download queue, e.g. for the file that is printed next
+            priority = int(msg["payload"]["query"].get("priority", 0))
+            job = self.download_manager.submit(msg["payload"]["query"]["s3path"], name, priority)
+            if job is None:
+                return 503, {
+                    "response": "Service Unavailable"
+                }
+            return handler.status, {
+                "path": path,
+                "jobId": job.id,
+                "state": job.state
+            }
+        return 204, RequestDispatcher.NO_CONTENT
+
+    def _handleStorageDelete(self, topic, msg, handler):
+        if "jobId" not in msg["payload"].get("query", {}):
+            return None
+        job = self.download_manager.cancel(msg["payload"]["query"]["jobId"])
+        if job is None:
+            return 404, NOT_FOUND
+        return 200, job.to_dict()
+
+    def _handleStorageGet(self, topic, msg, handler):
+        drives = ["device/"]
+        system = platform.system()
+        if system == 'Linux':
+            temp_drives = os.popen('sudo blkid /dev/sd*').read()
+            temp_drives = temp_drives.split('\n')
+            self.logger.debug(getLog('temp_drives: ' + str(temp_drives), topic=topic))
+            temp_drives.remove('')
+            for drive in temp_drives:
+                drive = drive.split(':')
+                try:
+                    if 'PARTUUID' in drive[1]:
+                        temp_drives2 = []
+                        temp_drives2.append(drive[0])
+                        for idx, drive in enumerate(temp_drives2):
+                            if drive != '':
+                                drives.append(drive)
+                except Exception as e:
+                    self.logger.error(getLog('error finding drive: ' + str(e), topic=topic))
+        elif system == 'Windows':
+            available_drives = ['%s:' % d for d in string.ascii_uppercase if os.path.exists('%s:' % d)]
+            for drive in available_drives:
+                if drive != 'C:':
+                    drives.append(drive)
+        return handler.status, drives
+
+    def _handleStoragePost(self, topic, msg, handler):
+        response = None
+        # get folder content
+        if "path" in msg["payload"]["query"] and "newPath" not in msg["payload"][\
+                "query"]:
+            files = self._get_folder_content(msg, topic)
+            response = 200, files
+
+        # edit file name
+        if "newPath" in msg["payload"]["query"]:
+            path = msg["payload"]["query"]["path"]
+            new_path = msg["payload"]["query"]["newPath"]
+            old_legs = path.split('/')
+            new_legs = new_path.split('/')
+            if old_legs[0] == 'device':
+                old_legs.pop(0)
+                path = '/'.join(old_legs[:])
+                new_legs.pop(0)
+                new_path = '/'.join(new_legs)
+                new_abs_path = os.path.join(self.plugin._settings.getBaseFolder('uploads'),
+                                            new_path)
+                os.rename(os.path.join(self.plugin._settings.getBaseFolder(
+                    'uploads'), path), new_abs_path)
+            else:
+                system = platform.system()
+                if system == 'Linux':
+                    old_abs_path = '/mnt/mosaic'
+                    for idx, leg in enumerate(old_legs):
+                        if idx > 2:
+                            old_abs_path = os.path.join(old_abs_path, leg)
+                    new_abs_path = '/mnt/mosaic'
+                    for idx, leg in enumerate(new_legs):
+                        if idx > 2:
+                            new_abs_path = os.path.join(new_abs_path, leg)
+                    os.popen('sudo mv ' + old_abs_path + ' ' + new_abs_path).read()
+                    pass
+                elif system == 'Windows':
+                    new_abs_path = new_path
+                    os.rename(path, new_path)
+                pass
+            timestamp = os.path.getmtime(new_abs_path)
+            timestamp = datetime.datetime.utcfromtimestamp(timestamp).strftime(
+                '%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+            response = 200, {
+                "name": new_legs[len(new_legs) - 1],
+                "dateModified":  timestamp
+            }
+        return response
+
+    def _handlePrinterConnect(self, topic, msg, handler):
+        port = None
+        baudrate = None
+        if "baudrate" in msg["payload"]["query"]:
+            if msg["payload"]["query"]["baudrate"] != "auto":
+                baudrate = int(msg["payload"]["query"]["baudrate"])
+        if "comPort" in msg["payload"]["query"]:
+            if msg["payload"]["query"]["comPort"] != "auto":
+                port = msg["payload"]["query"]["comPort"]
+        self._printer.connect(port=port, baudrate=baudrate)
+        connected = self.state_changes.wait_until(lambda: self.state.get("printer_connected"), handler.timeout)
+        self.request_broadcast()
+        if not connected:
+            return 504, GATEWAY_TIMEOUT
+
+    def _handlePaletteConnect(self, topic, msg, handler):
+        self.logger.info(getLog('palette connect', topic=topic))
+        self.plugin.canvas.palette_comm.send_message('connect')
+        connected = self.state_changes.wait_until(lambda: self.state.get("palette_connected"), handler.timeout)
+        self.request_broadcast()
+        if not connected:
+            return 504, GATEWAY_TIMEOUT
+
+    def _handlePaletteDisconnect(self, topic, msg, handler):
+        self.plugin.canvas.palette_comm.send_message('disconnect')
+        self.state_changes.wait_until(lambda: not self.state.get("palette_connected"), handler.timeout)
+
+    def _handlePrinterDisconnect(self, topic, msg, handler):
+        with self.completions.expect(events=['Disconnected']) as completion:
+            self._printer.disconnect()
+            self._awaitCompletion(completion, topic, handler.timeout, require_operational=False)
+
+    def _handleScanComPorts(self, topic, msg, handler):
+        connection_options = self._printer.get_connection_options()
+        return handler.status, {
+            "ports": connection_options["ports"]
+        }
+
+    def _handleUpdateActiveSetup(self, topic, msg, handler):
+        setup_id = msg["payload"]["query"]["id"]
+        with self.edit_hub_yaml() as hub_yaml:
+            hub_yaml["canvas-user"]["active-setup"] = {"id": setup_id}
+        self.logger.info(getLog('active setup updated', topic=topic))
+        self.update_state(active_setup_id=setup_id)
+
+    def update_state(self, **values):
+        # wakes any request waiting on connection or job status, and broadcasts if that changed the state
+        changed = self.state.set(**values)
+        self.state_changes.notify()
+        if changed:
+            self.request_broadcast()
+
+    def _awaitCompletion(self, completion, topic, timeout, require_operational=True):
+        # nothing is sent to a printer that isn't operational, so there is nothing to wait for
+        if require_operational and not self._printer.is_operational():
+            return
+        if not completion.wait(timeout):
+            self.logger.info(getLog('not confirmed within ' + str(timeout) + 's', topic=topic))
 
     def _publishResponse(self, response_topic, req_msg_id, response_body, response_status):
         response_msg = {
@@ -624,11 +700,7 @@ class Router:
                 "body": response_body,
             },
         }
-        self.mqtt.mqtt_publish(response_topic, response_msg)
-
-    def _check_kth_power(self, n, k):
-        candidate = k ** int(log(n, k))
-        return candidate == n or k * candidate == n
+        self.mqtt.mqtt_publish(response_topic, response_msg, allow_queueing=True)
 
     def _get_folder_content(self, msg, topic):
         files = []
@@ -0,0 +1,154 @@
+import collections
+import itertools
+import json
+import os
+import threading
+
+
+def getLog(msg, module='outbox'):
+    return '{ "msg": "' + str(msg) + '", "module": "' + module +'" }'
+
+
+class Outbox:
+    # Messages published while the broker is unreachable, oldest first, replayed by MQTT once it connects.
+    # A coalesced message replaces the queued one for its topic (the state broadcast: only the newest matters),
+    # every other message is kept in order. Past max_messages or max_bytes the oldest are dropped.
+    # With a path the outbox survives restarts: every change is appended to the file as one JSON line, and the
+    # file is rewritten with just the queued messages once it has grown to mostly stale lines.
+    def __init__(self, logger, path=None, max_messages=500, max_bytes=1048576):
+        self.logger = logger
+        self.path = path
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.dropped = 0
+        self._messages = collections.OrderedDict()
+        self._bytes = 0
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._file = None
+        self._lines = 0
+        if path is not None:
+            self._load()
+
+    def __len__(self):
+        return len(self._messages)
+
+    def put(self, topic, payload, qos=0, coalesce=False):
+        size = len(topic) + len(payload)
+        if size > self.max_bytes:
+            self.logger.warn(getLog("Not queueing a %d byte message for %s, larger than the outbox" % (size, topic)))
+            return False
+        with self._lock:
+            key = "topic:" + topic if coalesce else "seq:%d" % next(self._sequence)
+            if key in self._messages:
+                self._remove(key)
+            self._messages[key] = (topic, payload, qos)
+            self._bytes += size
+            self._append({"key": key, "topic": topic, "payload": payload, "qos": qos})
+            while len(self._messages) > self.max_messages or self._bytes > self.max_bytes:
+                oldest = next(iter(self._messages))
+                self._remove(oldest)
+                self._append({"key": oldest})
+                self.dropped += 1
+            self._compactIfStale()
+        return True
+
+    def peek(self):
+        # (key, message) for the oldest message or None; pass both to done() once it went out
+        with self._lock:
+            for key, message in self._messages.items():
+                return key, message
+            return None
+
+    def done(self, key, message):
+        # a coalesced message may have been replaced since peek(), the newer one stays queued
+        with self._lock:
+            if self._messages.get(key) is not message:
+                return
+            self._remove(key)
+            self._append({"key": key})
+            self._compactIfStale()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _remove(self, key):
+        topic, payload, _ = self._messages.pop(key)
+        self._bytes -= len(topic) + len(payload)
+
+    def _append(self, record):
+        if self._file is None:
+            return
+        try:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            self._lines += 1
+        except (IOError, OSError) as e:
+            self.logger.error(getLog("Failed to write outbox, it is kept in memory only: " + str(e)))
+            self._closeFile()
+
+    def _compactIfStale(self):
+        if self._file is None:
+            return
+        if not self._messages:
+            # the common case, everything went out
+            self._file.seek(0)
+            self._file.truncate()
+            self._lines = 0
+        elif self._lines > 2 * len(self._messages) + 64:
+            self._rewrite()
+
+    def _rewrite(self):
+        self._closeFile()
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "w") as temp_file:
+                for key, (topic, payload, qos) in self._messages.items():
+                    temp_file.write(json.dumps({"key": key, "topic": topic, "payload": payload, "qos": qos}) + "\n")
+            if os.name == "nt" and os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(temp_path, self.path)
+            self._lines = len(self._messages)
+            self._file = open(self.path, "a")
+        except (IOError, OSError) as e:
+            self.logger.error(getLog("Failed to rewrite outbox, it is kept in memory only: " + str(e)))
+
+    def _closeFile(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except (IOError, OSError):
+                pass
+            self._file = None
+
+    def _load(self):
+        folder = os.path.dirname(self.path)
+        if not os.path.exists(folder):
+            os.mkdir(folder)
+        last_sequence = -1
+        if os.path.isfile(self.path):
+            with open(self.path, "r") as outbox_file:
+                for line in outbox_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last line of a crash, the message it held was never confirmed as queued
+                        continue
+                    key = record["key"]
+                    if key in self._messages:
+                        self._remove(key)
+                    if "topic" in record:
+                        self._messages[key] = (record["topic"], record["payload"], record["qos"])
+                        self._bytes += len(record["topic"]) + len(record["payload"])
+                    if key.startswith("seq:"):
+                        last_sequence = max(last_sequence, int(key[4:]))
+        self._sequence = itertools.count(last_sequence + 1)
+        while len(self._messages) > self.max_messages or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._messages)))
+            self.dropped += 1
+        if self._messages:
+            self.logger.info(getLog("%d messages in the outbox from before the restart" % len(self._messages)))
+        self._rewrite()
@@ -30,11 +30,10 @@ class PaletteComm:
                     port = data['port']
                     port = port.split('\\')
                     port = port[-1]
-                    self.plugin.canvas.mqtt.mqttRouter.palette_connected = True
-                    self.plugin.canvas.mqtt.mqttRouter.palette_port = port[-1]
+                    self.plugin.canvas.mqtt.mqttRouter.update_state(palette_connected=True,
+                                                                    palette_port=port[-1])
                 elif data['connection'] == 'palette 2 disconnected':
-                    self.plugin.canvas.mqtt.mqttRouter.palette_connected = False
-                    self.plugin.canvas.mqtt.mqttRouter.palette_port = ''
+                    self.plugin.canvas.mqtt.mqttRouter.update_state(palette_connected=False, palette_port='')
         pass
 
     def _on_message(self, plugin, data):
@@ -45,12 +44,11 @@ class PaletteComm:
                     port = data['port']
                     port = port.split('\\')
                     port = port[-1]
-                    self.plugin.canvas.mqtt.mqttRouter.palette_connected = True
-                    self.plugin.canvas.mqtt.mqttRouter.palette_port = port[-1]
+                    self.plugin.canvas.mqtt.mqttRouter.update_state(palette_connected=True,
+                                                                    palette_port=port[-1])
                 elif data['connection'] == 'palette 2 disconnected':
                     self.logger.info(getLog('disconnect from canvas', topic='disonnect'))
-                    self.plugin.canvas.mqtt.mqttRouter.palette_connected = False
-                    self.plugin.canvas.mqtt.mqttRouter.palette_port = ''
+                    self.plugin.canvas.mqtt.mqttRouter.update_state(palette_connected=False, palette_port='')
         pass
 
     def send_message(self, data):
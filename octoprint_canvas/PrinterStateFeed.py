@@ -0,0 +1,19 @@
+from octoprint.printer import PrinterCallback
+
+
+class PrinterStateFeed(PrinterCallback):
+    # Registered with OctoPrint's printer, hands the current data and temperatures it pushes (while printing
+    # about once a second, otherwise on changes only) to the router's state model
+    def __init__(self, router):
+        self.router = router
+
+    def on_printer_send_initial_data(self, data):
+        self.router.on_current_data(data)
+        if data.get("temps"):
+            self.router.on_temperatures(data["temps"][-1])
+
+    def on_printer_send_current_data(self, data):
+        self.router.on_current_data(data)
+
+    def on_printer_add_temperature(self, data):
+        self.router.on_temperatures(data)
@@ -0,0 +1,51 @@
+NO_CONTENT = {
+    "response": "No Content"
+}
+
+
+class RequestHandler:
+    # callback(topic, msg, handler) returns (status, body), or None to answer with the handler's default response.
+    # concurrency is the RequestExecutor category the request runs in, None runs it alongside anything else.
+    # timeout is how long the handler may wait for the printer to confirm the request.
+    def __init__(self, callback=None, concurrency=None, timeout=None, status=204, body=None):
+        self.callback = callback
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.status = status
+        self.body = NO_CONTENT if body is None else body
+
+    def handle(self, topic, msg):
+        response = None
+        if self.callback is not None:
+            response = self.callback(topic, msg, self)
+        if response is None:
+            return self.status, self.body
+        return response
+
+
+class RequestDispatcher:
+    # Maps (request topic, storage method) to a handler. Requests without a method, or with a method that has no
+    # handler of its own, fall back to the handler registered for the bare topic.
+    def __init__(self, request_subscription, default_handler):
+        self.request_prefix = None
+        if request_subscription:
+            self.request_prefix = str(request_subscription).split('/#')[0]
+        self.default_handler = default_handler
+        self._handlers = {}
+
+    def register(self, topic, handler, method=None):
+        self._handlers[(topic, method)] = handler
+
+    def request_topic(self, topic):
+        if self.request_prefix is None or not topic.startswith(self.request_prefix):
+            return None
+        return topic[len(self.request_prefix):]
+
+    def resolve(self, request_topic, msg):
+        method = None
+        if isinstance(msg.get("payload"), dict):
+            method = msg["payload"].get("method")
+        handler = self._handlers.get((request_topic, method))
+        if handler is None:
+            handler = self._handlers.get((request_topic, None), self.default_handler)
+        return handler
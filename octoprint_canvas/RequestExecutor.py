@@ -0,0 +1,88 @@
+import threading
+import traceback
+from collections import deque
+
+
+def getLog(msg, module='request-executor'):
+    return '{ "msg": "' + str(msg) + '", "module": "' + module +'" }'
+
+
+class RequestExecutor:
+    # Runs inbound requests on a bounded pool of worker threads. Tasks that share a category are run one
+    # at a time in submission order (e.g. printer motion), tasks without a category run concurrently.
+    # When max_pending tasks are queued or running, submit() refuses new work instead of blocking the caller.
+    def __init__(self, logger, workers=3, max_pending=32):
+        self.logger = logger
+        self.max_pending = max_pending
+        self._lock = threading.Condition(threading.Lock())
+        self._ready = deque()
+        self._backlogs = {}
+        self._busy = set()
+        self._pending = 0
+        self._running = True
+        self._workers = []
+        for index in range(max(1, workers)):
+            worker = threading.Thread(target=self._work, name="canvas-request-%s" % index)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, category, fn, *args, **kwargs):
+        task = (category, fn, args, kwargs)
+        with self._lock:
+            if not self._running:
+                return False
+            if self._pending >= self.max_pending:
+                self.logger.warn(getLog("request queue full, rejecting " + str(category) + " task"))
+                return False
+            self._pending += 1
+            if category is not None and category in self._busy:
+                self._backlogs.setdefault(category, deque()).append(task)
+                return True
+            if category is not None:
+                self._busy.add(category)
+            self._ready.append(task)
+            self._lock.notify()
+        return True
+
+    def pending(self):
+        with self._lock:
+            return self._pending
+
+    def shutdown(self):
+        with self._lock:
+            self._running = False
+            self._pending -= len(self._ready) + sum(len(backlog) for backlog in self._backlogs.values())
+            self._ready.clear()
+            self._backlogs.clear()
+            self._lock.notify_all()
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while self._running and not self._ready:
+                    self._lock.wait()
+                if not self._running:
+                    return
+                category, fn, args, kwargs = self._ready.popleft()
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                self.logger.error(getLog("error running " + str(category) + " task: " + str(e)))
+                self.logger.error(traceback.format_exc())
+            finally:
+                self._finish(category)
+
+    def _finish(self, category):
+        with self._lock:
+            self._pending -= 1
+            if category is None:
+                return
+            backlog = self._backlogs.get(category)
+            if backlog:
+                # keep the category marked busy and hand its next task straight to the ready queue
+                self._ready.append(backlog.popleft())
+                self._lock.notify()
+            else:
+                self._backlogs.pop(category, None)
+                self._busy.discard(category)
@@ -0,0 +1,119 @@
+import email.utils
+import random
+import threading
+import time
+
+import requests
+
+
+def getLog(msg, module='retry'):
+    return '{ "msg": "' + str(msg) + '", "module": "' + module +'" }'
+
+
+class Retry(requests.exceptions.RequestException):
+    # raised by an attempt that should be tried again, retry_after is the server's Retry-After in seconds.
+    # A RequestException, so callers outside a RetryScheduler handle it like any other failed request.
+    def __init__(self, message, retry_after=None):
+        requests.exceptions.RequestException.__init__(self, message)
+        self.retry_after = retry_after
+
+
+class RetriesExhausted(Exception):
+    pass
+
+
+def retry_after_seconds(response):
+    # Retry-After is either delta-seconds or an HTTP date
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0, email.utils.mktime_tz(parsed) - time.time())
+
+
+class Backoff:
+    # Capped exponential backoff with full jitter: attempt n waits a random time between 0 and
+    # min(cap, base * multiplier^n), so hubs that failed together don't retry together. A Retry-After
+    # from the server is a lower bound.
+    def __init__(self, base=1, cap=300, multiplier=2):
+        self.base = base
+        self.cap = cap
+        self.multiplier = multiplier
+
+    def delay(self, attempt, retry_after=None):
+        ceiling = min(self.cap, self.base * (self.multiplier ** min(attempt, 32)))
+        delay = random.uniform(0, ceiling)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.cap))
+        return delay
+
+
+class RetryScheduler:
+    # Runs attempt() until it returns, waiting with backoff between attempts that raise Retry or one of
+    # retry_on. max_attempts None retries forever, stop_event cuts a wait short and gives up. Counts
+    # attempts, failures and the time it took to succeed.
+    def __init__(self, logger, name, backoff=None, max_attempts=None, stop_event=None,
+                 retry_on=(requests.exceptions.RequestException,)):
+        self.logger = logger
+        self.name = name
+        self.backoff = Backoff() if backoff is None else backoff
+        self.max_attempts = max_attempts
+        self.retry_on = retry_on
+        self._stop_event = threading.Event() if stop_event is None else stop_event
+        self._lock = threading.Lock()
+        self.attempts = 0
+        self.failures = 0
+        self.successes = 0
+        self.consecutive_failures = 0
+        self.last_time_to_success = None
+
+    def run(self, attempt):
+        started = time.time()
+        tries = 0
+        while True:
+            tries += 1
+            with self._lock:
+                self.attempts += 1
+            try:
+                result = attempt()
+            except Retry as e:
+                error, retry_after = e, e.retry_after
+            except self.retry_on as e:
+                error, retry_after = e, None
+            else:
+                elapsed = time.time() - started
+                with self._lock:
+                    self.successes += 1
+                    self.consecutive_failures = 0
+                    self.last_time_to_success = elapsed
+                if tries > 1:
+                    self.logger.info(getLog("%s succeeded after %s attempts in %d s" % (self.name, tries, elapsed)))
+                return result
+            with self._lock:
+                self.failures += 1
+                self.consecutive_failures += 1
+            if self.max_attempts is not None and tries >= self.max_attempts:
+                raise RetriesExhausted("%s failed %s times: %s" % (self.name, tries, str(error)))
+            delay = self.backoff.delay(tries - 1, retry_after)
+            self.logger.info(getLog("%s failed (%s), retrying in %d s" % (self.name, str(error), delay)))
+            if self._stop_event.wait(delay):
+                raise RetriesExhausted("%s stopped: %s" % (self.name, str(error)))
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "attempts": self.attempts,
+                "failures": self.failures,
+                "successes": self.successes,
+                "consecutiveFailures": self.consecutive_failures,
+                "lastTimeToSuccess": self.last_time_to_success
+            }
@@ -0,0 +1,140 @@
+import heapq
+import itertools
+import threading
+import time
+
+# deadlines are kept on a clock that wall clock adjustments can't move, python 2 only has clock()
+try:
+    clock = time.monotonic
+except AttributeError:
+    clock = time.time
+
+
+def getLog(msg, module='scheduler'):
+    return '{ "msg": "' + str(msg) + '", "module": "' + module +'" }'
+
+
+class Task:
+    def __init__(self, scheduler, name, fn, due, interval):
+        self.name = name
+        self.fn = fn
+        self.due = due
+        self.interval = interval
+        self.cancelled = False
+        self._scheduler = scheduler
+
+    def cancel(self):
+        self._scheduler.cancel(self)
+
+
+class TaskStats:
+    def __init__(self):
+        self.runs = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.max_late = 0.0
+
+    def record(self, elapsed, late, failed):
+        self.runs += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        self.max_late = max(self.max_late, late)
+        if failed:
+            self.errors += 1
+
+    def to_dict(self):
+        return {
+            "runs": self.runs,
+            "errors": self.errors,
+            "averageMs": int(self.total / self.runs * 1000) if self.runs else 0,
+            "maxMs": int(self.max * 1000),
+            "maxLateMs": int(self.max_late * 1000)
+        }
+
+
+class Scheduler:
+    # One thread runs every delayed and recurring task of the plugin, sleeping until the earliest one is due.
+    # Tasks run one at a time and must not block; work that waits on the network belongs on its own thread.
+    # Recurring tasks are due at fixed multiples of their interval from the first run, so they don't drift,
+    # and runs missed while the thread was busy are skipped rather than run back to back.
+    def __init__(self, logger):
+        self.logger = logger
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stats = {}
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="canvas-scheduler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def call_later(self, name, delay, fn):
+        return self._add(name, fn, clock() + delay, None)
+
+    def every(self, name, interval, fn, delay=None):
+        # first run after delay, interval by default
+        return self._add(name, fn, clock() + (interval if delay is None else delay), interval)
+
+    def cancel(self, task):
+        # a cancelled task stays in the heap until it comes up and is dropped there
+        with self._condition:
+            task.cancelled = True
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            for _, _, task in self._heap:
+                task.cancelled = True
+            self._heap = []
+            self._condition.notify()
+
+    def stats(self):
+        with self._condition:
+            return dict((name, stats.to_dict()) for name, stats in self._stats.items())
+
+    def _add(self, name, fn, due, interval):
+        task = Task(self, name, fn, due, interval)
+        with self._condition:
+            if self._stopped:
+                task.cancelled = True
+                return task
+            heapq.heappush(self._heap, (due, next(self._sequence), task))
+            # the new task may be due before the one the thread is sleeping for
+            self._condition.notify()
+        return task
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    if self._heap and self._heap[0][2].cancelled:
+                        heapq.heappop(self._heap)
+                        continue
+                    delay = self._heap[0][0] - clock() if self._heap else None
+                    if delay is not None and delay <= 0:
+                        break
+                    self._condition.wait(delay)
+                if self._stopped:
+                    return
+                due, _, task = heapq.heappop(self._heap)
+            self._runTask(task, due)
+
+    def _runTask(self, task, due):
+        started = clock()
+        failed = False
+        try:
+            task.fn()
+        except Exception as e:
+            failed = True
+            self.logger.error(getLog("task " + task.name + " failed: " + str(e)))
+        finished = clock()
+        with self._condition:
+            stats = self._stats.get(task.name)
+            if stats is None:
+                stats = self._stats[task.name] = TaskStats()
+            stats.record(finished - started, started - due, failed)
+            if task.interval is not None and not task.cancelled and not self._stopped:
+                missed = int((finished - due) // task.interval)
+                task.due = due + (missed + 1) * task.interval
+                heapq.heappush(self._heap, (task.due, next(self._sequence), task))
@@ -0,0 +1,137 @@
+import threading
+
+import requests
+
+from . import constants
+
+
+class RangeNotSupported(requests.exceptions.RequestException):
+    pass
+
+
+class Segment:
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.position = start
+
+
+def split_range(start, end, count):
+    # [start, end) in count segments of (nearly) equal size
+    size = max(1, -(-(end - start) // count))
+    return [Segment(begin, min(begin + size, end)) for begin in range(start, end, size)]
+
+
+def range_headers(start, end, etag):
+    # If-Range makes the server send the whole file instead if it changed since the partial download
+    return {"Range": "bytes=%s-%s" % (start, end - 1), "If-Range": etag}
+
+
+class SegmentedDownload:
+    # Fetches the rest of a spooled download as several concurrent byte ranges, written in place. The spool
+    # only ever exposes the contiguous prefix, so readers see the same bytes, in the same order, as with a
+    # single stream. first_response is the already opened response for the first segment, it may run
+    # past the end of that segment. With breakers (CircuitBreakers), the range requests go through the breaker
+    # for the host like every other S3 request.
+    def __init__(self, url, spool, total_size, segments, etag, chunk_size, resume_attempts, first_response=None,
+                 breakers=None):
+        self.url = url
+        self.breakers = breakers
+        self.etag = etag
+        self.total_size = total_size
+        self.chunk_size = chunk_size
+        self.resume_attempts = resume_attempts
+        self.segments = split_range(spool.size(), total_size, segments)
+        self.downloaded = spool.size()
+        self._spool = spool
+        self._first_response = first_response
+        self._condition = threading.Condition(threading.Lock())
+        self._running = 0
+        self._error = None
+
+    def run(self, on_progress=None, interval=0.25):
+        threads = []
+        with self._condition:
+            self._running = len(self.segments)
+        for index, segment in enumerate(self.segments):
+            response = self._first_response if index == 0 else None
+            thread = threading.Thread(target=self._fetch, args=(segment, response))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        while True:
+            with self._condition:
+                if self._running and self._error is None:
+                    self._condition.wait(interval)
+                downloaded = self.downloaded
+                finished = not self._running or self._error is not None
+            if on_progress is not None:
+                try:
+                    on_progress(downloaded)
+                except Exception as e:
+                    # e.g. the download was cancelled, the segments stop at their next chunk
+                    with self._condition:
+                        if self._error is None:
+                            self._error = e
+                    finished = True
+            if finished:
+                break
+        for thread in threads:
+            thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _fetch(self, segment, response):
+        attempts = 0
+        try:
+            while segment.position < segment.end and self._error is None:
+                try:
+                    if response is None:
+                        response = self._get(range_headers(segment.position, segment.end, self.etag))
+                    # a plain 200 is the whole file, which is fine for the segment that starts at byte 0
+                    if response.status_code != 206 and not (response.status_code == 200 and segment.position == 0):
+                        response.close()
+                        raise RangeNotSupported("server answered a range request with %s" % response.status_code)
+                    for data in response.iter_content(chunk_size=self.chunk_size):
+                        if self._error is not None:
+                            break
+                        data = data[:segment.end - segment.position]
+                        self._spool.write_at(segment.position, data)
+                        self._advance(segment, len(data))
+                        if segment.position >= segment.end:
+                            break
+                    response.close()
+                    response = None
+                    if segment.position < segment.end and self._error is None:
+                        raise requests.exceptions.ChunkedEncodingError("range ended early")
+                except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                    attempts += 1
+                    response = None
+                    if attempts > self.resume_attempts:
+                        raise
+        except Exception as e:
+            with self._condition:
+                if self._error is None:
+                    self._error = e
+                self._condition.notify_all()
+        finally:
+            with self._condition:
+                self._running -= 1
+                self._condition.notify_all()
+
+    def _get(self, headers):
+        if self.breakers is None:
+            return requests.get(self.url, stream=True, headers=headers, timeout=constants.DOWNLOAD_TIMEOUT)
+        return self.breakers.call(self.url, requests.get, self.url, stream=True, headers=headers,
+                                  timeout=constants.DOWNLOAD_TIMEOUT)
+
+    def _advance(self, segment, length):
+        with self._condition:
+            segment.position += length
+            self.downloaded += length
+            contiguous = self.segments[0].start
+            for current in self.segments:
+                contiguous = current.position
+                if current.position < current.end:
+                    break
+        self._spool.set_available(contiguous)
@@ -0,0 +1,124 @@
+import json
+import re
+import threading
+
+import six
+
+try:
+    # optional, a lot faster where it is installed
+    import orjson
+except ImportError:
+    orjson = None
+
+SEPARATORS = (",", ":")
+RAW_MARKER = "@@raw-%d@@"
+TEMPLATE_MARKER = "@@value-%s@@"
+TEMPLATE_VALUE = re.compile('"@@value-([^@"]+)@@"')
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+encode_string = json.encoder.encode_basestring_ascii
+
+
+class RawJSON:
+    # already encoded JSON, dumps() puts it into the output as it is
+    def __init__(self, text):
+        self.text = text
+
+
+def to_json_types(data):
+    # the slow path for data the encoders refuse: bytes keys (or values), tuples and dict subclasses
+    if isinstance(data, bytes) and not isinstance(data, str):
+        return data.decode('ascii')
+    if isinstance(data, dict):
+        return dict((to_json_types(key), to_json_types(value)) for key, value in data.items())
+    if isinstance(data, (list, tuple)):
+        return [to_json_types(item) for item in data]
+    return data
+
+
+# RawJSON values met while encoding, per thread
+_raws = threading.local()
+
+
+def _default(value):
+    if isinstance(value, RawJSON):
+        _raws.values.append(value.text)
+        return RAW_MARKER % (len(_raws.values) - 1)
+    if isinstance(value, bytes):
+        return value.decode('ascii')
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+
+# building an encoder costs more than encoding a small message, so there is just the one
+_json = json.JSONEncoder(separators=SEPARATORS, default=_default).encode
+
+if orjson is not None:
+    def _fast(data):
+        return orjson.dumps(data, default=_default).decode("utf-8")
+else:
+    _fast = _json
+
+
+def dumps(data):
+    # compact JSON. bytes values are decoded on the way instead of converting the whole payload first, only
+    # data the encoder refuses (bytes keys) goes through to_json_types
+    _raws.values = raws = []
+    try:
+        text = _fast(data)
+    except TypeError:
+        del raws[:]
+        text = _json(to_json_types(data))
+    for index, raw in enumerate(raws):
+        text = text.replace('"' + RAW_MARKER % index + '"', raw, 1)
+    return text
+
+
+INFINITY = float("inf")
+
+
+def _encode_float(value):
+    # json writes nan and inf as NaN and Infinity
+    return float.__repr__(value) if -INFINITY < value < INFINITY else json.dumps(value)
+
+
+# by exact type, so bool doesn't end up with the int encoder
+VALUE_ENCODERS = {
+    type(None): lambda value: "null",
+    bool: lambda value: "true" if value else "false",
+    float: _encode_float,
+}
+for _type in six.string_types + (six.text_type,):
+    VALUE_ENCODERS[_type] = encode_string
+for _type in six.integer_types:
+    VALUE_ENCODERS[_type] = _type.__repr__ if _type is int else str
+if bytes is not str:
+    VALUE_ENCODERS[bytes] = lambda value: encode_string(value.decode('ascii'))
+
+
+def encode_value(value):
+    encoder = VALUE_ENCODERS.get(type(value))
+    return encoder(value) if encoder is not None else dumps(value)
+
+
+class TemplateEncoder:
+    # For documents that always have the same shape, like the state broadcast. build(values) returns the document;
+    # it is rendered once with markers for the values, after which encode(values) only encodes the values and
+    # joins them with the rendered JSON around them. With orjson, encoding the whole document is faster than that,
+    # so encode() just builds it.
+    def __init__(self, build, names):
+        self._build = build
+        text = dumps(build(dict((name, TEMPLATE_MARKER % name) for name in names)))
+        parts = TEMPLATE_VALUE.split(text)
+        self._names = parts[1::2]
+        self._literals = parts[2::2]
+        self._head = parts[0]
+
+    def encode(self, values):
+        if orjson is not None:
+            return self._build(values)
+        out = [self._head]
+        for name, literal in zip(self._names, self._literals):
+            out.append(encode_value(values[name]))
+            out.append(literal)
+        return RawJSON("".join(out))
@@ -0,0 +1,173 @@
+import os
+import tempfile
+import threading
+
+
+# the offset file is brought up to date whenever the contiguous prefix has grown by this much
+OFFSET_RECORD_INTERVAL = 4 * 1024 * 1024
+
+
+class SpoolError(IOError):
+    pass
+
+
+def read_offset(offset_path):
+    # None if there is no usable record
+    try:
+        with open(offset_path, "r") as offset_file:
+            return int(offset_file.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_offset(offset_path, offset):
+    temp_path = offset_path + ".tmp"
+    with open(temp_path, "w") as offset_file:
+        offset_file.write(str(offset))
+        offset_file.flush()
+        os.fsync(offset_file.fileno())
+    if os.name == "nt" and os.path.exists(offset_path):
+        os.remove(offset_path)
+    os.rename(temp_path, offset_path)
+
+
+class SpoolFile:
+    # A download file that is read while it is still being written. Readers block until the bytes they
+    # want have been written, and fail if the writer gives up.
+    # With a path, the spool continues an earlier partial download: the first offset bytes are kept and
+    # everything after them is overwritten. complete=True wraps a file that is already fully on disk.
+    # offset_path records how much of the file is contiguous and on disk, for resuming after a crash: segments
+    # are written out of order, so the file size says nothing until the spool is closed.
+    def __init__(self, folder=None, path=None, offset=0, complete=False, offset_path=None):
+        self._handle = None
+        self._offset_path = None if complete else offset_path
+        if complete:
+            offset = os.path.getsize(path)
+        elif path is None:
+            self._handle = tempfile.NamedTemporaryFile(dir=folder, suffix=".part", delete=False)
+            path = self._handle.name
+            offset = 0
+        else:
+            self._handle = open(path, "r+b" if offset else "wb")
+            self._handle.seek(offset)
+            self._handle.truncate()
+        self.path = path
+        self._write_lock = threading.Lock()
+        self._condition = threading.Condition(threading.Lock())
+        self._available = offset
+        self._closed = complete
+        self._error = None
+        self._recorded = offset
+        self._record(offset, force=True)
+
+    def size(self):
+        with self._condition:
+            return self._available
+
+    def write(self, data):
+        # appends to the contiguous prefix, also after a segmented download left bytes past it
+        self.write_at(self.size(), data)
+        with self._condition:
+            self._available += len(data)
+            self._record(self._available)
+            self._condition.notify_all()
+
+    def write_at(self, offset, data):
+        # for segmented downloads, the caller reports the contiguous prefix with set_available()
+        with self._write_lock:
+            self._handle.seek(offset)
+            self._handle.write(data)
+            self._handle.flush()
+
+    def set_available(self, available):
+        with self._condition:
+            if available > self._available:
+                self._available = available
+                self._record(available)
+                self._condition.notify_all()
+
+    def finish(self):
+        self._close(None)
+
+    def fail(self, error):
+        self._close(error)
+
+    def _close(self, error):
+        with self._condition:
+            if self._closed:
+                return
+            # drop anything past the contiguous prefix, a later attempt resumes from the end of the file
+            self._handle.truncate(self._available)
+            self._record(self._available, force=True)
+            self._handle.close()
+            self._closed = True
+            self._error = error
+            self._condition.notify_all()
+
+    def _record(self, available, force=False):
+        # the data goes to disk before the offset that covers it, so the record never runs ahead of the file
+        if self._offset_path is None:
+            return
+        if not force and available - self._recorded < OFFSET_RECORD_INTERVAL:
+            return
+        try:
+            with self._write_lock:
+                self._handle.flush()
+                os.fsync(self._handle.fileno())
+            write_offset(self._offset_path, available)
+            self._recorded = available
+        except (IOError, OSError):
+            # an older record is still correct as long as the file wasn't cut back below it, which only a
+            # forced record (start, close) follows
+            if force and os.path.exists(self._offset_path):
+                os.remove(self._offset_path)
+
+    def wait_closed(self):
+        with self._condition:
+            while not self._closed:
+                self._condition.wait()
+            return self._error
+
+    def discard(self):
+        self.wait_closed()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def open_reader(self):
+        return SpoolReader(self)
+
+    def _wait_available(self, position):
+        with self._condition:
+            while self._available <= position and not self._closed:
+                self._condition.wait()
+            if self._error is not None:
+                raise SpoolError("download failed: " + str(self._error))
+            return self._available
+
+
+class SpoolReader:
+    def __init__(self, spool):
+        self._spool = spool
+        # unbuffered, read-ahead could pick up parts of the file a segmented download hasn't written yet
+        self._file = open(spool.path, "rb", 0)
+        self._position = 0
+
+    def read(self, size):
+        available = self._spool._wait_available(self._position)
+        data = self._file.read(min(size, available - self._position))
+        self._position += len(data)
+        return data
+
+    def read_exact(self, size):
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            data = self.read(remaining)
+            if not data:
+                raise SpoolError("unexpected end of download")
+            chunks.append(data)
+            remaining -= len(data)
+        return b"".join(chunks)
+
+    def close(self):
+        self._file.close()
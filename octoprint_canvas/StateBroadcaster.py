@@ -0,0 +1,72 @@
+import threading
+
+
+FULL = "full"
+DELTA = "delta"
+
+# where each StateModel slot sits in the state document, as a JSON pointer
+STATE_PATHS = {
+    "active_setup_id": "/state/simcoe/data/activeSetup/id",
+    "palette_connected": "/state/palette/data/connected",
+    "palette_port": "/state/palette/data/serial/port",
+    "printer_connected": "/state/printer/data/connected",
+    "serial_port": "/state/printer/data/serial/port",
+    "baud": "/state/printer/data/serial/baud",
+    "nozzle_actual": "/state/printer/data/temperature/nozzle/0/actual",
+    "nozzle_target": "/state/printer/data/temperature/nozzle/0/target",
+    "bed_actual": "/state/printer/data/temperature/bed/actual",
+    "bed_target": "/state/printer/data/temperature/bed/target",
+    "chamber_actual": "/state/printer/data/temperature/chamber/actual",
+    "chamber_target": "/state/printer/data/temperature/chamber/target",
+    "fan": "/state/printer/data/fan",
+    "motor": "/state/printer/data/motor",
+    "job_name": "/state/printer/job/name",
+    "job_progress": "/state/printer/job/progress",
+    "job_start": "/state/printer/job/time/start",
+    "job_status": "/state/printer/job/status/name",
+    "job_total_time": "/state/printer/job/data/totalTime",
+    "job_time_remaining": "/state/printer/job/data/timeRemaining",
+    "filament_length": "/state/printer/job/data/filament/length",
+    "file_path": "/state/printer/job/data/file/path",
+    "file_size": "/state/printer/job/data/file/size",
+    "file_date": "/state/printer/job/data/file/date",
+}
+
+
+class StateBroadcaster:
+    # Numbers the state broadcasts (seq) and decides what each one carries. In full mode every broadcast is a
+    # keyframe with the whole state as body. In delta mode only every keyframe_interval-th broadcast (and the
+    # first, and the one after request_keyframe()) is; the others carry patch, a list of JSON-patch replace
+    # operations against the previous broadcast. A consumer that misses a seq asks for /state to get a keyframe.
+    def __init__(self, mode=FULL, keyframe_interval=10):
+        self.mode = mode if mode in (FULL, DELTA) else FULL
+        self.keyframe_interval = max(1, keyframe_interval)
+        self.seq = 0
+        self._previous = None
+        self._keyframe_requested = False
+        self._lock = threading.Lock()
+
+    def request_keyframe(self):
+        with self._lock:
+            self._keyframe_requested = True
+
+    def payload(self, values, build_state):
+        # values are the published StateModel values, build_state turns them into the state document
+        with self._lock:
+            self.seq += 1
+            keyframe = (self.mode == FULL or self._previous is None or self._keyframe_requested or
+                        self.seq % self.keyframe_interval == 0)
+            payload = {
+                "status": 200,
+                "seq": self.seq,
+                "keyframe": keyframe,
+            }
+            if keyframe:
+                payload["body"] = build_state(values)
+            else:
+                payload["patch"] = [{"op": "replace", "path": STATE_PATHS[name], "value": value}
+                                    for name, value in sorted(values.items())
+                                    if name in STATE_PATHS and self._previous.get(name) != value]
+            self._previous = values
+            self._keyframe_requested = False
+            return payload
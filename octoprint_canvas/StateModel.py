@@ -0,0 +1,71 @@
+import threading
+
+
+class Slot:
+    # One field of the broadcast state. value is the current value, published the one last broadcast. A change
+    # is significant (and makes the slot dirty) when threshold is None and the value differs, or when the
+    # value moved more than threshold away from the published one. threshold can also be a function of the
+    # new value returning the threshold.
+    def __init__(self, value, threshold=None):
+        self.value = value
+        self.published = value
+        self.threshold = threshold
+        self.dirty = False
+
+    def set(self, value):
+        self.value = value
+        self.dirty = self.significant(self.published, value)
+        return self.dirty
+
+    def significant(self, before, after):
+        if before == after:
+            return False
+        if self.threshold is None:
+            return True
+        try:
+            threshold = self.threshold(after) if callable(self.threshold) else self.threshold
+            return abs(after - before) > threshold
+        except TypeError:
+            # not numbers, e.g. None before the first reading
+            return True
+
+
+class StateModel:
+    # The printer, job and palette state as flat named slots. Setting a slot is cheap and says whether the
+    # state now differs significantly from what was last published; the nested message is built by the
+    # caller from publish() only when it is actually sent.
+    def __init__(self):
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def define(self, name, value, threshold=None):
+        self._slots[name] = Slot(value, threshold)
+
+    def get(self, name):
+        return self._slots[name].value
+
+    def set(self, **values):
+        # True if any of the values made its slot dirty
+        changed = False
+        with self._lock:
+            for name, value in values.items():
+                if self._slots[name].set(value):
+                    changed = True
+        return changed
+
+    def dirty(self):
+        with self._lock:
+            return sorted(name for name, slot in self._slots.items() if slot.dirty)
+
+    def values(self):
+        with self._lock:
+            return dict((name, slot.value) for name, slot in self._slots.items())
+
+    def publish(self):
+        # the values to send, marked as published in the same step so a change made meanwhile stays dirty
+        with self._lock:
+            values = {}
+            for name, slot in self._slots.items():
+                values[name] = slot.published = slot.value
+                slot.dirty = False
+            return values
@@ -0,0 +1,22 @@
+import threading
+import time
+
+
+class StateNotifier:
+    # Writers call notify() after changing tracked state, waiters re-check their predicate on every notify
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+
+    def notify(self):
+        with self._condition:
+            self._condition.notify_all()
+
+    def wait_until(self, predicate, timeout):
+        deadline = time.time() + timeout
+        with self._condition:
+            while not predicate():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
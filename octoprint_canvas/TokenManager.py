@@ -0,0 +1,125 @@
+import threading
+import time
+
+import jwt
+
+from . import RetryScheduler
+
+
+def getLog(msg, module='token-manager'):
+    return '{ "msg": "' + str(msg) + '", "module": "' + module +'" }'
+
+
+def token_expiry(token):
+    # exp claim of a JWT, without verifying the signature (the Canvas API does that), or None
+    try:
+        # the options spelling works with pyjwt 1.x and 2.x alike
+        claims = jwt.decode(token, options={"verify_signature": False, "verify_exp": False})
+    except jwt.InvalidTokenError:
+        return None
+    exp = claims.get("exp")
+    if isinstance(exp, (int, float)):
+        return exp
+    return None
+
+
+class TokenManager:
+    # Keeps the device access token in memory and refreshes it refresh_margin seconds before it expires,
+    # in the background once start() has been called. fetch_token() returns a new token or raises; when
+    # several callers need a new token at once they all wait for the same fetch. on_refresh(token) is
+    # called with every new token, e.g. to persist it. Tokens without a readable exp are treated as valid
+    # for default_lifetime seconds.
+    def __init__(self, logger, fetch_token, on_refresh=None, refresh_margin=60, default_lifetime=300):
+        self.logger = logger
+        self.refresh_margin = refresh_margin
+        self.default_lifetime = default_lifetime
+        self._fetch_token = fetch_token
+        self._on_refresh = on_refresh
+        self._condition = threading.Condition(threading.Lock())
+        self._token = None
+        self._expires_at = 0
+        self._refreshing = False
+        self._error = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._wakeup = threading.Event()
+        self.retry = RetryScheduler.RetryScheduler(logger, "access token refresh", RetryScheduler.Backoff(5, 300),
+                                                   stop_event=self._stopped, retry_on=(Exception,))
+
+    def seed(self, token):
+        # a token we already have, e.g. from the hub YAML or the registration response
+        with self._condition:
+            self._set(token)
+        self._wakeup.set()
+
+    def get(self):
+        with self._condition:
+            if self._token is not None and time.time() < self._expires_at - self.refresh_margin:
+                return self._token
+        return self.refresh()
+
+    def invalidate(self):
+        with self._condition:
+            self._expires_at = 0
+
+    def refresh(self):
+        with self._condition:
+            if self._refreshing:
+                while self._refreshing:
+                    self._condition.wait()
+                if self._error is not None:
+                    raise self._error
+                return self._token
+            self._refreshing = True
+        token, error = None, None
+        try:
+            token = self._fetch_token()
+            if not token:
+                raise ValueError("no access token in response")
+        except Exception as e:
+            error = e
+        with self._condition:
+            self._refreshing = False
+            self._error = error
+            if error is None:
+                self._set(token)
+            self._condition.notify_all()
+        if error is not None:
+            self.logger.error(getLog("access token refresh failed: " + str(error)))
+            raise error
+        self.logger.debug(getLog("access token refreshed"))
+        self._wakeup.set()
+        if self._on_refresh is not None:
+            self._on_refresh(token)
+        return token
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._refreshInBackground, name="canvas-token-refresh")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def _set(self, token):
+        # with the lock held
+        expiry = token_expiry(token) if token else None
+        self._token = token
+        self._expires_at = expiry if expiry is not None else time.time() + self.default_lifetime
+
+    def _refreshInBackground(self):
+        while not self._stopped.is_set():
+            with self._condition:
+                delay = self._expires_at - self.refresh_margin - time.time()
+            if delay > 0:
+                # a new token (seed or refresh) wakes us up to recompute the delay
+                self._wakeup.wait(delay)
+                self._wakeup.clear()
+                continue
+            try:
+                self.retry.run(self.refresh)
+            except RetryScheduler.RetriesExhausted:
+                return
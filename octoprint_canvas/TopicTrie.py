@@ -0,0 +1,102 @@
+import threading
+
+
+class _Node:
+    def __init__(self):
+        self.children = {}
+        self.values = []
+
+
+class TopicTrie:
+    # MQTT topic filters by level, each with the values subscribed to it. match() walks the levels of a topic
+    # once, following the literal level, + and # at each, so it costs the topic depth rather than a check of
+    # every subscription. Wildcards follow MQTT: + is exactly one level, # the rest including none
+    # ("a/#" matches "a"), and neither matches a first level starting with $.
+    def __init__(self):
+        self._root = _Node()
+        self._lock = threading.Lock()
+
+    def add(self, topic_filter, value):
+        with self._lock:
+            node = self._root
+            for level in topic_filter.split("/"):
+                node = node.children.setdefault(level, _Node())
+            node.values.append(value)
+
+    def remove(self, predicate, topic_filter=None):
+        # removes the values predicate(value) is true for, under topic_filter or anywhere; returns the
+        # filters that lost all their values
+        with self._lock:
+            emptied = []
+            if topic_filter is None:
+                self._removeAll(self._root, [], predicate, emptied)
+            else:
+                self._removeFrom(self._root, topic_filter.split("/"), 0, predicate, emptied)
+            return emptied
+
+    def match(self, topic):
+        with self._lock:
+            values = []
+            levels = topic.split("/")
+            nodes = [self._root]
+            for depth, level in enumerate(levels):
+                wildcards = depth > 0 or not level.startswith("$")
+                next_nodes = []
+                for node in nodes:
+                    if wildcards:
+                        rest = node.children.get("#")
+                        if rest is not None:
+                            values.extend(rest.values)
+                        one = node.children.get("+")
+                        if one is not None:
+                            next_nodes.append(one)
+                    child = node.children.get(level)
+                    if child is not None:
+                        next_nodes.append(child)
+                nodes = next_nodes
+                if not nodes:
+                    return values
+            for node in nodes:
+                values.extend(node.values)
+                # "a/#" matches "a" itself
+                rest = node.children.get("#")
+                if rest is not None:
+                    values.extend(rest.values)
+            return values
+
+    def filters(self):
+        with self._lock:
+            found = []
+            self._collect(self._root, [], found)
+            return found
+
+    def _removeFrom(self, node, levels, depth, predicate, emptied):
+        if depth == len(levels):
+            self._removeValues(node, levels, predicate, emptied)
+        else:
+            child = node.children.get(levels[depth])
+            if child is None:
+                return
+            self._removeFrom(child, levels, depth + 1, predicate, emptied)
+            if not child.values and not child.children:
+                del node.children[levels[depth]]
+
+    def _removeAll(self, node, path, predicate, emptied):
+        self._removeValues(node, path, predicate, emptied)
+        for level, child in list(node.children.items()):
+            self._removeAll(child, path + [level], predicate, emptied)
+            if not child.values and not child.children:
+                del node.children[level]
+
+    def _removeValues(self, node, path, predicate, emptied):
+        if not node.values:
+            return
+        node.values = [value for value in node.values if not predicate(value)]
+        if not node.values:
+            emptied.append("/".join(path))
+
+    def _collect(self, node, path, found):
+        if node.values:
+            found.append("/".join(path))
+        for level, child in node.children.items():
+            self._collect(child, path + [level], found)
@@ -0,0 +1,174 @@
+import os
+import struct
+import zlib
+
+LOCAL_FILE_HEADER = b"PK\x03\x04"
+CENTRAL_DIRECTORY_HEADER = b"PK\x01\x02"
+END_OF_CENTRAL_DIRECTORY = b"PK\x05\x06"
+DATA_DESCRIPTOR = b"PK\x07\x08"
+LOCAL_HEADER = struct.Struct("<HHHHHIIIHH")
+ZIP64_EXTRA_ID = 0x0001
+ZIP64_LIMIT = 0xFFFFFFFF
+
+FLAG_ENCRYPTED = 0x01
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+STORED = 0
+DEFLATED = 8
+
+CHUNK_SIZE = 64 * 1024
+
+
+class UnsupportedZip(Exception):
+    # Raised for archives that can't be extracted front to back, the caller falls back to zipfile
+    pass
+
+
+def safe_member_path(name):
+    # same idea as zipfile: no absolute paths, no drive letters, no parent directory escapes
+    legs = [leg for leg in name.replace("\\", "/").split("/") if leg not in ("", ".", "..")]
+    if legs and len(legs[0]) == 2 and legs[0][1] == ":":
+        legs = legs[1:]
+    return os.path.join(*legs) if legs else None
+
+
+class StreamingZipExtractor:
+    # Extracts members from the local file headers as the archive is read, without needing the
+    # central directory at the end. reader only needs read(size).
+    def __init__(self, reader, destination, on_member=None):
+        self._reader = reader
+        self._destination = destination
+        self._on_member = on_member
+        self._pending = b""
+        self.extracted = []
+
+    def extract(self):
+        while True:
+            signature = self._read_exact(4)
+            if signature in (CENTRAL_DIRECTORY_HEADER, END_OF_CENTRAL_DIRECTORY):
+                return self.extracted
+            if signature != LOCAL_FILE_HEADER:
+                raise UnsupportedZip("unexpected record signature")
+            self._extract_member()
+
+    def _extract_member(self):
+        (version, flags, method, mod_time, mod_date, crc, compressed_size, size, name_length,
+         extra_length) = LOCAL_HEADER.unpack(self._read_exact(LOCAL_HEADER.size))
+        raw_name = self._read_exact(name_length)
+        extra = self._read_exact(extra_length)
+        name = raw_name.decode("utf-8" if flags & FLAG_UTF8 else "cp437")
+        if flags & FLAG_ENCRYPTED:
+            raise UnsupportedZip("encrypted member " + name)
+        if method not in (STORED, DEFLATED):
+            raise UnsupportedZip("unsupported compression for " + name)
+        zip64 = self._zip64_sizes(extra)
+        if zip64 is not None and compressed_size == ZIP64_LIMIT:
+            compressed_size = zip64[1]
+        has_descriptor = flags & FLAG_DATA_DESCRIPTOR
+        if has_descriptor and method == STORED:
+            raise UnsupportedZip("stored member with unknown size " + name)
+
+        relative_path = safe_member_path(name)
+        target = os.path.join(self._destination, relative_path) if relative_path else None
+        if target is None or name.endswith("/"):
+            self._skip_or_consume(method, compressed_size, has_descriptor, None)
+            if has_descriptor:
+                self._read_descriptor_crc(zip64 is not None)
+            if target is not None and not os.path.isdir(target):
+                os.makedirs(target)
+        else:
+            folder = os.path.dirname(target)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            # write under a hidden name so the watched folder only ever sees complete files
+            partial = os.path.join(folder, "." + os.path.basename(target) + ".part")
+            try:
+                with open(partial, "wb") as output:
+                    actual_crc = self._skip_or_consume(method, compressed_size, has_descriptor, output)
+                if has_descriptor:
+                    crc = self._read_descriptor_crc(zip64 is not None)
+                if actual_crc != crc:
+                    raise IOError("CRC mismatch in " + name)
+                if os.path.exists(target):
+                    os.remove(target)
+                os.rename(partial, target)
+            except Exception:
+                if os.path.exists(partial):
+                    os.remove(partial)
+                raise
+            self.extracted.append(name)
+            if self._on_member is not None:
+                self._on_member(name, len(self.extracted))
+
+    def _skip_or_consume(self, method, compressed_size, has_descriptor, output):
+        crc = 0
+        if method == STORED:
+            remaining = compressed_size
+            while remaining > 0:
+                data = self._read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    raise UnsupportedZip("archive ended inside a member")
+                remaining -= len(data)
+                crc = zlib.crc32(data, crc)
+                if output is not None:
+                    output.write(data)
+            return crc & 0xFFFFFFFF
+
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        remaining = None if has_descriptor else compressed_size
+        while remaining != 0 and not self._inflated_all(decompressor):
+            data = self._read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+            if not data:
+                raise UnsupportedZip("archive ended inside a member")
+            if remaining is not None:
+                remaining -= len(data)
+            inflated = decompressor.decompress(data)
+            crc = zlib.crc32(inflated, crc)
+            if output is not None:
+                output.write(inflated)
+        inflated = decompressor.flush()
+        crc = zlib.crc32(inflated, crc)
+        if output is not None:
+            output.write(inflated)
+        # anything read past the end of the deflate stream belongs to the next record
+        self._pending = decompressor.unused_data + self._pending
+        return crc & 0xFFFFFFFF
+
+    def _inflated_all(self, decompressor):
+        if hasattr(decompressor, "eof"):
+            return decompressor.eof
+        # Python 2 has no eof flag, but anything past the end of the stream lands in unused_data
+        return bool(decompressor.unused_data)
+
+    def _read_descriptor_crc(self, zip64):
+        sizes_length = 16 if zip64 else 8
+        first = self._read_exact(4)
+        if first == DATA_DESCRIPTOR:
+            first = self._read_exact(4)
+        self._read_exact(sizes_length)
+        return struct.unpack("<I", first)[0]
+
+    def _zip64_sizes(self, extra):
+        offset = 0
+        while offset + 4 <= len(extra):
+            header_id, length = struct.unpack("<HH", extra[offset:offset + 4])
+            if header_id == ZIP64_EXTRA_ID and length >= 16:
+                return struct.unpack("<QQ", extra[offset + 4:offset + 20])
+            offset += 4 + length
+        return None
+
+    def _read(self, size):
+        if self._pending:
+            data, self._pending = self._pending[:size], self._pending[size:]
+            return data
+        return self._reader.read(size)
+
+    def _read_exact(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self._read(size - len(data))
+            if not chunk:
+                raise UnsupportedZip("archive ended unexpectedly")
+            data += chunk
+        return data
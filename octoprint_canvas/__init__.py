@@ -13,6 +13,11 @@ from . import constants
 from . import MQTT
 import os
 from . import CanvasErrors
+from . import RequestExecutor
+from . import HubStore
+from . import HubSettings
+from . import Scheduler
+from . import Outbox
 import platform
 import logging
 import sys
@@ -21,13 +26,6 @@ import threading
 import subprocess
 from subprocess import call
 
-try:
-    from ruamel.yaml import YAML
-except ImportError:
-    from ruamel.yaml.main import YAML
-yaml = YAML(typ="safe")
-yaml.default_flow_style = False
-
 reM106 = re.compile("^M106.* S(\d+\.?\d*).*")
 
 def getLog(msg, module='init canvas'):
@@ -84,10 +82,15 @@ class CanvasPlugin(octoprint.plugin.TemplatePlugin,
                    octoprint.plugin.SettingsPlugin):
 
     def __init__(self):
-        self.hub_yaml = None
+        self.hub_store = None
+        self.hub_settings = None
         self.logger = None
         self.initialized = False
+        self.connectionTask = None
         self.connectionThread = None
+        self.request_executor = None
+        self.scheduler = None
+        self.outbox = None
 
     # STARTUPPLUGIN
     def on_after_startup(self):
@@ -105,31 +108,48 @@ class CanvasPlugin(octoprint.plugin.TemplatePlugin,
                 self.logger.error(getLog('Error on after startup: ', str(e)))
             self.logger.critical(getLog('Python - ' + sys.version))
             self.logger.critical(getLog('OctoPrint: ' + str(octoprint.server.VERSION)))
+            self.scheduler = Scheduler.Scheduler(self.logger)
             self.errors = CanvasErrors.CanvasErrors(self)
             self.logger.debug('ping google: ' + str(ping('google.com')))
             if ping('google.com') and not self.initialized:
                 self.init_canvas()
             else:
-                self._startConnectionThread()
-
-    def _startConnectionThread(self):
-        self.logger.debug(getLog('starting connection thread'))
-        if self.connectionThread is None:
-            self.connectionThread = threading.Thread(target=self._connection)
-            self.connectionThread.daemon = True
-            self.connectionThread.start()
-
-    def _connection(self):
-        self.logger.debug('connection thread started')
-        self.logger.debug('connection 0: ' + str(ping('google.com')))
-        while ping('google.com') == False:
-            time.sleep(3)
-            self.logger.debug('connection: ' + str(ping('google.com')))
-            if ping('google.com') and not self.initialized:
+                self._startConnectionCheck()
+
+    def _startConnectionCheck(self):
+        self.logger.debug(getLog('starting connection check'))
+        if self.connectionTask is None:
+            self.connectionTask = self.scheduler.every("connection check", 3, self._checkConnection)
+
+    def _checkConnection(self):
+        # the scheduler only triggers the check, ping and init_canvas wait on the network so they get a thread
+        if self.connectionThread is not None and self.connectionThread.is_alive():
+            return
+        self.connectionThread = threading.Thread(target=self._runConnectionCheck, name="canvas-connection-check")
+        self.connectionThread.daemon = True
+        self.connectionThread.start()
+
+    def _runConnectionCheck(self):
+        online = ping('google.com')
+        self.logger.debug('connection: ' + str(online))
+        if online:
+            self.connectionTask.cancel()
+            if not self.initialized:
                 self.init_canvas()
-        return
 
     def init_canvas(self):
+        if self.request_executor is None:
+            self.request_executor = RequestExecutor.RequestExecutor(
+                self.logger,
+                workers=self._settings.get_int(["requestWorkers"]),
+                max_pending=self._settings.get_int(["requestQueueSize"]))
+        if self.outbox is None:
+            outbox_path = None
+            if self._settings.get_boolean(["outboxPersist"]):
+                outbox_path = os.path.join(os.path.expanduser('~'), ".mosaicdata", "canvas-outbox.jsonl")
+            self.outbox = Outbox.Outbox(self.logger, outbox_path,
+                                        max_messages=self._settings.get_int(["outboxMaxMessages"]),
+                                        max_bytes=self._settings.get_int(["outboxMaxBytes"]))
         self.canvas = Canvas.Canvas(self)
         self.canvas.checkForRuamelVersion()
         self.canvas.isHubS = self.canvas.determineHubVersion()
@@ -145,7 +165,37 @@ class CanvasPlugin(octoprint.plugin.TemplatePlugin,
 
     #SHUTDOWNPLUGIN
     def on_shutdown(self):
-        self.canvas.mqtt.mqtt_disconnect(force=True)
+        # canvas and its parts only exist once the hub got online; every step runs even if an earlier one failed
+        steps = []
+        if self.hub_store is not None:
+            # first, a pending debounced write must not wait on the rest
+            steps.append(("hub YAML flush", self.hub_store.flush))
+        if self.request_executor is not None:
+            steps.append(("request executor", self.request_executor.shutdown))
+        canvas = getattr(self, "canvas", None)
+        if canvas is not None:
+            steps.extend([
+                ("download manager", canvas.download_manager.shutdown),
+                ("token manager", canvas.tokens.stop),
+                ("retries", canvas.retry_stop.set),
+                ("cloud API", canvas.api.close),
+            ])
+            mqtt = getattr(canvas, "mqtt", None)
+            if mqtt is not None:
+                steps.extend([
+                    ("MQTT router", mqtt.mqttRouter.close),
+                    ("MQTT", lambda: mqtt.mqtt_disconnect(force=True)),
+                ])
+        if self.outbox is not None:
+            steps.append(("outbox", self.outbox.close))
+        if self.scheduler is not None:
+            steps.append(("scheduler", self.scheduler.stop))
+        for name, step in steps:
+            try:
+                step()
+            except Exception as e:
+                if self.logger:
+                    self.logger.error(getLog("Error shutting down " + name + ": " + str(e)))
 
     # TEMPLATEPLUGIN
     def get_template_configs(self):
@@ -163,7 +213,13 @@ class CanvasPlugin(octoprint.plugin.TemplatePlugin,
         )
 
     def get_settings_defaults(self):
-        return dict(applyTheme=True, importantUpdate=True)
+        return dict(applyTheme=True, importantUpdate=True, requestWorkers=3, requestQueueSize=32,
+                    completionTimeout=5, stateChangeTimeout=29, downloadCacheSize=256,
+                    downloadSegments=4, downloadSegmentMinSize=8, downloadConcurrency=1,
+                    downloadProgressInterval=0.25, hubYamlFlushDelay=1.0, broadcastMode="full",
+                    broadcastKeyframeInterval=10, broadcastBackoffFactor=5, broadcastMaxInterval=3600,
+                    broadcastCoalesceWindow=0.25, broadcastRate=0.5, broadcastBurst=3, outboxPersist=True,
+                    outboxMaxMessages=500, outboxMaxBytes=1048576, outboxReplayRate=10, outboxReplayBurst=20)
 
     def get_update_information(self):
         # Define the configuration for your plugin to use with the Software Update
@@ -182,10 +238,10 @@ class CanvasPlugin(octoprint.plugin.TemplatePlugin,
 
     def handle_gcode_sent(self, comm_instance, phase, cmd, cmd_type, gcode, subcode=None, tags=None):
         try:
+            self.canvas.mqtt.mqttRouter.completions.notify_gcode(gcode, tags)
             if gcode == "M107":
                 # M107 -- set tracked fan speed to 0
-                self.canvas.mqtt.mqttRouter.fan_state = 0
-                self.canvas.mqtt.mqttRouter.broadcast_counter = -1
+                self.canvas.mqtt.mqttRouter.update_state(fan=0)
                 return
             if gcode == "M106":
                 # M106 Snn -- nn in [0..255] -- set tracked speed in [0..100]
@@ -194,16 +250,13 @@ class CanvasPlugin(octoprint.plugin.TemplatePlugin,
                     pwm_str = match.group(1)
                     pwm = float(pwm_str)
                     percentage = round(pwm * 100.0 / 255.0)
-                    self.canvas.mqtt.mqttRouter.fan_state = percentage
-                    self.canvas.mqtt.mqttRouter.broadcast_counter = -1
+                    self.canvas.mqtt.mqttRouter.update_state(fan=percentage)
                 return
             if gcode == "M17":
-                self.canvas.mqtt.mqttRouter.motor_state = True
-                self.canvas.mqtt.mqttRouter.broadcast_counter = -1
+                self.canvas.mqtt.mqttRouter.update_state(motor=True)
                 return
             if gcode == "M18":
-                self.canvas.mqtt.mqttRouter.motor_state = False
-                self.canvas.mqtt.mqttRouter.broadcast_counter = -1
+                self.canvas.mqtt.mqttRouter.update_state(motor=False)
                 return
         except Exception as e:
             if self.logger is not None:
@@ -242,6 +295,8 @@ class CanvasPlugin(octoprint.plugin.TemplatePlugin,
     # EVENTHANDLERPLUGIN
     def on_event(self, event, payload):
         try:
+            if self.initialized and hasattr(self.canvas, "mqtt"):
+                self.canvas.mqtt.mqttRouter.completions.notify_event(event)
             if "Startup" in event:
                 self.displayImportantUpdateAlert = False
             elif "ConnectivityChanged" in event:
@@ -258,105 +313,82 @@ class CanvasPlugin(octoprint.plugin.TemplatePlugin,
                         self.canvas.updateUI({"command": "importantUpdate", "data": "x.x.x"})
                     self.canvas.updateUsersOnUI()
                     self.canvas.updateIotConnectionOnUI()
+                    self.canvas.updateCloudStatusOnUI()
             elif "Shutdown" in event:
                 pass
             elif "PrintStarted" in event:
-                self.canvas.mqtt.mqttRouter._print_job_start_time = datetime.datetime.utcnow().isoformat()[:-3] + 'Z'
-                self.canvas.mqtt.mqttRouter._print_job_file_path = 'device/' + payload['path']
-                self.canvas.mqtt.mqttRouter._print_job_file_size = payload['size']
                 local_path = os.path.join(self.canvas._settings.getBaseFolder('uploads'), payload['path'])
                 timestamp = os.path.getmtime(local_path)
-                self.canvas.mqtt.mqttRouter._print_job_file_modified = datetime.datetime.fromtimestamp(
-                    timestamp).isoformat()[:-3] + 'Z'
-                self.canvas.mqtt.mqttRouter._print_job_file_name = payload['name']
-                self.canvas.mqtt.mqttRouter._print_job_status_name = 'start'
+                self.canvas.mqtt.mqttRouter.update_state(job_start=datetime.datetime.utcnow().isoformat()[:-3] + 'Z',
+                                                         file_path='device/' + payload['path'],
+                                                         file_size=payload['size'],
+                                                         file_date=datetime.datetime.fromtimestamp(
+                                                             timestamp).isoformat()[:-3] + 'Z',
+                                                         job_name=payload['name'],
+                                                         job_status='start')
             elif "PrintFailed" in event:
                 if payload['reason'] != 'cancelled':
                     pass
             elif "PrintCancelling" in event:
-                self.canvas.mqtt.mqttRouter._print_job_status_name = 'cancelling'
+                self.canvas.mqtt.mqttRouter.update_state(job_status='cancelling')
             elif ("PrintDone" in event) or ("PrintCancelled" in event):
-                self.canvas.mqtt.mqttRouter._print_job_start_time = ''
-                self.canvas.mqtt.mqttRouter._print_job_file_path = ''
-                self.canvas.mqtt.mqttRouter._print_job_file_size = ''
-                self.canvas.mqtt.mqttRouter._print_job_file_modified = ''
-                self.canvas.mqtt.mqttRouter._print_job_file_name = ''
-                self.canvas.mqtt.mqttRouter._print_job_status_name = ''
+                self.canvas.mqtt.mqttRouter.update_state(job_start='',
+                                                         file_path='',
+                                                         file_size='',
+                                                         file_date='',
+                                                         job_name='',
+                                                         job_status='')
             elif "PrintPaused" in event:
-                self.canvas.mqtt.mqttRouter._print_job_status_name = 'paused'
+                self.canvas.mqtt.mqttRouter.update_state(job_status='paused')
             elif "PrintResumed" in event:
-                self.canvas.mqtt.mqttRouter._print_job_status_name = 'start'
+                self.canvas.mqtt.mqttRouter.update_state(job_status='start')
             elif "PrinterStateChanged" in event:
-                self.canvas.mqtt.mqttRouter.broadcast_counter = -1
-                time.sleep(0.5)
+                self.canvas.mqtt.mqttRouter.request_broadcast()
                 if payload['state_id'] == 'DETECT_SERIAL' or payload['state_id'] == 'CONNECTING' \
                         or payload['state_id'] == 'NONE' or payload['state_id'] == 'UNKNOWN' \
                         or payload['state_id'] == 'CLOSED' or payload['state_id'] == 'ERROR' \
                         or payload['state_id'] == 'CLOSED_WITH_ERROR' or payload['state_id'] == 'OFFLINE':
-                    self.canvas.mqtt.mqttRouter.connected_state = False
+                    self.canvas.mqtt.mqttRouter.update_state(printer_connected=False)
                 else:
-                    self.canvas.mqtt.mqttRouter.connected_state = True
+                    self.canvas.mqtt.mqttRouter.update_state(printer_connected=True)
         except Exception as e:
             if self.logger:
                 self.logger.error(getLog(str(e)))
                 self.logger.error(getLog(str(event)))
 
-    def _loadYAMLFile(self, yaml_file_path):
-        yaml_file = open(yaml_file_path, "r")
-        yaml_data = yaml.load(yaml_file)
-        yaml_file.close()
-        return yaml_data
-
-    def _writeYAMLFile(self, yaml_file_path, data):
-        yaml_file = open(yaml_file_path, "w")
-        yaml.dump(data, yaml_file)
-        yaml_file.close()
-
-    def _updateYAMLInfo(self):
-        hub_data_path = os.path.expanduser('~') + "/.mosaicdata/canvas-hub-data.yml"
-        self._writeYAMLFile(hub_data_path, self.hub_yaml)
+    def _getHubStore(self):
+        if self.hub_store is None:
+            hub_file_path = os.path.join(os.path.expanduser('~'), ".mosaicdata", "canvas-hub-data.yml")
+            self.hub_store = HubStore.HubStore(hub_file_path, self.logger, self.scheduler,
+                                               self._settings.get_float(["hubYamlFlushDelay"]))
+        return self.hub_store
 
     def get_hub_yaml(self):
-        if not self.hub_yaml:
-            hub_dir_path = os.path.expanduser('~') + "/.mosaicdata"
-            hub_file_path = hub_dir_path + "/canvas-hub-data.yml"
-
-            # if /.mosaicdata doesn't exist yet, make the directory
-            if not os.path.exists(hub_dir_path):
-                os.mkdir(hub_dir_path)
-
-            # if the YML file doesn't exist, make the file
-            if not os.path.isfile(hub_file_path):
-                self._writeYAMLFile(hub_file_path, constants.DEFAULT_YAML)
-
-            # access yaml file with all the info
-            self.hub_yaml = self._loadYAMLFile(hub_file_path)
-
-            # if the yaml file is somehow empty
-            if not self.hub_yaml:
-                self._writeYAMLFile(hub_file_path, constants.DEFAULT_YAML)
-                self.hub_yaml = self._loadYAMLFile(hub_file_path)
-
-            # for compatibility with older hub zero, if the yaml file doesn't have a "canvas-users" key
-            if not "canvas-user" in self.hub_yaml and all(key in self.hub_yaml for key in ("canvas-hub", "versions")):
-                self.hub_yaml["canvas-user"] = {}
-                self._writeYAMLFile(hub_file_path, self.hub_yaml)
-                hub_yaml = self._loadYAMLFile(hub_file_path)
-
-            # if, for some reason, yaml file is still missing a property
-            if not all(key in self.hub_yaml for key in ("canvas-user", "canvas-hub", "versions")):
-                self.logger.info(getLog("Resetting YAML file to default"))
-                self._writeYAMLFile(hub_file_path, constants.DEFAULT_YAML)
-                hub_yaml = self._loadYAMLFile(hub_file_path)
-
-        return self.hub_yaml
+        # a read-only snapshot, take it once and read from it so all values come from the same version
+        return self._getHubStore().get()
+
+    def get_hub_settings(self):
+        # rebuilt only when the hub YAML changed since the last call
+        hub_yaml = self.get_hub_yaml()
+        hub_settings = self.hub_settings
+        if hub_settings is None or hub_settings.version != hub_yaml.version:
+            hub_settings = self.hub_settings = HubSettings.HubSettings(hub_yaml)
+        return hub_settings
+
+    def edit_hub_yaml(self):
+        # with self.edit_hub_yaml() as hub_yaml: ... changes a copy that is published and saved when the block
+        # ends. Written at most once per hubYamlFlushDelay, see flush_hub_yaml() for changes that must hit
+        # the disk now
+        return self._getHubStore().edit()
 
     def replace_hub_yaml(self, data):
-        self.hub_yaml = data
-        self._updateYAMLInfo()
+        self._getHubStore().replace(data)
+
+    def flush_hub_yaml(self):
+        self._getHubStore().flush()
 
-    def save_hub_yaml(self):
-        self._updateYAMLInfo()
+    def delete_hub_yaml(self):
+        return self._getHubStore().delete()
 
     def _writeFile(self, path, content):
         data = open(path, "w")
@@ -7,6 +7,14 @@ HUB_NOT_REGISTERED = "HUB is not registered yet. Cannot add user."
 USER_ALREADY_LINKED = "User already registered to HUB."
 INVALID_USER_CREDENTIALS = "Invalid user credentials. Cannot add user"
 
+# PRINT FILE DOWNLOADS
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_SPOOL_FOLDER = ".canvas-downloads"
+DOWNLOAD_CACHE_FOLDER = "cache"
+DOWNLOAD_RESUME_ATTEMPTS = 3
+# (connect, read) seconds, a stalled connection fails instead of holding a download worker
+DOWNLOAD_TIMEOUT = (10, 60)
+
 # SHADOW DEVICE CREDENTIALS
 ROOT_CA_CERTIFICATE = "https://www.amazontrust.com/repository/AmazonRootCA1.pem"
 SHADOW_CLIENT_HOST = "a6xr6l0abc72a-ats.iot.us-east-1.amazonaws.com"
@@ -7,6 +7,7 @@ function CanvasViewModel(parameters) {
 
   self.iotConnected = ko.observable(false);
   self.userLinked = ko.observable(false);
+  self.cloudAvailable = ko.observable(true);
   self.users = ko.observable(null);
 
   self.applyTheme = ko.observable();
@@ -129,6 +130,10 @@ function CanvasViewModel(parameters) {
   };
 
   self.addUser = () => {
+    if (!self.cloudAvailable()) {
+      CanvasAlerts.cloudUnavailable();
+      return;
+    }
     CanvasUI.loadingOverlay(true, 'addUser');
     const payload = {
       command: "addUser",
@@ -153,6 +158,10 @@ function CanvasViewModel(parameters) {
   });
 
   self.showUnlinkModal = () => {
+    if (!self.cloudAvailable()) {
+      CanvasAlerts.cloudUnavailable();
+      return;
+    }
     $("body").on("click", (event) => {
       if (event.target.classList.contains('unlink-confirm-btn')) {
         CanvasUI.loadingOverlay(true, 'unlinkUser');
@@ -250,13 +259,24 @@ function CanvasViewModel(parameters) {
         case "AccountUnlinkError":
           CanvasAlerts.AccountUnlinkError();
           break;
+        case "CloudStatus":
+          self.cloudAvailable(message.data.available);
+          break;
         case "CanvasDownload":
-          if (message.status === "starting") {
+          if (message.status === "queued") {
+            CanvasUI.updateDownloadQueued(message.data.filename);
+          } else if (message.status === "starting") {
             CanvasUI.startDownload(message.data.filename);
           } else if (message.status === "downloading") {
             CanvasUI.updateDownloadProgress(message.data.filename, message.data.progress);
           } else if (message.status === "received") {
             CanvasUI.updateFileReceived(message.data.filename);
+          } else if (message.status === "extracting") {
+            CanvasUI.updateFileExtracting(message.data.filename, message.data.member, message.data.count);
+          } else if (message.status === "extracted") {
+            CanvasUI.updateFileExtracted(message.data.filename, message.data.members);
+          } else if (message.status === "failed" || message.status === "cancelled") {
+            CanvasUI.updateDownloadFailed(message.data.filename, message.status === "cancelled");
           }
           break;
         case "importantUpdate":
@@ -77,4 +77,11 @@ const CanvasAlerts = {
       text: `There seems to be an issue unlinking the account from your Canvas Hub. Please make sure you are connected to the Internet and try again.`
     });
   },
+  cloudUnavailable: () => {
+    return swal({
+      type: "info",
+      title: "Canvas is unavailable",
+      text: `Your Canvas Hub can't reach Canvas right now. Please try again in a minute.`
+    });
+  },
 };
\ No newline at end of file
@@ -52,7 +52,8 @@ const CanvasUI = {
   /* 2.1 Update the download progress (%) on UI */
   updateDownloadProgress: (filename, progress) => {
     const id = getDownloadDomId(filename);
-    if (progress === 0) {
+    // updates come on a time budget, so any value can be the first one and 10 or 96 may never be hit exactly
+    if (progress < 10) {
       $("body")
         .find(`#${id} .total-bar`)
         .css("position", "static");
@@ -63,12 +64,18 @@ const CanvasUI = {
         .find(`#${id} .progression-tool-tip`)
         .css({ left: "0%", right: "auto", visibility: "visible" })
         .removeClass("tool-tip-arrow");
-    } else if (progress === 10) {
+    } else if (progress < 96) {
+      $("body")
+        .find(`#${id} .total-bar`)
+        .css("position", "static");
+      $("body")
+        .find(`#${id} .current-bar`)
+        .css("position", "relative");
       $("body")
         .find(`#${id} .progression-tool-tip`)
-        .css({ left: "auto", right: "-13.5px" })
+        .css({ left: "auto", right: "-13.5px", visibility: "visible" })
         .addClass("tool-tip-arrow");
-    } else if (progress === 96) {
+    } else {
       $("body")
         .find(`#${id} .total-bar`)
         .css("position", "relative");
@@ -77,7 +84,7 @@ const CanvasUI = {
         .css("position", "static");
       $("body")
         .find(`#${id} .progression-tool-tip`)
-        .css({ left: "auto", right: "0%" })
+        .css({ left: "auto", right: "0%", visibility: "visible" })
         .removeClass("tool-tip-arrow");
     }
     $("body")
@@ -128,6 +135,60 @@ const CanvasUI = {
         .addClass("highlight-glow-received");
     }, 400);
   },
+  /* 2.4 Show a download waiting for its turn in the download queue */
+  updateDownloadQueued: filename => {
+    const id = getDownloadDomId(filename);
+    if ($("body").find(`#${id}`).length === 0) {
+      CanvasUI.startDownload(filename);
+    }
+    $("body")
+      .find(`#${id} .popup-title`)
+      .text("Canvas File Queued...");
+  },
+  /* 2.5 Show each file as it comes out of the archive */
+  updateFileExtracting: (filename, member, count) => {
+    const id = getDownloadDomId(filename);
+    $("body")
+      .find(`#${id} .popup-title`)
+      .text(`Extracting Files (${count})...`);
+    $("body")
+      .find(`#${id} .file-download-name`)
+      .text(member);
+  },
+  /* 2.6 All files are out of the archive, analysis follows */
+  updateFileExtracted: (filename, members) => {
+    const id = getDownloadDomId(filename);
+    $("body")
+      .find(`#${id} .popup-title`)
+      .text(`${members} File${members === 1 ? "" : "s"} Extracted. Please Wait...`);
+    $("body")
+      .find(`#${id} .file-download-name`)
+      .text(filename);
+  },
+  /* 2.7 The download failed or was cancelled, clear the progress bar */
+  updateDownloadFailed: (filename, cancelled) => {
+    const id = getDownloadDomId(filename);
+    if ($("body").find(`#${id}`).length === 0) {
+      CanvasUI.startDownload(filename);
+    }
+    $("body")
+      .find(`#${id} .popup-title`)
+      .text(cancelled ? "Canvas Download Cancelled" : "Canvas Download Failed")
+      .hide()
+      .fadeIn(200);
+    $("body")
+      .find(`#${id} .small-loader`)
+      .remove();
+    $("body")
+      .find(`#${id} .total-bar`)
+      .fadeOut(200);
+    $("body")
+      .find(`#${id} .file-download-name`)
+      .text(filename);
+    $("body")
+      .find(`#${id}`)
+      .addClass("highlight-glow-failed");
+  },
   /* 3. Remove popup notifications */
   removePopup: () => {
     $("body").on("click", ".side-notifications-list .remove-popup", function () {
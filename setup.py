@@ -34,7 +34,12 @@ plugin_license = "AGPLv3"
 
 # Any additional requirements besides OctoPrint should be listed here
 plugin_requires = ["ruamel.yaml<0.16.0", "python-dotenv", "AWSIoTPythonSDK", "pyjwt",
-                   "paho-mqtt", "dictdiffer"]
+                   "paho-mqtt"]
+
+# Optional requirements by extra; "fast" adds a faster JSON encoder for MQTT payloads
+plugin_extras_requires = {
+    "fast": ["orjson; python_version >= '3.6'"]
+}
 
 # Additional package data to install for this plugin. The subfolders "templates", "static" and "translations" will
 # already be installed automatically if they exist.
@@ -62,5 +67,6 @@ setup(**octoprint_setuptools.create_plugin_setup_parameters(
     url=plugin_url,
     license=plugin_license,
     requires=plugin_requires,
+    extra_requires=plugin_extras_requires,
     additional_data=plugin_additional_data
 ))